@@ -0,0 +1,789 @@
+# pip install requests flask flask-cors quart httpx
+
+"""
+异步服务模式：基于 Quart (ASGI) 与 httpx 异步连接池实现与 main.py 相同的接口。
+每个流式请求只占用一个协程而非一个线程，单进程即可承载大量并发的长时间生成。
+
+启动时复用 main.py 中账号池 (account_pool) 的初始化结果、模型映射与本地会话库；
+请求翻译逻辑与 Flask 服务共用 QwenClient.prepare_chat / ChatStreamTranslator。
+原有的 Flask 服务 (python main.py) 保留作为后备。
+
+启动: python async_server.py
+或:   hypercorn async_server:app --bind 0.0.0.0:5000
+"""
+
+import asyncio
+import os
+import time
+
+import httpx
+from quart import Quart, request, jsonify, Response, g, send_file
+
+from main import (
+    ACTIVE_STREAMS,
+    ASYNC_UPSTREAM_MAX_CONNECTIONS,
+    CREATE_CHAT_HEDGES_TOTAL,
+    DEBUG_STATUS,
+    PORT,
+    STREAM_KEEPALIVE_INTERVAL,
+    ChatStreamTranslator,
+    InFlightRequest,
+    LOOKUP_SESSION,
+    QwenClient,
+    RequestTrace,
+    STAGE_SECONDS,
+    UPSTREAM_CONNECT_TIMEOUT,
+    UPSTREAM_MAX_RETRIES,
+    UPSTREAM_READ_TIMEOUT,
+    UPSTREAM_RESPONSES_TOTAL,
+    UPSTREAM_RETRIES_TOTAL,
+    UPSTREAM_RETRY_STATUSES,
+    UpstreamUnavailable,
+    account_pool,
+    batch_runner,
+    compaction_header,
+    reasoning_stream_mode,
+    response_cache,
+    single_flight,
+    start_request_trace,
+    trace_response,
+    debug_print,
+    error_response,
+    is_delta_line,
+    metrics,
+    qwen_client,
+    record_upstream_error,
+    retry_delay,
+)
+
+UPSTREAM_ERRORS = (httpx.HTTPError, UpstreamUnavailable)
+
+
+async def aiter_byte_lines(response: httpx.Response):
+    """按字节切分上游 SSE 行，不做整行解码"""
+    buffer = b""
+    async for data in response.aiter_bytes():
+        buffer += data
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line.rstrip(b"\r")
+    if buffer:
+        yield buffer
+
+
+async def aiter_with_keepalive(lines, interval: float, until=is_delta_line):
+    """
+    上游开始输出增量（until 为真的第一行）之前，超过 interval 秒没有新行时产出 None，供调用方在首 token 前发送保活注释；
+    等待中的读取不会因超时被取消，下一轮继续等待同一次读取。之后直接迭代，interval 为 0 时同样直接迭代。
+    """
+    iterator = lines.__aiter__()
+    if interval:
+        pending = None
+        try:
+            while True:
+                if pending is None:
+                    pending = asyncio.ensure_future(iterator.__anext__())
+                done, _ = await asyncio.wait({pending}, timeout=interval)
+                if not done:
+                    yield None
+                    continue
+                task, pending = pending, None
+                try:
+                    line = task.result()
+                except StopAsyncIteration:
+                    return
+                yield line
+                if until(line):
+                    break
+        finally:
+            if pending is not None:
+                pending.cancel()
+    async for line in iterator:
+        yield line
+
+
+async def aiter_flight_lines(flight: InFlightRequest, keepalive: float = 0):
+    """从头重放 single-flight 的上游行，等待新行超过 keepalive 秒时产出 None；上游出错时在末尾抛出异常"""
+    loop = asyncio.get_running_loop()
+    index = 0
+    while True:
+        lines, finished, error, future = flight.poll(index, loop)
+        if future is not None:
+            try:
+                await asyncio.wait_for(future, keepalive or None)
+            except asyncio.TimeoutError:
+                yield None
+            continue
+        index += len(lines)
+        for line in lines:
+            yield line
+        if finished:
+            if error is not None:
+                raise error
+            return
+
+
+async def wait_flight_ready(flight: InFlightRequest) -> dict:
+    """等待 single-flight 驱动方准备好会话并返回上下文；准备失败时抛出对应的异常"""
+    loop = asyncio.get_running_loop()
+    while flight.ctx is None:
+        _lines, finished, error, future = flight.poll(0, loop)
+        if flight.ctx is not None:
+            break
+        if finished:
+            raise error or RuntimeError("single-flight 驱动方未能准备会话")
+        if future is not None:
+            await future
+    return flight.ctx
+
+
+class AsyncQwenClient:
+    """
+    QwenClient 的异步版本，只负责与上游的 HTTP 交互。
+    模型映射、会话匹配与本地记录仍委托给同步的 QwenClient。
+    """
+
+    def __init__(self, client: QwenClient):
+        self.client = client
+        self.http = None
+
+    async def start(self):
+        """创建到上游的异步连接池"""
+        self.http = httpx.AsyncClient(
+            headers=dict(self.client.session.headers),
+            limits=httpx.Limits(max_connections=ASYNC_UPSTREAM_MAX_CONNECTIONS,
+                                max_keepalive_connections=ASYNC_UPSTREAM_MAX_CONNECTIONS),
+            # 读取超时限制的是两段数据之间的间隔，流式生成总时长不受限制
+            timeout=httpx.Timeout(connect=UPSTREAM_CONNECT_TIMEOUT, read=UPSTREAM_READ_TIMEOUT,
+                                  write=30.0, pool=None),
+        )
+
+    async def close(self):
+        """关闭连接池"""
+        if self.http is not None:
+            await self.http.aclose()
+
+    def _auth_headers(self, extra: dict = None) -> dict:
+        """确保 token 是最新的"""
+        headers = {"authorization": f"Bearer {self.client.auth_token}"}
+        if extra:
+            headers.update(extra)
+        return headers
+
+    async def _upstream_request(self, method: str, url: str, model_id: str = None,
+                                stream: bool = False, **kwargs) -> httpx.Response:
+        """与 QwenClient._upstream_request 相同的熔断与重试策略；stream=True 时调用方负责 aclose"""
+        breaker = self.client.breaker
+        retry_errors = (httpx.ConnectError, httpx.ConnectTimeout) if method == "POST" else \
+            (httpx.TransportError,)
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                raise UpstreamUnavailable(f"上游连续故障，已熔断 (账号 {self.client.name})")
+            try:
+                response = await self.http.send(self.http.build_request(method, url, **kwargs),
+                                                stream=stream)
+            except httpx.HTTPError as e:
+                breaker.record_failure()
+                if not isinstance(e, retry_errors) or attempt >= UPSTREAM_MAX_RETRIES:
+                    raise
+                debug_print(f"上游请求失败，准备重试: {e}")
+                if model_id is not None:
+                    record_upstream_error(model_id, e)
+            else:
+                if model_id is not None:
+                    UPSTREAM_RESPONSES_TOTAL.inc(model_id, response.status_code)
+                if response.status_code < 500:
+                    breaker.record_success()
+                else:
+                    breaker.record_failure()
+                if response.status_code not in UPSTREAM_RETRY_STATUSES or attempt >= UPSTREAM_MAX_RETRIES:
+                    try:
+                        response.raise_for_status()
+                    except httpx.HTTPStatusError:
+                        await response.aclose()
+                        raise
+                    return response
+                debug_print(f"上游返回 {response.status_code}，准备重试: {url}")
+                await response.aclose()
+            attempt += 1
+            UPSTREAM_RETRIES_TOTAL.inc(method)
+            await asyncio.sleep(retry_delay(attempt))
+
+    async def create_chat(self, model_id: str, title: str = "新对话") -> str:
+        """创建一个新的对话，对冲策略与 QwenClient.create_chat 相同"""
+        delay = self.client.hedge_delay()
+        if delay is None:
+            return await self._create_chat_once(model_id, title)
+        primary = asyncio.ensure_future(self._create_chat_once(model_id, title))
+        tasks = [primary]
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            debug_print(f"创建对话超过 {delay:.3f}s 未完成，发出对冲请求")
+            CREATE_CHAT_HEDGES_TOTAL.inc("sent")
+            tasks.append(asyncio.ensure_future(self._create_chat_once(model_id, title)))
+        error = None
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    error = task.exception()
+                    continue
+                if task is not primary:
+                    CREATE_CHAT_HEDGES_TOTAL.inc("won")
+                for other in tasks:
+                    if other is not task:
+                        other.add_done_callback(lambda t: self._discard_hedged_chat(model_id, t))
+                return task.result()
+        raise error
+
+    def _discard_hedged_chat(self, model_id: str, task: asyncio.Task):
+        """落选的对冲请求成功创建了对话时，放入对话池，池满则删除"""
+        if task.cancelled() or task.exception() is not None:
+            return
+        if not self.client.chat_pool.release(model_id, task.result()):
+            asyncio.ensure_future(self.delete_chat(task.result()))
+
+    async def _create_chat_once(self, model_id: str, title: str) -> str:
+        """发送一次创建对话请求"""
+        url = f"{self.client.base_url}/api/v2/chats/new"
+        payload = {
+            "title": title,
+            "models": [model_id],
+            "chat_mode": "normal",
+            "chat_type": "t2t", # Text to Text
+            "timestamp": int(time.time() * 1000)
+        }
+        started = time.perf_counter()
+        try:
+            response = await self._upstream_request("POST", url, model_id, json=payload,
+                                                    headers=self._auth_headers())
+            chat_id = response.json()['data']['id']
+            elapsed = time.perf_counter() - started
+            STAGE_SECONDS.observe(elapsed, "create_chat", model_id)
+            self.client._create_chat_latencies.append(elapsed)
+            debug_print(f"成功创建对话: {chat_id}")
+            return chat_id
+        except UPSTREAM_ERRORS as e:
+            debug_print(f"创建对话失败: {e}")
+            record_upstream_error(model_id, e)
+            self.client.health.record_failure(e)
+            raise
+
+    async def delete_chat(self, chat_id: str):
+        """删除一个对话"""
+        url = f"{self.client.base_url}/api/v2/chats/{chat_id}"
+        try:
+            response = await self._upstream_request("DELETE", url, headers=self._auth_headers())
+            res_data = response.json()
+            if res_data.get('success', False):
+                debug_print(f"成功删除对话: {chat_id}")
+                # 同时删除本地记录
+                await asyncio.to_thread(self.client.forget_session, chat_id)
+                return True
+            else:
+                debug_print(f"删除对话 {chat_id} 返回 success=False: {res_data}")
+                return False
+        except UPSTREAM_ERRORS as e:
+            debug_print(f"删除对话失败 {chat_id}: {e}")
+            return False
+        except ValueError:
+            debug_print(f"删除对话时无法解析 JSON 响应 {chat_id}")
+            return False
+
+    async def acquire_chat(self, ctx: dict) -> str:
+        """为新对话取得 chat_id：优先使用预创建的空对话，池中没有时即时创建"""
+        with ctx["trace"].span("create_chat") as span:
+            chat_id = self.client.chat_pool.acquire(ctx["qwen_model_id"])
+            if chat_id is None:
+                chat_id = await self.create_chat(ctx["qwen_model_id"], title=f"OpenAI_API_对话_{int(time.time())}")
+            span.set("qwen.chat_id", chat_id)
+        ctx["trace"].root.set("qwen.chat_id", chat_id)
+        return chat_id
+
+    async def chat_completions(self, openai_request: dict, cache_key: str = None, trace: RequestTrace = None,
+                               matched_session=LOOKUP_SESSION):
+        """
+        执行聊天补全。
+        流式时返回异步生成器；非流式时返回 (响应体, 状态码)。提供 cache_key 时完整回复写入响应缓存。
+        """
+        ctx = await asyncio.to_thread(self.client.prepare_chat, openai_request, trace, matched_session)
+        ctx["cache_key"] = cache_key
+        if "prompt_compaction" in ctx:
+            g.prompt_compaction = ctx["prompt_compaction"]
+        if ctx["chat_id"] is None:
+            ctx["chat_id"] = await self.acquire_chat(ctx)
+            debug_print(f"创建新会话 {ctx['chat_id']}")
+
+        url, payload, headers = self.client.build_completion_request(ctx)
+        headers = self._auth_headers(headers)
+        qwen_model_id = ctx["qwen_model_id"]
+        translator = ChatStreamTranslator(ctx["chat_id"], ctx["model"], ctx["stream"], qwen_model_id,
+                                          keep_reasoning=cache_key is not None,
+                                          reasoning_mode=ctx["reasoning_mode"], started=ctx["received_at"])
+
+        if ctx["stream"]:
+            async def generate():
+                ACTIVE_STREAMS.inc(qwen_model_id)
+                cancelled = False
+                try:
+                    r = await self._upstream_request("POST", url, qwen_model_id, stream=True,
+                                                     json=payload, headers=headers)
+                    try:
+                        # 上游长时间没有输出时 line 为 None，只用于发送保活注释
+                        async for line in aiter_with_keepalive(aiter_byte_lines(r), STREAM_KEEPALIVE_INTERVAL):
+                            for chunk in translator.relay_line(line):
+                                yield chunk
+                            if translator.done:
+                                break
+                        for chunk in translator.flush_pending():
+                            yield chunk
+                    finally:
+                        await r.aclose()
+                    self.client.health.record_success()
+                except (GeneratorExit, asyncio.CancelledError):
+                    # 客户端断开：生成器被关闭或协程被取消，上游连接已在上面的 finally 中关闭
+                    cancelled = not translator.complete
+                    raise
+                except UPSTREAM_ERRORS as e:
+                    debug_print(f"流式请求失败: {e}")
+                    record_upstream_error(qwen_model_id, e)
+                    self.client.health.record_failure(e)
+                    yield translator.error_chunk(e)
+                finally:
+                    ACTIVE_STREAMS.dec(qwen_model_id)
+                    # 客户端断开时协程会被取消，取消处理不再 await，直接同步执行（只记录指标并在后台通知上游）；
+                    # 正常结束时写会话记录可能访问 SQLite，放到线程中执行，避免阻塞事件循环
+                    if cancelled:
+                        self.client.cancel_chat(ctx, translator)
+                    else:
+                        await asyncio.to_thread(self.client.finish_chat, ctx, translator)
+
+            return generate()
+
+        try:
+            r = await self._upstream_request("POST", url, qwen_model_id, stream=True,
+                                             json=payload, headers=headers)
+            try:
+                async for line in aiter_byte_lines(r):
+                    translator.feed_line(line)
+                    if translator.done:
+                        break
+            finally:
+                await r.aclose()
+        except asyncio.CancelledError:
+            # 非流式请求的客户端断开时处理协程被取消，同样停止上游生成
+            self.client.cancel_chat(ctx, translator)
+            raise
+        except UPSTREAM_ERRORS as e:
+            debug_print(f"聊天补全失败: {e}")
+            record_upstream_error(qwen_model_id, e)
+            self.client.health.record_failure(e)
+            if isinstance(e, UpstreamUnavailable):
+                return error_response(str(e), "upstream_unavailable"), 503
+            return error_response(f"内部服务器错误: {str(e)}"), 500
+
+        self.client.health.record_success()
+        await asyncio.to_thread(self.client.finish_chat, ctx, translator)
+        return translator.completion_response(), 200
+
+    async def run_flight(self, openai_request: dict, flight: InFlightRequest, cache_key: str = None,
+                         trace: RequestTrace = None, matched_session=LOOKUP_SESSION):
+        """作为 single-flight 的驱动方执行一次聊天补全，逻辑与 QwenClient.run_flight 相同"""
+        ctx = translator = error = None
+        try:
+            ctx = await asyncio.to_thread(self.client.prepare_chat, openai_request, trace, matched_session)
+            ctx["cache_key"] = cache_key
+            if ctx["chat_id"] is None:
+                ctx["chat_id"] = await self.acquire_chat(ctx)
+                debug_print(f"创建新会话 {ctx['chat_id']}")
+            flight.start(ctx)
+            url, payload, headers = self.client.build_completion_request(ctx)
+            headers = self._auth_headers(headers)
+            qwen_model_id = ctx["qwen_model_id"]
+            translator = ChatStreamTranslator(ctx["chat_id"], ctx["model"], False, qwen_model_id,
+                                              keep_reasoning=cache_key is not None,
+                                              reasoning_mode="buffered", started=ctx["received_at"])
+            if not flight.cancelled:
+                r = await self._upstream_request("POST", url, qwen_model_id, stream=True,
+                                                 json=payload, headers=headers)
+                try:
+                    async for line in aiter_byte_lines(r):
+                        translator.feed_line(line)
+                        flight.publish(line)
+                        if translator.done or flight.cancelled:
+                            break
+                finally:
+                    await r.aclose()
+                self.client.health.record_success()
+        except UPSTREAM_ERRORS as e:
+            debug_print(f"single-flight 聊天补全失败: {e}")
+            if ctx is not None:
+                record_upstream_error(ctx["qwen_model_id"], e)
+            self.client.health.record_failure(e)
+            error = e
+        except Exception as e:
+            debug_print(f"single-flight 聊天补全出错: {e}")
+            error = e
+        finally:
+            try:
+                if translator is not None:
+                    if flight.cancelled and not translator.complete:
+                        self.client.cancel_chat(ctx, translator)
+                    else:
+                        await asyncio.to_thread(self.client.finish_chat, ctx, translator)
+            finally:
+                single_flight.done(flight)
+                flight.finish(error)
+
+
+class AsyncAccountPool:
+    """账号池的异步封装，调度策略与 main.AccountPool 一致"""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.clients = {client.name: AsyncQwenClient(client) for client in pool.clients}
+        self._flight_tasks = set()  # 保留驱动任务的引用，避免被垃圾回收
+
+    async def start(self):
+        for client in self.clients.values():
+            await client.start()
+
+    async def close(self):
+        for client in self.clients.values():
+            await client.close()
+
+    async def chat_completions(self, openai_request: dict, cache_control: str = None,
+                               trace: RequestTrace = None):
+        """选择账号并执行聊天补全，流式响应在发送完毕后才释放在途计数；缓存命中时直接重放"""
+        cached, cache_key, cache_result = await asyncio.to_thread(
+            self.pool.cached_response, openai_request, cache_control)
+        if cache_result:
+            g.response_cache = cache_result
+        if cached is not None:
+            return self._replay(cached) if openai_request.get("stream", False) else (cached, 200)
+        if single_flight.enabled:
+            return await self.shared_completions(openai_request, cache_key, trace)
+        client, matched_session = await asyncio.to_thread(self.pool.select, openai_request.get("messages", []))
+        client.health.begin()
+        if trace is not None:
+            trace.root.set("qwen.account", client.name)
+        try:
+            result = await self.clients[client.name].chat_completions(openai_request, cache_key, trace,
+                                                                      matched_session)
+        except BaseException:
+            client.health.end()
+            raise
+        if openai_request.get("stream", False):
+            return self._release_after_stream(client, result)
+        client.health.end()
+        return result
+
+    async def shared_completions(self, openai_request: dict, cache_key: str = None, trace: RequestTrace = None):
+        """合并同时进行的相同请求，与 main.AccountPool.shared_completions 相同"""
+        received_at = time.perf_counter()
+        flight, leader = single_flight.join(self.pool.flight_key(openai_request))
+        g.single_flight = "leader" if leader else "joined"
+        if leader:
+            client, matched_session = await asyncio.to_thread(self.pool.select,
+                                                              openai_request.get("messages", []))
+            client.health.begin()
+            if trace is not None:
+                trace.root.set("qwen.account", client.name)
+                trace.hold()
+            task = asyncio.create_task(self._run_flight(client, openai_request, flight, cache_key, trace,
+                                                        matched_session))
+            self._flight_tasks.add(task)
+            task.add_done_callback(self._flight_tasks.discard)
+        return await self.flight_response(flight, openai_request, received_at)
+
+    async def _run_flight(self, client: QwenClient, openai_request: dict, flight: InFlightRequest,
+                          cache_key: str = None, trace: RequestTrace = None, matched_session=LOOKUP_SESSION):
+        try:
+            await self.clients[client.name].run_flight(openai_request, flight, cache_key, trace,
+                                                       matched_session)
+        finally:
+            client.health.end()
+            if trace is not None:
+                trace.release()
+
+    @staticmethod
+    async def flight_response(flight: InFlightRequest, openai_request: dict, received_at: float):
+        """single-flight 订阅者：流式时返回异步生成器；非流式时返回 (响应体, 状态码)"""
+        try:
+            ctx = await wait_flight_ready(flight)
+        except BaseException:
+            # 准备会话失败时按直接请求的方式抛出，由路由返回错误响应
+            single_flight.leave(flight)
+            raise
+        if "prompt_compaction" in ctx:
+            g.prompt_compaction = ctx["prompt_compaction"]
+        qwen_model_id = ctx["qwen_model_id"]
+        stream = openai_request.get("stream", False)
+        translator = ChatStreamTranslator(ctx["chat_id"], openai_request.get("model", "qwen3"), stream,
+                                          qwen_model_id, reasoning_mode=reasoning_stream_mode(openai_request),
+                                          started=received_at)
+
+        if stream:
+            async def generate():
+                ACTIVE_STREAMS.inc(qwen_model_id)
+                try:
+                    async for line in aiter_flight_lines(flight, STREAM_KEEPALIVE_INTERVAL):
+                        for chunk in translator.relay_line(line):
+                            yield chunk
+                        if translator.done:
+                            break
+                    for chunk in translator.flush_pending():
+                        yield chunk
+                except UPSTREAM_ERRORS as e:
+                    yield translator.error_chunk(e)
+                finally:
+                    ACTIVE_STREAMS.dec(qwen_model_id)
+                    translator.close(stages=False)
+                    single_flight.leave(flight)
+
+            return generate()
+
+        try:
+            async for line in aiter_flight_lines(flight):
+                translator.feed_line(line)
+        except UPSTREAM_ERRORS as e:
+            if isinstance(e, UpstreamUnavailable):
+                return error_response(str(e), "upstream_unavailable"), 503
+            return error_response(f"内部服务器错误: {str(e)}"), 500
+        finally:
+            translator.close(stages=False)
+            single_flight.leave(flight)
+        return translator.completion_response(), 200
+
+    @staticmethod
+    async def finish_trace_after_stream(trace: RequestTrace, generator):
+        """流式响应发送完毕或客户端断开后结束追踪"""
+        try:
+            async for chunk in generator:
+                yield chunk
+        finally:
+            await generator.aclose()
+            trace.finish(200)
+
+    @staticmethod
+    async def _replay(chunks: list):
+        for chunk in chunks:
+            yield chunk
+
+    @staticmethod
+    async def _release_after_stream(client: QwenClient, generator):
+        try:
+            async for chunk in generator:
+                yield chunk
+        finally:
+            # 客户端断开时显式关闭内层生成器，使其立即关闭上游连接
+            await generator.aclose()
+            client.health.end()
+
+    async def delete_chat(self, chat_id: str) -> bool:
+        """删除对话，本地无记录时依次尝试各账号"""
+        owner = await asyncio.to_thread(self.pool.find_owner, chat_id)
+        if owner is not None:
+            return await self.clients[owner.name].delete_chat(chat_id)
+        for client in self.clients.values():
+            if await client.delete_chat(chat_id):
+                return True
+        return False
+
+
+# --- Quart (ASGI) 应用 ---
+app = Quart(__name__)
+async_pool = AsyncAccountPool(account_pool)
+
+@app.before_serving
+async def startup():
+    await async_pool.start()
+
+@app.after_serving
+async def shutdown():
+    await async_pool.close()
+
+@app.after_request
+async def add_cors_headers(response):
+    """允许所有来源 (生产环境请根据需要进行限制)"""
+    response.headers["Access-Control-Allow-Origin"] = "*"
+    response.headers["Access-Control-Allow-Headers"] = "*"
+    response.headers["Access-Control-Allow-Methods"] = "GET, POST, DELETE, OPTIONS"
+    return response
+
+@app.after_request
+async def add_response_headers(response):
+    """提示词被压缩时在响应头中返回本次请求的节省量；启用响应缓存与请求合并时返回对应结果；启用追踪时返回 trace id"""
+    compaction = g.get("prompt_compaction")
+    if compaction:
+        response.headers["X-Prompt-Compaction"] = compaction_header(compaction)
+    if g.get("response_cache"):
+        response.headers["X-Response-Cache"] = g.response_cache
+    if g.get("single_flight"):
+        response.headers["X-Single-Flight"] = g.single_flight
+    trace = g.get("trace")
+    if trace is not None:
+        trace_response(trace, response.headers, g)
+        # 流式响应由 finish_trace_after_stream 在发送完毕后结束
+        if response.mimetype != "text/event-stream":
+            trace.finish(response.status_code)
+    return response
+
+@app.route('/v1/models', methods=['GET'])
+async def list_models():
+    """列出可用模型 (模拟 OpenAI API)"""
+    try:
+        # 直接返回预先序列化的响应体，客户端带 If-None-Match 且目录未变化时返回 304
+        snapshot = qwen_client.catalog.snapshot
+        if snapshot.etag in request.if_none_match:
+            return Response(b"", status=304, headers={"ETag": f'"{snapshot.etag}"'})
+        return Response(snapshot.models_body, content_type='application/json',
+                        headers={"ETag": f'"{snapshot.etag}"'})
+    except Exception as e:
+        print(f"列出模型时出错: {e}")
+        return jsonify(error_response(f"获取模型列表失败: {e}")), 500
+
+@app.route('/v1/chat/completions', methods=['POST'])
+async def chat_completions():
+    """处理 OpenAI 兼容的聊天补全请求"""
+    openai_request = await request.get_json(silent=True)
+    if not openai_request:
+        return jsonify(error_response("请求体中 JSON 无效", "invalid_request_error")), 400
+
+    g.trace = trace = start_request_trace("POST /v1/chat/completions", request.headers.get("traceparent"))
+    if trace is not None:
+        trace.root.set("http.request.body.size", request.content_length)
+    try:
+        if openai_request.get("stream", False):
+            result = await async_pool.chat_completions(openai_request, request.headers.get("Cache-Control"), trace)
+            if trace is not None:
+                result = async_pool.finish_trace_after_stream(trace, result)
+            response = Response(result, content_type='text/event-stream')
+            response.timeout = None  # 不限制流式响应的总时长
+            return response
+        body, status_code = await async_pool.chat_completions(openai_request, request.headers.get("Cache-Control"),
+                                                              trace)
+        return jsonify(body), status_code
+    except UpstreamUnavailable as e:
+        return jsonify(error_response(str(e), "upstream_unavailable")), 503
+    except Exception as e:
+        debug_print(f"处理聊天补全请求时发生未预期错误: {e}")
+        return jsonify(error_response(f"内部服务器错误: {str(e)}")), 500
+
+@app.route('/v1/chats/<chat_id>', methods=['DELETE'])
+async def delete_chat(chat_id):
+    """删除指定的对话"""
+    try:
+        success = await async_pool.delete_chat(chat_id)
+        if success:
+            return jsonify({"message": f"会话 {chat_id} 已删除", "success": True})
+        else:
+            return jsonify({"message": f"删除会话 {chat_id} 失败", "success": False}), 400
+    except Exception as e:
+        debug_print(f"删除会话时发生错误: {e}")
+        return jsonify(error_response(f"删除会话失败: {str(e)}")), 500
+
+@app.route('/', methods=['GET'])
+async def index():
+    """根路径，返回 API 信息"""
+    return jsonify({
+        "message": "千问 (Qwen) OpenAI API 代理正在运行（异步模式）。",
+        "docs": "https://platform.openai.com/docs/api-reference/chat"
+    })
+
+@app.route('/v1/history/sync', methods=['GET'])
+async def history_sync_status():
+    """查询云端历史记录同步进度"""
+    return jsonify(account_pool.get_sync_status())
+
+@app.route('/v1/history/sync', methods=['POST'])
+async def history_sync_start():
+    """手动触发一次云端历史记录同步"""
+    started = account_pool.start_history_sync()
+    status_code = 202 if started else 409
+    return jsonify({"started": started, **account_pool.get_sync_status()}), status_code
+
+@app.route('/v1/cache/stats', methods=['GET'])
+async def cache_stats():
+    """查看响应缓存的容量与命中率"""
+    return jsonify(response_cache.stats())
+
+@app.route('/v1/single-flight/stats', methods=['GET'])
+async def single_flight_stats():
+    """查看相同请求合并的统计"""
+    return jsonify(single_flight.stats())
+
+@app.route('/v1/batches', methods=['POST'])
+async def create_batch():
+    """上传 JSONL 批处理任务（请求体即文件内容），由 main.BatchRunner 在后台线程中执行"""
+    if not batch_runner.enabled:
+        return jsonify(error_response("批处理接口未启用", "invalid_request_error")), 404
+    data = await request.get_data()
+    try:
+        batch = await asyncio.to_thread(batch_runner.create, [data])
+    except ValueError as e:
+        return jsonify(error_response(str(e), "invalid_request_error")), 400
+    return jsonify(batch)
+
+@app.route('/v1/batches', methods=['GET'])
+async def list_batches():
+    """列出全部批处理任务及其进度"""
+    batches = await asyncio.to_thread(batch_runner.list) if batch_runner.enabled else []
+    return jsonify({"object": "list", "data": batches})
+
+@app.route('/v1/batches/<batch_id>', methods=['GET'])
+async def get_batch(batch_id):
+    """查询批处理任务的状态与进度"""
+    batch = await asyncio.to_thread(batch_runner.get, batch_id) if batch_runner.enabled else None
+    if batch is None:
+        return jsonify(error_response(f"批处理任务不存在: {batch_id}", "invalid_request_error")), 404
+    return jsonify(batch)
+
+@app.route('/v1/batches/<batch_id>/cancel', methods=['POST'])
+async def cancel_batch(batch_id):
+    """取消批处理任务，已写入的结果保留"""
+    batch = await asyncio.to_thread(batch_runner.cancel, batch_id) if batch_runner.enabled else None
+    if batch is None:
+        return jsonify(error_response(f"批处理任务不存在: {batch_id}", "invalid_request_error")), 404
+    return jsonify(batch)
+
+@app.route('/v1/batches/<batch_id>/output', methods=['GET'])
+async def batch_output(batch_id):
+    """下载批处理结果 (JSONL)，任务进行中时返回目前已完成的部分"""
+    path = batch_runner.output_path(batch_id) if batch_runner.enabled else None
+    if path is None:
+        return jsonify(error_response(f"批处理任务没有结果: {batch_id}", "invalid_request_error")), 404
+    return await send_file(os.path.abspath(path), mimetype="application/jsonl")
+
+@app.route('/v1/history/stats', methods=['GET'])
+async def history_stats():
+    """查看本地历史库的大小、行数与保留策略执行情况"""
+    return jsonify({"accounts": await asyncio.to_thread(account_pool.history_stats)})
+
+@app.route('/v1/accounts', methods=['GET'])
+async def list_accounts():
+    """查看各账号的调度与健康状态"""
+    return jsonify({"accounts": account_pool.snapshot()})
+
+@app.route('/metrics', methods=['GET'])
+async def metrics_endpoint():
+    """Prometheus 格式的监控指标"""
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# 健康检查端点
+@app.route('/health', methods=['GET'])
+async def health_check():
+    """健康检查端点；上游熔断时 status 为 degraded，服务本身仍可用故返回 200"""
+    return jsonify(account_pool.upstream_health()), 200
+
+if __name__ == '__main__':
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    config = Config()
+    config.bind = [f"0.0.0.0:{PORT}"]
+    print(f"正在以异步模式启动服务器于端口 {PORT}...")
+    print(f"Debug模式: {'开启' if DEBUG_STATUS else '关闭'}")
+    asyncio.run(serve(app, config))
@@ -0,0 +1,91 @@
+"""
+聊天历史库并发基准测试：对比“每次调用新建连接 + 回滚日志”的旧实现、
+连接池 + WAL 的同步写入，以及后台攒批写入 (write-behind)，统计每秒可完成的补全次数。
+
+每次“补全”模拟一次真实请求对数据库的访问：按上一轮回复查找会话，再写回本轮回复。
+后台写入时请求线程只把更新放入队列，紧接着的查找由未落盘记录的覆盖层命中。
+
+用法: python benchmarks/bench_history_db.py --threads 16 --ops 200
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_qwen  # noqa: E402
+
+
+def make_legacy_manager(main):
+    """构造旧实现：每次调用新建连接，使用默认的回滚日志与 synchronous=FULL"""
+
+    class LegacyChatHistoryManager(main.ChatHistoryManager):
+        def _create_connection(self):
+            conn = sqlite3.connect(self.db_path)
+            conn.execute("PRAGMA journal_mode=DELETE")
+            return conn
+
+        @contextmanager
+        def _connection(self):
+            conn = self._create_connection()
+            try:
+                yield conn
+                conn.commit()
+            finally:
+                conn.close()
+
+    return LegacyChatHistoryManager
+
+
+def run(manager, threads, ops, queued=False):
+    """多线程执行模拟补全，返回每秒完成数；queued 为 True 时通过后台队列写入"""
+    write = manager.queue_session_update if queued else manager.update_session
+    for i in range(threads):
+        manager.update_session(f"chat-{i}", "bench", 0, 0, "t2t", "resp-0", f"reply {i} 0")
+
+    def worker(idx):
+        for n in range(ops):
+            manager.get_session_by_last_content(f"reply {idx} {n}")
+            write(chat_id=f"chat-{idx}", title="bench", created_at=0, updated_at=n + 1, chat_type="t2t",
+                  current_response_id=f"resp-{n + 1}", last_assistant_content=f"reply {idx} {n + 1}")
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    manager.flush()
+    elapsed = time.perf_counter() - start
+    return threads * ops / elapsed
+
+
+def main_entry():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--ops", type=int, default=200, help="每个线程执行的补全次数")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="qwen-bench-")
+    main = fake_qwen.import_main(workdir)
+    legacy_cls = make_legacy_manager(main)
+
+    before = run(legacy_cls(os.path.join(workdir, "legacy.db")), args.threads, args.ops)
+    after = run(main.ChatHistoryManager(os.path.join(workdir, "pooled.db")), args.threads, args.ops)
+    queued = run(main.ChatHistoryManager(os.path.join(workdir, "queued.db")), args.threads, args.ops,
+                 queued=True)
+
+    print(f"线程数: {args.threads}, 每线程补全数: {args.ops}")
+    print(f"旧实现 (每次新建连接): {before:10.1f} 次/秒")
+    print(f"连接池 + WAL 同步写入: {after:10.1f} 次/秒  ({after / before:.2f}x)")
+    print(f"后台攒批写入:         {queued:10.1f} 次/秒  ({queued / before:.2f}x)")
+
+
+if __name__ == '__main__':
+    main_entry()
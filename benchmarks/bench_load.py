@@ -0,0 +1,329 @@
+"""
+端到端压测：启动本地模拟上游与代理服务，用多个并发虚拟用户驱动 /v1/chat/completions，
+混合新对话/续接对话、流式/非流式请求，统计 RPS、首 token 延迟 (TTFT)、token 间隔与代理进程的内存占用 (RSS)。
+
+模拟上游、代理与压测客户端分别运行在独立进程中，互不争抢 GIL；RSS 统计包含代理的全部子进程。
+
+用法:
+  python benchmarks/bench_load.py --server flask --concurrency 16 --duration 20
+  python benchmarks/bench_load.py --server async --token-rate 50 --first-token-latency 0.3
+  python benchmarks/bench_load.py --server gunicorn --workers 4 --json result.json
+  python benchmarks/bench_load.py --target http://127.0.0.1:5000 --pid 1234  # 压测已在运行的服务
+"""
+
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import fake_qwen  # noqa: E402
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_ready(url: str, timeout: float = 60.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(url, timeout=1).status_code == 200:
+                return
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f"等待 {url} 就绪超时")
+
+
+def read_rss(pid: int) -> int:
+    """返回进程及其全部子进程的 RSS（字节），仅支持 Linux"""
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+                        break
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as f:
+                    pending.extend(int(child) for child in f.read().split())
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+    return total
+
+
+def percentile(samples, q):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+def serve(kind: str, port: int):
+    """--serve 内部模式：在当前进程中运行代理服务"""
+    sys.path.insert(0, REPO_DIR)
+    if kind == "flask":
+        import logging
+        from werkzeug.serving import make_server
+        import main
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        make_server("127.0.0.1", port, main.app, threaded=True).serve_forever()
+    else:
+        import asyncio
+        from hypercorn.asyncio import serve as hypercorn_serve
+        from hypercorn.config import Config
+        import async_server
+        config = Config()
+        config.bind = [f"127.0.0.1:{port}"]
+        config.accesslog = None
+        asyncio.run(hypercorn_serve(async_server.app, config))
+
+
+def start_processes(args, workdir):
+    """启动模拟上游与代理，返回 (进程列表, 代理地址, 代理 PID)"""
+    upstream_port = free_port()
+    upstream_cmd = [sys.executable, os.path.join(BENCH_DIR, "fake_qwen.py"), "--port", str(upstream_port),
+                    "--think-tokens", str(args.think_tokens), "--answer-tokens", str(args.answer_tokens),
+                    "--first-token-latency", str(args.first_token_latency), "--token-rate", str(args.token_rate),
+                    "--latency", str(args.latency), "--error-rate", str(args.error_rate)]
+    upstream = subprocess.Popen(upstream_cmd, stdout=subprocess.DEVNULL)
+    upstream_url = f"http://127.0.0.1:{upstream_port}"
+    wait_ready(f"{upstream_url}/api/v1/auths/")
+
+    proxy_port = free_port()
+    env = dict(os.environ, QWEN_BASE_URL=upstream_url, QWEN_AUTH_TOKEN=os.environ.get("QWEN_AUTH_TOKEN") or "fake-token",
+               PORT=str(proxy_port), WORKERS=str(args.workers))
+    if args.server == "gunicorn":
+        proxy_cmd = [sys.executable, "-m", "gunicorn", "-c", os.path.join(REPO_DIR, "gunicorn.conf.py"),
+                     "--pythonpath", REPO_DIR, "--bind", f"127.0.0.1:{proxy_port}", "main:app"]
+    else:
+        proxy_cmd = [sys.executable, os.path.abspath(__file__), "--serve", args.server, "--port", str(proxy_port)]
+    proxy = subprocess.Popen(proxy_cmd, cwd=workdir, env=env,
+                             stdout=subprocess.DEVNULL, stderr=None if args.verbose else subprocess.DEVNULL)
+    proxy_url = f"http://127.0.0.1:{proxy_port}"
+    wait_ready(f"{proxy_url}/health")
+    return [proxy, upstream], proxy_url, proxy.pid
+
+
+class LoadRunner:
+    """并发虚拟用户：每个用户维护自己的对话，按比例选择新对话/续接与流式/非流式"""
+
+    def __init__(self, url: str, args):
+        self.url = f"{url}/v1/chat/completions"
+        self.args = args
+        self.lock = threading.Lock()
+        self.results = []  # 每个请求一条记录
+
+    def run(self, deadline: float):
+        threads = [threading.Thread(target=self._user, args=(i, deadline), daemon=True)
+                   for i in range(self.args.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _user(self, index: int, deadline: float):
+        rng = random.Random(index)
+        session = requests.Session()
+        messages = []
+        turn = 0
+        while time.time() < deadline:
+            continuation = bool(messages) and rng.random() < self.args.continuation_ratio \
+                and turn < self.args.max_turns
+            if not continuation:
+                messages, turn = [], 0
+            turn += 1
+            messages.append({"role": "user", "content": f"用户{index} 第{turn}轮 {rng.random():.6f}"})
+            stream = rng.random() < self.args.stream_ratio
+            result = self._request(session, messages, stream)
+            result["kind"] = "continuation" if continuation else "new"
+            with self.lock:
+                self.results.append(result)
+            if result["ok"]:
+                messages.append({"role": "assistant", "content": result.pop("content")})
+            else:
+                messages = []
+
+    def _request(self, session, messages, stream: bool) -> dict:
+        body = {"model": self.args.model, "messages": messages, "stream": stream,
+                "enable_thinking": self.args.think_tokens > 0}
+        started = time.perf_counter()
+        result = {"stream": stream, "ok": False, "ttft": None, "gaps": [], "tokens": 0}
+        try:
+            with session.post(self.url, json=body, stream=stream, timeout=300) as r:
+                if r.status_code != 200:
+                    result["latency"] = time.perf_counter() - started
+                    return result
+                if stream:
+                    content = []
+                    last = None
+                    for line in r.iter_lines():
+                        if not line.startswith(b"data: {"):
+                            continue
+                        delta = json.loads(line[6:])["choices"][0]["delta"]
+                        if not (delta.get("content") or delta.get("reasoning_content")):
+                            continue
+                        now = time.perf_counter()
+                        if last is None:
+                            result["ttft"] = now - started
+                        else:
+                            result["gaps"].append(now - last)
+                        last = now
+                        result["tokens"] += 1
+                        content.append(delta.get("content") or "")
+                    result["content"] = "".join(content)
+                else:
+                    data = r.json()
+                    result["content"] = data["choices"][0]["message"]["content"]
+                    result["tokens"] = data.get("usage", {}).get("completion_tokens", 0)
+                result["ok"] = bool(result["content"])
+        except requests.exceptions.RequestException:
+            pass
+        result["latency"] = time.perf_counter() - started
+        return result
+
+
+def continuation_hits(url: str) -> dict:
+    """从代理的 /metrics 读取续接命中计数，确认续接请求确实复用了已有对话"""
+    counts = {"hit": 0, "miss": 0}
+    try:
+        text = requests.get(f"{url}/metrics", timeout=5).text
+    except requests.exceptions.RequestException:
+        return counts
+    for line in text.splitlines():
+        if line.startswith("qwen_proxy_continuation_total{"):
+            for result in counts:
+                if f'result="{result}"' in line:
+                    counts[result] += float(line.rsplit(" ", 1)[1])
+    return counts
+
+
+def summarize(results, elapsed: float, rss_samples) -> dict:
+    ok = [r for r in results if r["ok"]]
+    streamed = [r for r in ok if r["stream"]]
+    gaps = [gap for r in streamed for gap in r["gaps"]]
+
+    def dist(samples):
+        return {q: round(percentile(samples, p) * 1000, 2) if samples else None
+                for q, p in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))}
+
+    return {
+        "requests": len(results),
+        "errors": len(results) - len(ok),
+        "rps": round(len(ok) / elapsed, 2),
+        "tokens_per_second": round(sum(r["tokens"] for r in ok) / elapsed, 1),
+        "mix": {
+            "new": sum(r["kind"] == "new" for r in results),
+            "continuation": sum(r["kind"] == "continuation" for r in results),
+            "stream": sum(r["stream"] for r in results),
+            "non_stream": sum(not r["stream"] for r in results),
+        },
+        "latency_ms": dist([r["latency"] for r in ok]),
+        "ttft_ms": dist([r["ttft"] for r in streamed if r["ttft"] is not None]),
+        "inter_token_ms": dist(gaps),
+        "rss_mb": {
+            "peak": round(max(rss_samples) / 1024 / 1024, 1) if rss_samples else None,
+            "final": round(rss_samples[-1] / 1024 / 1024, 1) if rss_samples else None,
+        },
+    }
+
+
+def print_report(report: dict, args):
+    print(f"服务: {args.target or args.server}   并发: {args.concurrency}   时长: {args.duration}s")
+    mix = report["mix"]
+    print(f"请求: {report['requests']} (新对话 {mix['new']} / 续接 {mix['continuation']}, "
+          f"流式 {mix['stream']} / 非流式 {mix['non_stream']})   错误: {report['errors']}")
+    lookups = report["continuation_lookups"]
+    print(f"RPS: {report['rps']}   token/s: {report['tokens_per_second']}   "
+          f"会话查找 (本进程): 命中 {lookups['hit']:.0f} / 未命中 {lookups['miss']:.0f}")
+    for name, key in (("总耗时", "latency_ms"), ("TTFT", "ttft_ms"), ("token 间隔", "inter_token_ms")):
+        values = report[key]
+        print(f"{name:<10} p50 {values['p50']} ms   p95 {values['p95']} ms   p99 {values['p99']} ms")
+    print(f"代理 RSS: 峰值 {report['rss_mb']['peak']} MiB   结束 {report['rss_mb']['final']} MiB")
+
+
+def main_entry():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--server", choices=("flask", "async", "gunicorn"), default="flask", help="被压测的服务模式")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn 模式的工作进程数")
+    parser.add_argument("--target", help="压测已在运行的服务地址，此时不启动模拟上游与代理")
+    parser.add_argument("--pid", type=int, help="配合 --target 统计该进程的 RSS")
+    parser.add_argument("--concurrency", type=int, default=8, help="并发虚拟用户数")
+    parser.add_argument("--duration", type=float, default=10.0, help="压测时长（秒）")
+    parser.add_argument("--continuation-ratio", type=float, default=0.5, help="续接已有对话的请求比例")
+    parser.add_argument("--stream-ratio", type=float, default=0.5, help="流式请求比例")
+    parser.add_argument("--max-turns", type=int, default=5, help="单个对话的最大轮数")
+    parser.add_argument("--model", default="qwen")
+    parser.add_argument("--json", help="将结果以 JSON 写入该文件，便于对比不同版本")
+    parser.add_argument("--verbose", action="store_true", help="输出代理进程的日志")
+    parser.add_argument("--serve", choices=("flask", "async"), help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    fake_qwen.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.port)
+        return
+
+    processes = []
+    try:
+        if args.target:
+            url, pid = args.target.rstrip("/"), args.pid
+        else:
+            processes, url, pid = start_processes(args, tempfile.mkdtemp(prefix="qwen-load-"))
+
+        rss_samples = []
+        stop = threading.Event()
+
+        def sample_rss():
+            while pid and not stop.is_set():
+                rss_samples.append(read_rss(pid))
+                stop.wait(0.5)
+
+        sampler = threading.Thread(target=sample_rss, daemon=True)
+        sampler.start()
+        runner = LoadRunner(url, args)
+        started = time.perf_counter()
+        runner.run(time.time() + args.duration)
+        elapsed = time.perf_counter() - started
+        stop.set()
+        sampler.join()
+        if pid:
+            rss_samples.append(read_rss(pid))
+
+        report = summarize(runner.results, elapsed, rss_samples)
+        report["continuation_lookups"] = continuation_hits(url)
+        print_report(report, args)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump({"args": {k: v for k, v in vars(args).items() if k not in ("serve", "port")},
+                           "report": report}, f, ensure_ascii=False, indent=2)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+if __name__ == '__main__':
+    main_entry()
@@ -0,0 +1,85 @@
+"""
+思考内容输出方式对比：对同一个带思考阶段的本地模拟上游，分别以 live / buffered / dropped 方式
+发送流式请求，统计客户端收到第一个内容块的时间 (TTFB)、收到第一个回答块的时间、总耗时与收到的保活注释数。
+
+用法: python benchmarks/bench_reasoning_stream.py --requests 10 --think-tokens 64 --token-rate 100
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_qwen  # noqa: E402
+
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+def run_stream(client, mode: str) -> dict:
+    """发送一个新对话的流式请求，逐块读取并记录各时间点"""
+    started = time.perf_counter()
+    response = client.post("/v1/chat/completions", buffered=False, json={
+        "model": "qwen", "stream": True, "reasoning_stream": mode,
+        "messages": [{"role": "user", "content": f"问题 {time.time_ns()}"}],
+    })
+    result = {"ttfb": None, "first_answer": None, "total": None, "keepalives": 0, "reasoning_chars": 0}
+    for data in response.response:
+        text = data.decode("utf-8") if isinstance(data, bytes) else data
+        now = time.perf_counter() - started
+        if text.startswith(":"):
+            result["keepalives"] += 1
+            continue
+        if result["ttfb"] is None:
+            result["ttfb"] = now
+        if '"content"' in text and result["first_answer"] is None:
+            result["first_answer"] = now
+        if '"reasoning_content"' in text:
+            result["reasoning_chars"] += len(text)
+    response.close()
+    result["total"] = time.perf_counter() - started
+    return result
+
+
+def main_entry():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=10, help="每种方式的请求数")
+    parser.add_argument("--think-tokens", type=int, default=64, help="每次回复的思考 token 数")
+    parser.add_argument("--answer-tokens", type=int, default=16, help="每次回复的回答 token 数")
+    parser.add_argument("--token-rate", type=float, default=100.0, help="上游每秒输出 token 数")
+    parser.add_argument("--first-token-latency", type=float, default=1.5, help="上游首 token 延迟（秒）")
+    parser.add_argument("--keepalive", type=float, default=0.5, help="保活注释间隔（秒）")
+    args = parser.parse_args()
+
+    main = fake_qwen.import_main(tempfile.mkdtemp(prefix="qwen-bench-"))
+    main.STREAM_KEEPALIVE_INTERVAL = args.keepalive
+    main.UPSTREAM_WAIT_KEEPALIVE = True  # 首 token 前同样发送保活注释
+    fake_qwen.STREAM.update(think_tokens=args.think_tokens, answer_tokens=args.answer_tokens,
+                            token_rate=args.token_rate, first_token_latency=args.first_token_latency)
+    client = main.app.test_client()
+
+    print(f"思考 {args.think_tokens} token，回答 {args.answer_tokens} token，上游 {args.token_rate:.0f} token/秒，"
+          f"首 token 延迟 {args.first_token_latency}s，保活间隔 {args.keepalive}s")
+    for mode in main.REASONING_STREAM_MODES:
+        results = [run_stream(client, mode) for _ in range(args.requests)]
+        ttfb = [r["ttfb"] for r in results]
+        answer = [r["first_answer"] for r in results]
+        total = [r["total"] for r in results]
+        keepalives = sum(r["keepalives"] for r in results) / len(results)
+        print(f"{mode:9s} TTFB P50 {percentile(ttfb, 0.5) * 1000:7.1f} ms  P95 {percentile(ttfb, 0.95) * 1000:7.1f} ms   "
+              f"首个回答块 P50 {percentile(answer, 0.5) * 1000:7.1f} ms   总耗时 P50 {percentile(total, 0.5) * 1000:7.1f} ms   "
+              f"保活注释 {keepalives:.1f}/请求")
+    print()
+    print("/metrics 中的首字节时间:")
+    for line in main.metrics.render().splitlines():
+        if line.startswith("qwen_proxy_stream_ttfb_seconds_sum") or line.startswith("qwen_proxy_stream_ttfb_seconds_count"):
+            print("  " + line)
+
+
+if __name__ == '__main__':
+    main_entry()
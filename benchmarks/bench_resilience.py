@@ -0,0 +1,109 @@
+"""
+上游容错验证：对注入了延迟与错误的本地模拟上游调用 create_chat，
+分别观察抖动重试后的成功率、对冲请求对尾延迟的改善，以及熔断器的打开、快速失败与恢复。
+
+用法: python benchmarks/bench_resilience.py --requests 200
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_qwen  # noqa: E402
+
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+def run_create_chat(main, client, requests_count):
+    """连续创建对话，返回 (成功数, 耗时样本)"""
+    ok, latencies = 0, []
+    for _ in range(requests_count):
+        started = time.perf_counter()
+        try:
+            client.create_chat("qwen3-235b-a22b")
+            ok += 1
+        except main.requests.exceptions.RequestException:
+            pass
+        latencies.append(time.perf_counter() - started)
+    return ok, latencies
+
+
+def reset_faults(**faults):
+    fake_qwen.FAULTS.update(latency=0.0, slow_rate=0.0, slow_latency=0.0, error_rate=0.0,
+                            error_status=503, paths=["/api/v2/chats/new"])
+    fake_qwen.FAULTS.update(faults)
+
+
+def bench_retries(main, client, count):
+    print("== 抖动重试 (30% 请求返回 503) ==")
+    main.UPSTREAM_RETRY_BACKOFF = 0.005
+    client.breaker.failure_threshold = 10 ** 6  # 本场景不触发熔断
+    for retries in (0, main.UPSTREAM_MAX_RETRIES):
+        main.UPSTREAM_MAX_RETRIES = retries
+        reset_faults(error_rate=0.3)
+        ok, latencies = run_create_chat(main, client, count)
+        print(f"最大重试 {retries}: 成功率 {ok / count:6.1%}   P50 {percentile(latencies, 0.5) * 1000:6.1f} ms")
+    client.breaker.failure_threshold = main.CIRCUIT_FAILURE_THRESHOLD
+    client.breaker.record_success()
+
+
+def bench_hedging(main, client, count):
+    print("== 对冲请求 (3% 请求额外慢 300ms) ==")
+    for hedge in (False, True):
+        main.CREATE_CHAT_HEDGE = hedge
+        client._create_chat_latencies.clear()
+        reset_faults(latency=0.01)
+        run_create_chat(main, client, main.CREATE_CHAT_HEDGE_MIN_SAMPLES)  # 预热耗时样本
+        reset_faults(latency=0.01, slow_rate=0.03, slow_latency=0.3)
+        ok, latencies = run_create_chat(main, client, count)
+        print(f"对冲 {'开启' if hedge else '关闭'}: P50 {percentile(latencies, 0.5) * 1000:6.1f} ms   "
+              f"P99 {percentile(latencies, 0.99) * 1000:6.1f} ms   成功 {ok}/{count}")
+    main.CREATE_CHAT_HEDGE = False
+
+
+def bench_circuit_breaker(main, client):
+    print("== 熔断器 (上游全部返回 503) ==")
+    main.UPSTREAM_MAX_RETRIES = 0
+    client.breaker.reset_timeout = 0.5
+    reset_faults(error_rate=1.0)
+    upstream_calls, rejected, latencies = 0, 0, []
+    for _ in range(20):
+        started = time.perf_counter()
+        try:
+            client.create_chat("qwen3-235b-a22b")
+        except main.UpstreamUnavailable:
+            rejected += 1
+        except main.requests.exceptions.RequestException:
+            upstream_calls += 1
+        latencies.append(time.perf_counter() - started)
+    health = main.account_pool.upstream_health()
+    print(f"发往上游 {upstream_calls} 次后熔断，快速拒绝 {rejected} 次 "
+          f"(拒绝耗时 P50 {percentile(latencies[-rejected:], 0.5) * 1e6:.0f} us)，/health: {health['status']}")
+    reset_faults()
+    time.sleep(client.breaker.reset_timeout)
+    client.create_chat("qwen3-235b-a22b")
+    print(f"上游恢复、探测请求成功后 /health: {main.account_pool.upstream_health()['status']}")
+
+
+def main_entry():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200, help="每个场景的请求数")
+    args = parser.parse_args()
+
+    main = fake_qwen.import_main(tempfile.mkdtemp(prefix="qwen-bench-"))
+    client = main.qwen_client
+    client.chat_pool.close()  # 避免后台补充对话池干扰故障注入
+    bench_retries(main, client, args.requests)
+    bench_hedging(main, client, args.requests)
+    bench_circuit_breaker(main, client)
+
+
+if __name__ == '__main__':
+    main_entry()
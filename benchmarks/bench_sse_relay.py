@@ -0,0 +1,125 @@
+"""
+SSE 转发微基准：回放一段上游 SSE 记录，对比逐 token 解码 + json.loads + json.dumps 的旧实现
+与 ChatStreamTranslator 快速路径，统计每秒可转发的上游块数。
+
+可通过 --transcript 回放真实录制的上游响应（原始 SSE 文本，每行一个 "data: ..."），
+未指定时生成一段合成记录。
+
+用法: python benchmarks/bench_sse_relay.py --tokens 20000
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_qwen  # noqa: E402
+
+
+def make_transcript(tokens: int) -> bytes:
+    """生成一段包含 think/answer 两个阶段的合成上游 SSE 记录"""
+    events = [{"response.created": {"response_id": "resp-bench"}}]
+    think = tokens // 4
+    for i in range(tokens):
+        phase = "think" if i < think else "answer"
+        events.append({"choices": [{"delta": {
+            "role": "assistant", "phase": phase, "status": "typing",
+            "content": f"词{i % 97} ", "extra": None}}]})
+    events.append({"choices": [{"delta": {"phase": "answer", "status": "finished",
+                                          "content": "", "finish_reason": "stop"}}],
+                   "usage": {"input_tokens": 10, "output_tokens": tokens, "total_tokens": tokens + 10}})
+    lines = [f"data: {json.dumps(e, ensure_ascii=False)}" for e in events] + ["data: [DONE]"]
+    return ("\n\n".join(lines) + "\n\n").encode("utf-8")
+
+
+def legacy_relay(lines, chat_id, model):
+    """旧实现：逐行解码、解析并重新构造字典后 json.dumps"""
+    reasoning_text = ""
+    out = 0
+    for raw in lines:
+        line = raw.decode("utf-8")
+        if not line.startswith("data: "):
+            continue
+        data_str = line[6:]
+        if data_str.strip() == "[DONE]":
+            break
+        try:
+            data = json.loads(data_str)
+        except json.JSONDecodeError:
+            continue
+        if "choices" in data and len(data["choices"]) > 0:
+            delta = data["choices"][0].get("delta", {})
+            phase = delta.get("phase")
+            content = delta.get("content", "")
+            if phase == "think":
+                if delta.get("status") != "finished":
+                    reasoning_text += content
+            elif phase == "answer" or (phase is None and content):
+                openai_chunk = {
+                    "id": f"chatcmpl-{chat_id[:10]}",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}],
+                }
+                if reasoning_text:
+                    openai_chunk["choices"][0]["delta"]["reasoning_content"] = reasoning_text
+                    reasoning_text = ""
+                out += len(f"data: {json.dumps(openai_chunk)}\n\n")
+    return out
+
+
+def fast_relay(main, lines, chat_id, model):
+    """当前实现：ChatStreamTranslator（思考内容与旧实现一样随第一个回答块发送）"""
+    translator = main.ChatStreamTranslator(chat_id, model, stream=True, reasoning_mode="buffered")
+    out = 0
+    for line in lines:
+        for chunk in translator.feed_line(line):
+            out += len(chunk)
+        if translator.done:
+            break
+    return out
+
+
+def measure(fn, lines, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(lines)
+        best = min(best, time.perf_counter() - start)
+    return len(lines) / best
+
+
+def main_entry():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--tokens", type=int, default=20000, help="合成记录的 token 数")
+    parser.add_argument("--transcript", help="回放的上游 SSE 记录文件")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.transcript:
+        with open(args.transcript, "rb") as f:
+            raw = f.read()
+    else:
+        raw = make_transcript(args.tokens)
+    lines = [line for line in raw.split(b"\n") if line]
+
+    main = fake_qwen.import_main(tempfile.mkdtemp(prefix="qwen-bench-"))
+    chat_id, model = "bench-chat-id-0000", "qwen"
+
+    print(f"上游块数: {len(lines)}, JSON 解析: {main.json_loads.__module__}")
+    legacy = measure(lambda ls: legacy_relay(ls, chat_id, model), lines, args.repeat)
+    print(f"旧实现:               {legacy:12.0f} 块/秒")
+    fast = measure(lambda ls: fast_relay(main, ls, chat_id, model), lines, args.repeat)
+    print(f"快速路径:             {fast:12.0f} 块/秒  ({fast / legacy:.2f}x)")
+    main.RELAY_BATCH_INTERVAL = 0.02
+    batched = measure(lambda ls: fast_relay(main, ls, chat_id, model), lines, args.repeat)
+    print(f"快速路径 + 合并增量:  {batched:12.0f} 块/秒  ({batched / legacy:.2f}x)")
+
+
+if __name__ == '__main__':
+    main_entry()
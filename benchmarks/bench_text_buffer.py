@@ -0,0 +1,103 @@
+"""
+长回复聚合基准：对合成的超长回复（默认共 20 万 token，前 1/4 为思考阶段）执行非流式聚合，
+对比对象属性上反复 += 的旧写法与 TextBuffer，统计耗时与峰值内存；
+并演示 REASONING_MAX_CHARS 限制保留的思考内容后的内存占用。
+
+用法: python benchmarks/bench_text_buffer.py --tokens 100000
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_qwen  # noqa: E402
+from bench_sse_relay import make_transcript  # noqa: E402
+
+
+class LegacyAccumulator:
+    """旧写法：在对象属性上反复 +="""
+
+    def __init__(self):
+        self.reasoning_text = ""
+        self.assistant_content = ""
+
+    def feed(self, phase, content):
+        if phase == "think":
+            self.reasoning_text += content
+        else:
+            self.assistant_content += content
+
+    def result(self):
+        return self.assistant_content, self.reasoning_text
+
+
+def parse_deltas(raw: bytes, main):
+    """预先解析出 (phase, content)，使两种写法只比较累积本身"""
+    deltas = []
+    for line in raw.split(b"\n"):
+        if not line.startswith(b"data: {"):
+            continue
+        data = main.json_loads(line[6:])
+        if data.get("choices"):
+            delta = data["choices"][0]["delta"]
+            if delta.get("status") != "finished":
+                deltas.append((delta.get("phase"), delta.get("content", "")))
+    return deltas
+
+
+def measure(fn):
+    tracemalloc.start()
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main_entry():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--tokens", type=int, default=100000, help="合成回复的 token 数（实际生成两倍）")
+    parser.add_argument("--reasoning-cap", type=int, default=4096, help="演示用的思考内容保留上限（字符）")
+    args = parser.parse_args()
+
+    main = fake_qwen.import_main(tempfile.mkdtemp(prefix="qwen-bench-"))
+    raw = make_transcript(args.tokens * 2)
+    deltas = parse_deltas(raw, main)
+    lines = [line for line in raw.split(b"\n") if line]
+    print(f"增量数: {len(deltas)}")
+
+    def legacy():
+        acc = LegacyAccumulator()
+        for phase, content in deltas:
+            acc.feed(phase, content)
+        return acc.result()
+
+    def buffered():
+        reasoning, answer = main.TextBuffer(), main.TextBuffer()
+        for phase, content in deltas:
+            (reasoning if phase == "think" else answer).append(content)
+        return answer.getvalue(), reasoning.getvalue()
+
+    def translator(cap):
+        main.REASONING_MAX_CHARS = cap
+        t = main.ChatStreamTranslator("bench-chat-id", "qwen", stream=False)
+        for line in lines:
+            t.feed_line(line)
+        return t.completion_response()
+
+    for name, fn in [("属性 += (旧写法)", legacy),
+                     ("TextBuffer", buffered),
+                     ("完整翻译 (不限制思考)", lambda: translator(None)),
+                     (f"完整翻译 (思考上限 {args.reasoning_cap})", lambda: translator(args.reasoning_cap))]:
+        elapsed, peak = measure(fn)
+        print(f"{name:<28} 耗时 {elapsed * 1000:9.1f} ms   峰值内存 {peak / 1024 / 1024:8.2f} MiB")
+
+
+if __name__ == '__main__':
+    main_entry()
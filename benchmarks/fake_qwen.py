@@ -0,0 +1,247 @@
+"""
+本地模拟的 chat.qwen.ai 上游，实现 QwenClient 调用的全部接口：
+登录信息、模型列表、用户设置、对话列表/详情、创建/删除对话、按 think/answer 阶段输出的流式补全，
+以及停止生成。
+便于在不访问真实站点的情况下导入 main.py 进行基准测试与压测。
+
+可通过 STREAM 调整每次回复的 token 数、首 token 延迟与输出速率，通过 FAULTS 注入延迟与错误。
+
+独立运行: python benchmarks/fake_qwen.py --port 5001 --token-rate 50 --first-token-latency 0.3
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+
+from flask import Flask, Response, jsonify, request
+from werkzeug.serving import make_server
+
+FAKE_MODELS = ["qwen3-235b-a22b", "qwen3-coder-plus", "qwen3-32b", "qwen-max-latest",
+               "qwen-plus-2025-01-25", "qwen-turbo-2025-02-11", "qwq-32b"]
+STARTED_AT = int(time.time())
+CHATS_PAGE_SIZE = 20
+
+# 流式补全配置，运行中可直接修改
+STREAM = {
+    "think_tokens": 32,          # 开启思考时输出的思考 token 数
+    "answer_tokens": 64,         # 回答 token 数
+    "first_token_latency": 0.0,  # 收到请求到输出第一个 token 的延迟（秒）
+    "token_rate": 0.0,           # 每秒输出的 token 数，0 表示不限速
+}
+
+# 累计生成的 token 数与被停止接口中止的回复数，用于观察取消后上游是否停止生成
+STREAM_STATS = {"tokens": 0, "stopped": 0}
+
+# 故障注入配置，运行中可直接修改；paths 为 None 时作用于除登录外的全部接口
+FAULTS = {
+    "latency": 0.0,        # 每个请求的固定延迟（秒）
+    "slow_rate": 0.0,      # 额外慢请求的比例
+    "slow_latency": 0.0,   # 慢请求额外增加的延迟（秒）
+    "error_rate": 0.0,     # 直接返回错误的比例
+    "error_status": 503,   # 注入错误时返回的状态码
+    "paths": None,         # 只对这些路径前缀注入故障，如 ["/api/v2/chats/new"]
+}
+
+
+def sse(event: dict) -> str:
+    return f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+
+def delta_event(phase: str, status: str, content: str) -> str:
+    return sse({"choices": [{"delta": {"role": "assistant", "phase": phase, "status": status,
+                                       "content": content, "extra": None}}]})
+
+
+def create_app():
+    """创建模拟上游的 Flask 应用"""
+    app = Flask(__name__)
+    chats = {}  # chat_id -> 对话记录
+    stopped = set()  # 已被要求停止生成的 response_id
+    lock = threading.Lock()
+
+    @app.before_request
+    def inject_faults():
+        paths = FAULTS["paths"]
+        if request.path == "/api/v1/auths/" or (paths and not request.path.startswith(tuple(paths))):
+            return None
+        delay = FAULTS["latency"]
+        if FAULTS["slow_rate"] and random.random() < FAULTS["slow_rate"]:
+            delay += FAULTS["slow_latency"]
+        if delay:
+            time.sleep(delay)
+        if FAULTS["error_rate"] and random.random() < FAULTS["error_rate"]:
+            return jsonify({"success": False, "error": "injected"}), FAULTS["error_status"]
+        return None
+
+    @app.route('/api/v1/auths/', methods=['GET'])
+    def auths():
+        return jsonify({"id": "fake-user", "name": "fake", "role": "user"})
+
+    @app.route('/api/models', methods=['GET'])
+    def models():
+        # 支持 ETag 条件请求，模型列表不变时返回 304
+        response = jsonify({"data": [{
+            "id": model_id,
+            "owned_by": "qwen",
+            "info": {"id": model_id, "created_at": STARTED_AT},
+        } for model_id in FAKE_MODELS]})
+        response.add_etag()
+        return response.make_conditional(request)
+
+    @app.route('/api/v2/users/user/settings', methods=['GET'])
+    def user_settings():
+        return jsonify({"success": True, "data": {"model_config": {}}})
+
+    @app.route('/api/v2/chats/', methods=['GET'])
+    def list_chats():
+        page = request.args.get("page", 1, type=int)
+        with lock:
+            ordered = sorted(chats.values(), key=lambda chat: chat["updated_at"], reverse=True)
+        start = (page - 1) * CHATS_PAGE_SIZE
+        return jsonify({"success": True, "data": [{
+            key: chat[key] for key in ("id", "title", "created_at", "updated_at", "chat_type")
+        } for chat in ordered[start:start + CHATS_PAGE_SIZE]]})
+
+    @app.route('/api/v2/chats/<chat_id>', methods=['GET'])
+    def chat_detail(chat_id):
+        with lock:
+            chat = chats.get(chat_id)
+            if chat is None:
+                return jsonify({"success": False, "data": None}), 404
+            return jsonify({"success": True, "data": {
+                "id": chat_id,
+                "title": chat["title"],
+                "currentId": chat["current_id"],
+                "chat": {"messages": list(chat["messages"])},
+            }})
+
+    @app.route('/api/v2/chats/new', methods=['POST'])
+    def new_chat():
+        body = request.get_json(silent=True) or {}
+        chat_id = str(uuid.uuid4())
+        now = int(time.time())
+        with lock:
+            chats[chat_id] = {"id": chat_id, "title": body.get("title", "新对话"), "created_at": now,
+                              "updated_at": now, "chat_type": body.get("chat_type", "t2t"),
+                              "current_id": None, "messages": []}
+        return jsonify({"success": True, "data": {"id": chat_id}})
+
+    @app.route('/api/v2/chats/<chat_id>', methods=['DELETE'])
+    def delete_chat(chat_id):
+        with lock:
+            chats.pop(chat_id, None)
+        return jsonify({"success": True, "data": True})
+
+    @app.route('/api/v2/chat/completions', methods=['POST'])
+    def chat_completions():
+        chat_id = request.args.get("chat_id")
+        body = request.get_json(silent=True) or {}
+        with lock:
+            known = chat_id in chats
+        if not known:
+            return jsonify({"success": False, "error": "chat not found"}), 404
+        message = (body.get("messages") or [{}])[0]
+        content = message.get("content", "")
+        thinking = message.get("feature_config", {}).get("thinking_enabled", False)
+        think_tokens = STREAM["think_tokens"] if thinking else 0
+        answer_tokens = max(1, STREAM["answer_tokens"])
+        first_token_latency = STREAM["first_token_latency"]
+        interval = 1.0 / STREAM["token_rate"] if STREAM["token_rate"] else 0.0
+        response_id = str(uuid.uuid4())
+        # 回答以回复 ID 开头，保证不同回复的内容互不相同
+        answer = [f"[{response_id[:8]}] "] + [f"词{i % 97} " for i in range(1, answer_tokens)]
+
+        def generate():
+            yield sse({"response.created": {"chat_id": chat_id, "parent_id": body.get("parent_id"),
+                                            "response_id": response_id}})
+            if first_token_latency:
+                time.sleep(first_token_latency)
+            tokens = [("think", f"思考{i} ") for i in range(think_tokens)] + [("answer", t) for t in answer]
+            for i, (phase, token) in enumerate(tokens):
+                if interval and i:
+                    time.sleep(interval)
+                if response_id in stopped:
+                    STREAM_STATS["stopped"] += 1
+                    return
+                STREAM_STATS["tokens"] += 1
+                if phase == "answer" and think_tokens and i == think_tokens:
+                    yield delta_event("think", "finished", "")
+                yield delta_event(phase, "typing", token)
+            yield sse({"choices": [{"delta": {"role": "assistant", "phase": "answer", "status": "finished",
+                                              "content": "", "finish_reason": "stop"}}],
+                       "usage": {"input_tokens": len(content), "output_tokens": len(tokens),
+                                 "total_tokens": len(content) + len(tokens)}})
+            with lock:
+                chat = chats.get(chat_id)
+                if chat is not None:
+                    chat["messages"].append({"id": message.get("fid"), "role": "user", "content": content})
+                    chat["messages"].append({"id": response_id, "role": "assistant",
+                                             "content_list": [{"content": "".join(answer), "phase": "answer"}]})
+                    chat["current_id"] = response_id
+                    chat["updated_at"] = int(time.time())
+
+        return Response(generate(), content_type="text/event-stream")
+
+    @app.route('/api/v2/chat/completions/stop', methods=['POST'])
+    def stop_completion():
+        body = request.get_json(silent=True) or {}
+        with lock:
+            stopped.add(body.get("response_id"))
+        return jsonify({"success": True, "data": {"status": "stopped"}})
+
+    return app
+
+
+def start_in_thread(host="127.0.0.1", port=0):
+    """在后台线程启动模拟上游，返回 (server, base_url)"""
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server(host, port, create_app(), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_port}"
+
+
+def import_main(workdir):
+    """启动模拟上游并在 workdir 中导入 main.py，避免访问真实站点或改动真实的 chat_history.db"""
+    _server, base_url = start_in_thread()
+    os.environ["QWEN_BASE_URL"] = base_url
+    os.environ.setdefault("QWEN_AUTH_TOKEN", "fake-token")
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import main
+    return main
+
+
+def add_arguments(parser):
+    """添加模拟上游的命令行参数，供压测脚本复用"""
+    parser.add_argument("--think-tokens", type=int, default=STREAM["think_tokens"], help="每次回复的思考 token 数")
+    parser.add_argument("--answer-tokens", type=int, default=STREAM["answer_tokens"], help="每次回复的回答 token 数")
+    parser.add_argument("--first-token-latency", type=float, default=STREAM["first_token_latency"],
+                        help="首 token 延迟（秒）")
+    parser.add_argument("--token-rate", type=float, default=STREAM["token_rate"], help="每秒输出 token 数，0 表示不限速")
+    parser.add_argument("--latency", type=float, default=0.0, help="每个请求的固定延迟（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="注入错误的比例")
+
+
+def configure(args):
+    """按命令行参数更新 STREAM 与 FAULTS"""
+    STREAM.update(think_tokens=args.think_tokens, answer_tokens=args.answer_tokens,
+                  first_token_latency=args.first_token_latency, token_rate=args.token_rate)
+    FAULTS.update(latency=args.latency, error_rate=args.error_rate)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="本地模拟的 chat.qwen.ai 上游")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5001)
+    add_arguments(parser)
+    args = parser.parse_args()
+    configure(args)
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    print(f"模拟上游运行于 http://{args.host}:{args.port}", flush=True)
+    make_server(args.host, args.port, create_app(), threaded=True).serve_forever()
@@ -0,0 +1,48 @@
+# 生产环境多进程启动配置: gunicorn main:app（自动读取当前目录下的本文件）
+#
+# 主进程预加载 main.py，只执行一次初始化（获取用户信息、模型列表、用户设置），
+# 随后 fork 出多个工作进程；历史同步、历史库压缩与批处理任务只在持有 leader 锁的一个工作进程中执行，
+# 该进程退出或被重启后由其他工作进程接替；对话池在每个工作进程中各自维护。
+# 续接会话状态保存在各进程共用的 SQLite (WAL) 中，进程内缓存通过共享失效计数保持一致。
+
+import multiprocessing
+import os
+
+os.environ["QWEN_PREFORK"] = "1"  # 须在 main.py 被导入前设置
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get("WORKERS", multiprocessing.cpu_count()))  # 工作进程数
+worker_class = "gthread"
+threads = int(os.environ.get("WORKER_THREADS", "32"))  # 每个工作进程的线程数，即可同时处理的流式请求数
+preload_app = True  # 初始化失败时主进程直接退出，不会启动任何工作进程
+timeout = 120
+graceful_timeout = 30  # 重启或停止时等待进行中的请求完成的时长（秒）
+keepalive = 5
+
+
+def post_fork(server, worker):
+    import main
+    main.account_pool.after_fork(leader=False)
+
+    def become_leader():
+        server.log.info(f"工作进程 {worker.pid} 成为 leader，运行历史同步、历史库压缩与批处理任务")
+        main.account_pool.start_leader_tasks()
+        main.batch_runner.start()
+
+    # 不能按 worker.age 判断：重启的工作进程 age 会继续递增，原来的第一个进程退出后就再没有 leader
+    main.leader_lock.campaign(become_leader)
+
+
+def worker_exit(server, worker):
+    import main
+    main.batch_runner.close()
+    main.account_pool.close()
+    main.leader_lock.close()
+    main.trace_exporter.close()
+
+
+def when_ready(server):
+    import main
+    startup = ", ".join(f"{c.name} {c.bootstrap['seconds'] * 1000:.0f} ms ({c.bootstrap['source']})"
+                        for c in main.account_pool.clients)
+    server.log.info(f"主进程初始化完成（{startup}），启动 {workers} 个工作进程")
@@ -9,8 +9,27 @@ import warnings
 import sqlite3
 import re
 import html
-from flask import Flask, request, jsonify, Response, stream_with_context
+import shutil
+from json.encoder import encode_basestring_ascii
+import hashlib
+import threading
+import queue
+import socket
+import bisect
+import random
+import atexit
+import multiprocessing
+from collections import OrderedDict, deque
+from contextlib import contextmanager, closing
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from flask import Flask, request, jsonify, Response, stream_with_context, g, has_request_context, send_file
 from flask_cors import CORS
+try:
+    # 可选依赖：安装 orjson 后用它解析上游 SSE，逐 token 的解析开销显著降低
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 # ==================== 配置区域 ====================
 # 请将您的有效 token 放在这里，或通过环境变量 QWEN_AUTH_TOKEN 设置
@@ -18,10 +37,87 @@ QWEN_AUTH_TOKEN = os.environ.get("QWEN_AUTH_TOKEN")
 if not QWEN_AUTH_TOKEN:
     # 如果环境变量未设置，请在此处直接填写你的 token
     QWEN_AUTH_TOKEN = ""
+# 多账号：通过环境变量 QWEN_AUTH_TOKENS 设置多个 token（逗号分隔），请求将在账号间负载均衡
+QWEN_AUTH_TOKENS = [t.strip() for t in os.environ.get("QWEN_AUTH_TOKENS", "").split(",") if t.strip()]
+if not QWEN_AUTH_TOKENS:
+    QWEN_AUTH_TOKENS = [QWEN_AUTH_TOKEN]
+ACCOUNT_MAX_FAILURES = 3  # 账号连续失败多少次后暂停调度
+ACCOUNT_FAILURE_COOLDOWN = 30  # 账号连续失败或认证失败后的暂停时长（秒）
+ACCOUNT_THROTTLE_COOLDOWN = 60  # 账号被上游限流 (HTTP 429) 后的暂停时长（秒）
 IS_DELETE = 0  # 是否在会话结束后自动删除会话
 PORT = 5000  # 服务端绑定的端口
 DEBUG_STATUS = False  # 是否输出debug信息
-DATABASE_PATH = "chat_history.db"  # 数据库文件路径
+DATA_DIR = os.environ.get("QWEN_DATA_DIR", ".")  # 数据目录：历史库、启动快照、leader 锁、响应缓存、批处理与追踪文件都放在这里，容器部署时指向挂载的卷
+DATABASE_PATH = os.path.join(DATA_DIR, "chat_history.db")  # 数据库文件路径，WAL 模式下同目录还有 -wal/-shm 文件，需一并持久化
+DATABASE_POOL_SIZE = 8  # 数据库连接池最多保留的空闲连接数
+DATABASE_BUSY_TIMEOUT = 5.0  # 数据库被锁定时的最长等待时间（秒）
+SESSION_WRITE_BEHIND = True  # 聊天结束后的会话记录是否交给后台线程批量写入，False 时在请求线程中同步写入
+SESSION_WRITE_FLUSH_INTERVAL = 0.005  # 后台写入最多攒批的时长（秒）
+SESSION_WRITE_BATCH_SIZE = 64  # 待写入记录达到该数量时立即写入
+HISTORY_SYNC_CONCURRENCY = 8  # 同步云端历史记录时并发拉取会话详情的数量
+HISTORY_MAX_ROWS = None  # 本地最多保留的会话数，超出时淘汰最久未更新的会话；None 表示不限制
+HISTORY_MAX_AGE = None  # 会话按 updated_at 计算的最长保留时间（秒），None 表示不限制
+HISTORY_MAX_BYTES = None  # 会话记录内容的总字节数上限，None 表示不限制
+HISTORY_DELETE_CLOUD = False  # 淘汰本地会话时是否同时删除对应的云端对话
+HISTORY_CLOUD_DELETE_BATCH = 20  # 每批并发删除的云端对话数量
+HISTORY_COMPACT_INTERVAL = 300  # 后台执行保留策略与增量 VACUUM 的间隔（秒）
+HISTORY_VACUUM_PAGES = 2000  # 每次增量 VACUUM 最多回收的页数
+SESSION_CACHE_SIZE = 1024  # 内存中缓存的续接会话数量上限
+SESSION_CACHE_TTL = 600  # 续接会话缓存的有效期（秒）
+CHAT_POOL_SIZE = 0  # 每个常用模型预先创建的空对话数量，0 表示关闭预创建；多进程模式下每个工作进程各自维护一份
+CHAT_POOL_MODELS = None  # 需要预创建对话的模型 ID 列表，None 表示 MODEL_MAP 中出现的全部模型
+CHAT_POOL_TITLE = "OpenAI_API_预创建对话"  # 预创建对话的标题，历史同步据此识别并删除上次运行遗留的空对话
+CHAT_POOL_TTL = 3600  # 预创建对话的最长闲置时间（秒），过期后删除并重新创建
+CHAT_POOL_CHECK_INTERVAL = 60  # 对话池后台检查过期与补充的间隔（秒）
+BOOTSTRAP_SNAPSHOT = True  # 是否把启动数据（用户信息、模型列表、用户设置）保存为本地快照，重启时直接从快照启动并在后台向上游重新验证
+BOOTSTRAP_SNAPSHOT_MAX_AGE = 7 * 24 * 3600  # 超过该时长（秒）的快照不再使用，启动时重新向上游获取
+LEADER_RETRY_INTERVAL = 5  # 多进程模式下非 leader 工作进程重新竞争 leader 锁的间隔（秒），leader 退出后由其他进程接替
+MODEL_CATALOG_REFRESH_INTERVAL = 600  # 后台刷新模型列表与用户设置的间隔（秒），0 表示只在启动时获取一次
+REASONING_MAX_CHARS = None  # 非流式响应单次回复最多保留的思考内容字符数，超出部分丢弃；None 表示不限制
+PROMPT_COMPACTION = False  # 新对话拼接完整历史时，超出 token 预算是否压缩较早的消息
+PROMPT_TOKEN_BUDGETS = {}  # 模型 ID -> 提示词 token 预算；未配置的模型按上游模型信息中的上下文长度推算
+PROMPT_TOKEN_BUDGET_DEFAULT = 30000  # 上游未提供上下文长度时使用的预算
+PROMPT_CONTEXT_RATIO = 0.75  # 由上下文长度推算预算时留给提示词的比例，其余留给思考与回答
+PROMPT_KEEP_RECENT = 4  # 最近若干条消息保持原样，不参与压缩
+PROMPT_TOOL_OUTPUT_MAX_CHARS = 2000  # 压缩时较早的工具输出最多保留的字符数（保留首尾）
+RESPONSE_CACHE = False  # 是否缓存完全相同的请求（模型、消息、思考参数）的回复，命中时不再访问上游
+RESPONSE_CACHE_MEMORY_BYTES = 64 * 1024 * 1024  # 内存缓存层的容量（字节），超出时淘汰最久未使用的回复
+RESPONSE_CACHE_DIR = os.path.join(DATA_DIR, "response_cache")  # 磁盘缓存层目录，多进程共用；None 表示只使用内存缓存
+RESPONSE_CACHE_DISK_BYTES = 1024 * 1024 * 1024  # 磁盘缓存层的容量（字节），超出时淘汰最久未使用的回复
+RESPONSE_CACHE_TTL = 7 * 24 * 3600  # 缓存回复的有效期（秒）
+BATCH_DIR = os.path.join(DATA_DIR, "batches")  # 离线批处理任务的输入、输出与进度目录，多进程共用；None 表示关闭批处理接口
+BATCH_CONCURRENCY = 4  # 批处理同时执行的请求数
+BATCH_MAX_REQUESTS = 50000  # 单个批处理任务最多包含的请求数
+BATCH_MAX_RETRIES = 3  # 批处理中的请求连接失败、被限流 (429) 或返回 5xx 后的最大重试次数
+BATCH_RETRY_BACKOFF = 5.0  # 批处理重试退避基数（秒），第 n 次重试随机等待 0 ~ 基数 × 2^(n-1)
+BATCH_POLL_INTERVAL = 2.0  # 后台检查新任务与取消请求的间隔（秒）
+TRACING = False  # 是否为聊天补全请求记录追踪（各处理阶段的 span），采样的追踪按 OTLP JSON 格式写入本地文件
+TRACE_SAMPLE_RATE = 0.1  # 头部采样比例 (0~1)，请求开始时决定是否记录；带 traceparent 请求头的请求沿用其中的采样标记
+TRACE_EXPORT_PATH = os.path.join(DATA_DIR, "traces.jsonl")  # 追踪导出文件，每行一个 OTLP ExportTraceServiceRequest，多进程共用
+TRACE_EXPORT_INTERVAL = 1.0  # 后台线程攒批写入追踪的间隔（秒）
+TRACE_EXPORT_QUEUE_SIZE = 10000  # 等待写入的追踪数上限，超出时丢弃新结束的追踪
+SINGLE_FLIGHT = False  # 是否合并同时进行的完全相同请求（模型、消息、思考参数）：只有第一个请求访问上游，其余请求共享其输出
+RELAY_BATCH_INTERVAL = 0  # 流式转发时合并小增量的时间窗口（秒），0 表示每个增量立即发送
+RELAY_BATCH_MAX_CHARS = 256  # 合并的增量达到该字符数时立即发送
+REASONING_STREAM_MODE = "live"  # 思考内容的默认输出方式，请求可用 reasoning_stream 参数覆盖：live 随上游实时发送，buffered 附在第一个回答块中发送，dropped 不发送
+STREAM_KEEPALIVE_INTERVAL = 1.0  # 流式响应超过多少秒没有可发送的内容（缓存的思考阶段等）时发送一条 SSE 注释，防止中间代理超时并尽早发现客户端断开；0 表示关闭
+UPSTREAM_WAIT_KEEPALIVE = False  # 同步服务模式下，首 token 前上游完全沉默期间是否也发送保活注释；开启后每个流式请求在收到首个增量前额外占用一个读取线程。异步服务模式不需要额外线程，始终发送
+UPSTREAM_STOP_PATH = None  # 客户端断开后通知上游停止生成的接口路径（确认上游实际接口后填写，如 "/api/v2/chat/completions/stop"），None 表示只断开上游连接
+UPSTREAM_CONNECT_TIMEOUT = 10.0  # 连接上游的超时（秒）
+UPSTREAM_READ_TIMEOUT = 120.0  # 等待上游响应头或两段数据之间的最长间隔（秒）
+UPSTREAM_MAX_RETRIES = 2  # 上游在返回响应前失败或返回 5xx 时的最大重试次数
+UPSTREAM_RETRY_BACKOFF = 0.5  # 重试退避基数（秒），第 n 次重试随机等待 0 ~ 基数 × 2^(n-1)
+UPSTREAM_RETRY_STATUSES = (500, 502, 503, 504)  # 可重试的上游状态码
+CREATE_CHAT_HEDGE = False  # 创建对话耗时超过近期 P95 时是否再并发发出一个请求，取先完成者
+CREATE_CHAT_HEDGE_MIN_SAMPLES = 20  # 启用对冲前至少需要的创建对话耗时样本数
+CIRCUIT_FAILURE_THRESHOLD = 5  # 上游连续故障（连接失败、超时、5xx）多少次后熔断
+CIRCUIT_RESET_TIMEOUT = 30  # 熔断后直接拒绝请求的时长（秒），之后放行一个探测请求
+ASYNC_UPSTREAM_MAX_CONNECTIONS = 1000  # 异步服务模式 (async_server.py) 下到上游的最大连接数
+QWEN_BASE_URL = os.environ.get("QWEN_BASE_URL", "https://chat.qwen.ai")  # 上游地址，可指向本地模拟服务
+# 多进程模式（由 gunicorn.conf.py 设置）：启动初始化只在主进程执行一次，后台任务在 fork 出的工作进程中启动
+PREFORK = os.environ.get("QWEN_PREFORK") == "1"
+# 服务启动时间，早于该时间创建且从未使用的预创建对话视为上次运行遗留
+SERVICE_STARTED_AT = int(time.time())
 # 模型映射，基于实际返回的模型列表
 MODEL_MAP = {
     "qwen": "qwen3-235b-a22b", # 默认旗舰模型
@@ -49,6 +145,17 @@ def debug_print(message):
     if DEBUG_STATUS:
         print(f"[DEBUG] {message}")
 
+def error_response(message: str, error_type: str = "server_error") -> dict:
+    """构造 OpenAI 格式的错误响应体"""
+    return {
+        "error": {
+            "message": message,
+            "type": error_type,
+            "param": None,
+            "code": None
+        }
+    }
+
 def remove_tool(text):
     # 使用正则表达式匹配 <tool_use>...</tool_use>，包括跨行内容
     pattern = r'<tool_use>.*?</tool_use>'
@@ -56,18 +163,746 @@ def remove_tool(text):
     cleaned_text = re.sub(pattern, '', text, flags=re.DOTALL)
     return cleaned_text
 
+def estimate_tokens(text: str) -> int:
+    """
+    粗略估算 token 数：ASCII 字符约 4 个一个 token，中文等非 ASCII 字符约一个一个 token。
+    只做一次 UTF-8 编码，不依赖分词器。
+    """
+    if not text:
+        return 0
+    # 非 ASCII 字符多为 3 字节的中日韩文字，按额外字节数估算其个数
+    non_ascii = (len(text.encode('utf-8')) - len(text)) // 2
+    return (len(text) - non_ascii + 3) // 4 + non_ascii
+
+def truncate_middle(text: str, max_chars: int) -> str:
+    """超长文本只保留首尾，中间替换为省略说明"""
+    if len(text) <= max_chars:
+        return text
+    head = max_chars * 2 // 3
+    tail = max_chars - head
+    return f"{text[:head]}\n...[已省略 {len(text) - max_chars} 字符]...\n{text[len(text) - tail:]}"
+
+def compaction_header(report: dict) -> str:
+    """X-Prompt-Compaction 响应头的取值"""
+    return "; ".join(f"{key}={report[key]}" for key in
+                     ("saved_bytes", "saved_tokens", "tokens", "budget", "deduplicated", "truncated", "dropped"))
+
+def format_transcript(messages: list) -> str:
+    """把完整消息历史拼接为新对话的单条用户消息"""
+    formatted_history = "\n\n".join([f"{msg['role']}: {msg['content']}" for msg in messages])
+    if messages and messages[0]['role'] != "system":
+        formatted_history = "system:\n\n" + formatted_history
+    return formatted_history
+
+REASONING_STREAM_MODES = ("live", "buffered", "dropped")
+
+def reasoning_stream_mode(openai_request: dict) -> str:
+    """请求的思考内容输出方式，未指定或取值无效时使用 REASONING_STREAM_MODE"""
+    mode = openai_request.get("reasoning_stream", REASONING_STREAM_MODE)
+    if mode not in REASONING_STREAM_MODES:
+        debug_print(f"无效的 reasoning_stream: {mode}，使用默认值 {REASONING_STREAM_MODE}")
+        return REASONING_STREAM_MODE
+    return mode
+
+def compact_messages(messages: list, budget: int, keep_recent: int = PROMPT_KEEP_RECENT,
+                     tool_output_max_chars: int = PROMPT_TOOL_OUTPUT_MAX_CHARS):
+    """
+    按 token 预算压缩消息历史，返回 (压缩后的消息列表, 各步骤的处理条数)。依次执行，满足预算即停止：
+    1. 去掉与之前完全相同的重复 system 消息（总是执行）；
+    2. 较早的 assistant 消息去除工具调用，较早的工具输出只保留首尾；
+    3. 从最早的非 system 消息开始整条丢弃，并插入一条省略说明。
+    最近 keep_recent 条消息始终保持原样。
+    """
+    report = {"deduplicated": 0, "truncated": 0, "dropped": 0}
+    seen_system = set()
+    result = []
+    for msg in messages:
+        if msg.get('role') == 'system' and isinstance(msg.get('content'), str):
+            if msg['content'] in seen_system:
+                report["deduplicated"] += 1
+                continue
+            seen_system.add(msg['content'])
+        result.append(msg)
+
+    tokens = [estimate_tokens(f"{msg['role']}: {msg['content']}") for msg in result]
+    total = sum(tokens)
+    recent_start = max(0, len(result) - keep_recent)
+
+    for i in range(recent_start):
+        if total <= budget:
+            break
+        msg = result[i]
+        content = msg.get('content')
+        if not isinstance(content, str):
+            continue
+        if msg.get('role') in ('tool', 'function'):
+            compacted = truncate_middle(content, tool_output_max_chars)
+        elif msg.get('role') == 'assistant':
+            compacted = remove_tool(content)
+        else:
+            continue
+        if compacted != content:
+            result[i] = dict(msg, content=compacted)
+            new_tokens = estimate_tokens(f"{msg['role']}: {compacted}")
+            total += new_tokens - tokens[i]
+            tokens[i] = new_tokens
+            report["truncated"] += 1
+
+    if total > budget:
+        kept = []
+        first_dropped = None
+        for i, msg in enumerate(result):
+            if total > budget and i < recent_start and msg.get('role') != 'system':
+                total -= tokens[i]
+                report["dropped"] += 1
+                if first_dropped is None:
+                    first_dropped = len(kept)
+                continue
+            kept.append(msg)
+        if report["dropped"]:
+            kept.insert(first_dropped, {"role": "system",
+                                        "content": f"[已省略较早的 {report['dropped']} 条消息]"})
+        result = kept
+    return result, report
+
+# --- 监控指标 (Prometheus 文本格式) ---
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+def _format_labels(labelnames, labelvalues, extra: str = "") -> str:
+    """格式化标签，转义 Prometheus 文本格式中的特殊字符"""
+    parts = []
+    for name, value in zip(labelnames, labelvalues):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{name}="{value}"')
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Counter:
+    """带标签的计数器，每次更新只持有一次锁"""
+    metric_type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *labelvalues, amount: float = 1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def render(self) -> list:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in values]
+
+class Gauge(Counter):
+    """带标签的可增减指标"""
+    metric_type = "gauge"
+
+    def dec(self, *labelvalues, amount: float = 1):
+        self.inc(*labelvalues, amount=-amount)
+
+    def set(self, value: float, *labelvalues):
+        with self._lock:
+            self._values[labelvalues] = value
+
+class Histogram:
+    """带标签的直方图，桶内计数非累积存储，输出时再累加"""
+    metric_type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (),
+                 buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._values = {}  # labelvalues -> [每个桶的计数..., +Inf 桶计数, 总和]
+
+    def observe(self, value: float, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labelvalues)
+            if state is None:
+                state = self._values[labelvalues] = [0] * (len(self.buckets) + 2)
+            state[index] += 1
+            state[-1] += value
+
+    def render(self) -> list:
+        with self._lock:
+            values = [(key, list(state)) for key, state in self._values.items()]
+        lines = []
+        for key, state in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), state[:-1]):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {state[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+class MetricsRegistry:
+    """指标注册表，负责输出 /metrics 文本"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.metric_type}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+STAGE_SECONDS = metrics.register(Histogram(
+    "qwen_proxy_stage_seconds",
+    "各请求阶段耗时: session_lookup/create_chat/upstream_first_byte/think_phase/answer_phase/session_write",
+    ("stage", "model")))
+CONTINUATION_TOTAL = metrics.register(Counter(
+    "qwen_proxy_continuation_total", "会话续接命中 (hit) 与未命中 (miss) 次数", ("model", "result")))
+UPSTREAM_RESPONSES_TOTAL = metrics.register(Counter(
+    "qwen_proxy_upstream_responses_total", "上游 HTTP 响应状态码计数，连接失败记为 error",
+    ("model", "status")))
+SSE_DECODE_ERRORS_TOTAL = metrics.register(Counter(
+    "qwen_proxy_sse_decode_errors_total", "上游 SSE 数据 JSON 解析失败次数", ("model",)))
+TOKENS_RELAYED_TOTAL = metrics.register(Counter(
+    "qwen_proxy_tokens_relayed_total", "转发的上游增量块数量，按 think/answer 阶段区分", ("model", "phase")))
+ACTIVE_STREAMS = metrics.register(Gauge(
+    "qwen_proxy_active_streams", "正在进行的流式响应数量", ("model",)))
+STREAMS_CANCELLED_TOTAL = metrics.register(Counter(
+    "qwen_proxy_streams_cancelled_total", "客户端中途断开而提前结束的响应数，按断开时所处阶段 (waiting/think/answer)",
+    ("model", "phase")))
+PROMPT_COMPACTED_TOTAL = metrics.register(Counter(
+    "qwen_proxy_prompt_compacted_total", "新对话提示词被压缩的请求数", ("model",)))
+PROMPT_SAVED_BYTES_TOTAL = metrics.register(Counter(
+    "qwen_proxy_prompt_saved_bytes_total", "提示词压缩节省的字节数", ("model",)))
+PROMPT_SAVED_TOKENS_TOTAL = metrics.register(Counter(
+    "qwen_proxy_prompt_saved_tokens_total", "提示词压缩节省的 token 数（估算）", ("model",)))
+RESPONSE_CACHE_TOTAL = metrics.register(Counter(
+    "qwen_proxy_response_cache_total", "响应缓存查找结果 (memory_hit/disk_hit/miss/bypass) 与写入 (store) 次数",
+    ("result",)))
+STREAM_TTFB_SECONDS = metrics.register(Histogram(
+    "qwen_proxy_stream_ttfb_seconds",
+    "流式请求从开始处理到向客户端发出第一个内容块（思考或回答，不含保活注释）的时间，按思考内容输出方式 (live/buffered/dropped)",
+    ("model", "mode")))
+SINGLE_FLIGHT_TOTAL = metrics.register(Counter(
+    "qwen_proxy_single_flight_total", "合并相同请求时驱动上游生成 (leader) 与加入进行中生成 (joined) 的请求数",
+    ("result",)))
+BATCH_REQUESTS_TOTAL = metrics.register(Counter(
+    "qwen_proxy_batch_requests_total", "批处理请求的执行结果 (completed/failed) 与重试 (retried) 次数", ("result",)))
+CANCELLED_TOKENS_SAVED_TOTAL = metrics.register(Counter(
+    "qwen_proxy_cancelled_tokens_saved_total",
+    "取消后上游不必再生成的输出增量数，按该模型近期完整回复的平均输出量估算", ("model",)))
+
+CHAT_POOL_DEPTH = metrics.register(Gauge(
+    "qwen_proxy_chat_pool_depth", "预创建对话池中可用的空对话数量", ("model",)))
+CHAT_POOL_TOTAL = metrics.register(Counter(
+    "qwen_proxy_chat_pool_total", "新对话从预创建池取得 (hit) 或需即时创建 (miss) 的次数", ("model", "result")))
+CHAT_POOL_RECLAIMED_TOTAL = metrics.register(Counter(
+    "qwen_proxy_chat_pool_reclaimed_total", "过期或关闭时删除的预创建对话数量", ("model",)))
+CHAT_POOL_REFILL_SECONDS = metrics.register(Histogram(
+    "qwen_proxy_chat_pool_refill_seconds", "一次将某模型的对话池补满所用的时间", ("model",)))
+UPSTREAM_RETRIES_TOTAL = metrics.register(Counter(
+    "qwen_proxy_upstream_retries_total", "上游请求在返回响应前失败后的重试次数", ("method",)))
+CREATE_CHAT_HEDGES_TOTAL = metrics.register(Counter(
+    "qwen_proxy_create_chat_hedges_total", "创建对话的对冲请求 (sent/won)", ("result",)))
+CIRCUIT_STATE = metrics.register(Gauge(
+    "qwen_proxy_circuit_state", "上游熔断器状态 (0=closed, 1=half_open, 2=open)", ("account",)))
+CIRCUIT_REJECTED_TOTAL = metrics.register(Counter(
+    "qwen_proxy_circuit_rejected_total", "熔断期间被直接拒绝的上游请求数", ("account",)))
+HISTORY_EVICTED_TOTAL = metrics.register(Counter(
+    "qwen_proxy_history_evicted_total", "按保留策略淘汰的本地会话数 (age/rows/bytes)", ("reason",)))
+HISTORY_DB_BYTES = metrics.register(Gauge(
+    "qwen_proxy_history_db_bytes", "会话数据库文件大小（含 WAL）", ("account",)))
+SESSION_WRITE_BATCH_ROWS = metrics.register(Histogram(
+    "qwen_proxy_session_write_batch_rows", "后台一次事务写入的会话记录数", (),
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256)))
+SESSION_WRITE_FLUSH_SECONDS = metrics.register(Histogram(
+    "qwen_proxy_session_write_flush_seconds", "后台批量写入会话记录的事务耗时"))
+STARTUP_SECONDS = metrics.register(Gauge(
+    "qwen_proxy_startup_seconds", "账号初始化到可以处理请求所用的时间，按启动数据来源 (snapshot/upstream)",
+    ("account", "source")))
+MODEL_CATALOG_REFRESH_TOTAL = metrics.register(Counter(
+    "qwen_proxy_model_catalog_refresh_total", "模型目录刷新次数 (updated/not_modified/failed)", ("result",)))
+TRACES_TOTAL = metrics.register(Counter(
+    "qwen_proxy_traces_total", "请求追踪数: sampled/unsampled 为采样结果，exported/dropped 为导出结果", ("result",)))
+
+def record_upstream_error(model: str, error: Exception):
+    """记录没有拿到 HTTP 响应的上游失败（有响应的已按状态码记录）"""
+    if isinstance(error, UpstreamUnavailable):
+        UPSTREAM_RESPONSES_TOTAL.inc(model, "circuit_open")
+    elif getattr(error, "response", None) is None:
+        UPSTREAM_RESPONSES_TOTAL.inc(model, "error")
+
+# --- 上游容错 ---
+class UpstreamUnavailable(requests.exceptions.RequestException):
+    """熔断器打开时直接拒绝上游请求"""
+
+def retry_delay(attempt: int, base: float = None) -> float:
+    """第 attempt 次重试前的等待时间：指数退避加全抖动，避免大量请求同时重试；base 默认为 UPSTREAM_RETRY_BACKOFF"""
+    if base is None:
+        base = UPSTREAM_RETRY_BACKOFF
+    return random.uniform(0, base * 2 ** (attempt - 1))
+
+class TimeoutHTTPAdapter(requests.adapters.HTTPAdapter):
+    """为未显式指定超时的上游请求设置默认的连接/读取超时"""
+
+    def send(self, request, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = (UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT)
+        return super().send(request, timeout=timeout, **kwargs)
+
+class CircuitBreaker:
+    """
+    上游熔断器：连续故障达到阈值后打开，在一段时间内直接拒绝请求；
+    到期后进入半开状态只放行一个探测请求，成功则恢复，失败则重新打开。
+    """
+    STATE_VALUES = {"closed": 0, "half_open": 1, "open": 2}
+
+    def __init__(self, name: str, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 reset_timeout: float = CIRCUIT_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self.trips = 0
+        self.rejected = 0
+        CIRCUIT_STATE.set(0, name)
+
+    def _set_state(self, state: str):
+        self.state = state
+        CIRCUIT_STATE.set(self.STATE_VALUES[state], self.name)
+
+    def allow(self) -> bool:
+        """是否放行一次上游请求；放行后调用方必须报告成功或失败"""
+        with self._lock:
+            if self.state == "open" and time.time() - self.opened_at >= self.reset_timeout:
+                self._set_state("half_open")
+            if self.state == "closed" or (self.state == "half_open" and not self._probing):
+                self._probing = self.state == "half_open"
+                return True
+            self.rejected += 1
+        CIRCUIT_REJECTED_TOTAL.inc(self.name)
+        return False
+
+    def is_open(self) -> bool:
+        """当前是否在拒绝请求（不消耗半开状态的探测机会）"""
+        with self._lock:
+            return self.state == "open" and time.time() - self.opened_at < self.reset_timeout
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self._probing = False
+            if self.state != "closed":
+                self._set_state("closed")
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            self._probing = False
+            if self.state == "half_open" or (self.state == "closed"
+                                              and self.consecutive_failures >= self.failure_threshold):
+                self.opened_at = time.time()
+                self.trips += 1
+                self._set_state("open")
+
+    def snapshot(self) -> dict:
+        """返回熔断器状态"""
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "trips": self.trips,
+                "rejected": self.rejected,
+                "retry_in": max(0, round(self.opened_at + self.reset_timeout - time.time(), 1))
+                            if self.state == "open" else 0,
+            }
+
+# --- 请求追踪 ---
+SPAN_KIND_INTERNAL, SPAN_KIND_SERVER, SPAN_KIND_CLIENT = 1, 2, 3  # OTLP 中的 span 类型
+TRACEPARENT_PATTERN = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+def otlp_value(value) -> dict:
+    """把属性值转换为 OTLP JSON 的 AnyValue"""
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+def otlp_attributes(attributes: dict) -> list:
+    return [{"key": key, "value": otlp_value(value)} for key, value in attributes.items() if value is not None]
+
+class TraceSpan:
+    """追踪中的一个 span；start/end 与事件时间均为 time.perf_counter()，导出时再换算为 Unix 纳秒"""
+    __slots__ = ("name", "span_id", "parent_id", "kind", "start", "end", "attributes", "events", "error")
+
+    def __init__(self, name: str, parent_id: str = None, kind: int = SPAN_KIND_INTERNAL,
+                 start: float = None, end: float = None, attributes: dict = None):
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.kind = kind
+        self.start = start if start is not None else time.perf_counter()
+        self.end = end
+        self.attributes = attributes or {}
+        self.events = []
+        self.error = None
+
+    def set(self, key: str, value):
+        self.attributes[key] = value
+        return self
+
+    def add_event(self, name: str, at: float, attributes: dict = None):
+        """记录 span 内的一个时间点，如第一个思考增量；at 为 None 时忽略"""
+        if at is not None:
+            self.events.append((name, at, attributes or {}))
+
+class RequestTrace:
+    """
+    单个请求的追踪：根 span 覆盖整个请求，处理过程中的各阶段记录为子 span。
+    是否记录在请求开始时一次性决定（头部采样）；未被采样时记录方法都是空操作，只保留 trace id 用于响应头。
+    请求结束 (finish) 且后台驱动方释放 (release) 后，整条追踪交给 trace_exporter 写入文件。
+    """
+
+    def __init__(self, name: str = "", trace_id: str = None, parent_id: str = None, sampled: bool = False):
+        self.trace_id = trace_id or os.urandom(16).hex()
+        self.sampled = sampled
+        self.root = TraceSpan(name, parent_id, SPAN_KIND_SERVER)
+        self.spans = [self.root]
+        self._lock = threading.Lock()
+        self._holds = 1  # 请求本身持有一次，single-flight 驱动方另外持有
+        # perf_counter 与墙上时间的对应关系，用于导出时换算
+        self._wall_ns = time.time_ns()
+        self._perf = self.root.start
+
+    @classmethod
+    def start(cls, name: str, traceparent: str = None) -> "RequestTrace":
+        """开始一个请求的追踪：沿用 W3C traceparent 中的 trace id 与采样标记，没有时按 TRACE_SAMPLE_RATE 采样"""
+        match = TRACEPARENT_PATTERN.match((traceparent or "").strip().lower())
+        if match and match.group(1) != "0" * 32 and match.group(2) != "0" * 16:
+            trace = cls(name, match.group(1), match.group(2), bool(int(match.group(3), 16) & 1))
+        else:
+            trace = cls(name, sampled=random.random() < TRACE_SAMPLE_RATE)
+        TRACES_TOTAL.inc("sampled" if trace.sampled else "unsampled")
+        return trace
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.root.span_id}-{'01' if self.sampled else '00'}"
+
+    def add_span(self, name: str, start: float, end: float = None, parent: TraceSpan = None,
+                 kind: int = SPAN_KIND_INTERNAL, attributes: dict = None) -> TraceSpan:
+        """按已知的起止时间补记一个 span，parent 默认为根 span"""
+        span = TraceSpan(name, (parent or self.root).span_id, kind, start,
+                         end if end is not None else time.perf_counter(), attributes)
+        if self.sampled:
+            with self._lock:
+                self.spans.append(span)
+        return span
+
+    @contextmanager
+    def span(self, name: str, parent: TraceSpan = None, kind: int = SPAN_KIND_INTERNAL):
+        """记录代码块的耗时；代码块抛出异常时 span 标记为错误"""
+        span = TraceSpan(name, (parent or self.root).span_id, kind)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            span.end = time.perf_counter()
+            if self.sampled:
+                with self._lock:
+                    self.spans.append(span)
+
+    def hold(self):
+        """后台驱动方（single-flight）在请求结束后仍可能记录 span，持有期间暂不导出"""
+        with self._lock:
+            self._holds += 1
+
+    def release(self):
+        with self._lock:
+            self._holds -= 1
+            ready = self._holds == 0
+        if ready and self.sampled:
+            trace_exporter.export(self)
+
+    def finish(self, status_code: int = None):
+        """请求结束（响应发送完毕或客户端断开），可重复调用"""
+        if self.root.end is not None:
+            return
+        self.root.end = time.perf_counter()
+        self.root.set("http.response.status_code", status_code)
+        if status_code is not None and status_code >= 500:
+            self.root.error = f"HTTP {status_code}"
+        self.release()
+
+    def _unix_nano(self, at: float) -> str:
+        return str(self._wall_ns + int((at - self._perf) * 1e9))
+
+    def otlp_spans(self) -> list:
+        """按 OTLP JSON 编码全部 span；持有期间结束的请求，未结束的 span 以当前时间截止"""
+        with self._lock:
+            spans = list(self.spans)
+        now = time.perf_counter()
+        encoded = []
+        for span in spans:
+            item = {
+                "traceId": self.trace_id,
+                "spanId": span.span_id,
+                "name": span.name,
+                "kind": span.kind,
+                "startTimeUnixNano": self._unix_nano(span.start),
+                "endTimeUnixNano": self._unix_nano(span.end if span.end is not None else now),
+                "attributes": otlp_attributes(span.attributes),
+                "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+            }
+            if span.parent_id:
+                item["parentSpanId"] = span.parent_id
+            if span.events:
+                item["events"] = [{"name": name, "timeUnixNano": self._unix_nano(at),
+                                   "attributes": otlp_attributes(attributes)}
+                                  for name, at, attributes in span.events]
+            encoded.append(item)
+        return encoded
+
+NO_TRACE = RequestTrace(sampled=False)  # 未启用追踪时使用，所有记录都是空操作
+LOOKUP_SESSION = object()  # prepare_chat 的缺省参数：调用方尚未查找可续接的会话，由 prepare_chat 自行查找
+
+def start_request_trace(name: str, traceparent: str = None):
+    """未启用追踪时返回 None"""
+    return RequestTrace.start(name, traceparent) if TRACING else None
+
+def trace_response(trace: RequestTrace, headers, request_globals):
+    """在响应头中返回 trace id（客户端可据此关联自己记录的延迟），并把缓存、合并等结果记入根 span"""
+    headers["X-Trace-Id"] = trace.trace_id
+    headers["traceparent"] = trace.traceparent
+    if trace.sampled:
+        trace.root.set("qwen.response_cache", request_globals.get("response_cache")) \
+            .set("qwen.single_flight", request_globals.get("single_flight"))
+        compaction = request_globals.get("prompt_compaction")
+        if compaction:
+            trace.root.set("qwen.prompt.saved_tokens", compaction["saved_tokens"])
+
+class TraceExporter:
+    """
+    把采样的追踪按 OTLP JSON 格式追加写入 TRACE_EXPORT_PATH，每行一个 ExportTraceServiceRequest，
+    可由 OpenTelemetry Collector 的 otlpjsonfile receiver 读取后转发到 Jaeger、Tempo 等后端。
+    请求线程只把结束的追踪放入队列，后台线程攒批后一次写入；多进程以追加模式写同一文件，每批只写一次。
+    """
+
+    def __init__(self, path: str = TRACE_EXPORT_PATH, interval: float = TRACE_EXPORT_INTERVAL,
+                 max_queued: int = TRACE_EXPORT_QUEUE_SIZE):
+        self.path = path
+        self.interval = interval
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.exported = 0
+        self.dropped = 0
+        self.write_errors = 0
+
+    def export(self, trace: RequestTrace):
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            self.dropped += 1
+            TRACES_TOTAL.inc("dropped")
+
+    def _ensure_thread(self):
+        # 首次导出时才启动后台线程；多进程模式下每个工作进程各自启动
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, daemon=True, name="trace-export")
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                first = self._queue.get(timeout=self.interval)
+            except queue.Empty:
+                continue
+            batch = [first]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = None in batch
+            self._write([trace for trace in batch if trace is not None])
+            if stopping:
+                return
+            time.sleep(self.interval)
+
+    def _write(self, traces: list):
+        if not traces:
+            return
+        request_body = {"resourceSpans": [{
+            "resource": {"attributes": otlp_attributes({"service.name": "qwen-proxy", "process.pid": os.getpid()})},
+            "scopeSpans": [{"scope": {"name": "qwen-proxy"},
+                            "spans": [span for trace in traces for span in trace.otlp_spans()]}],
+        }]}
+        data = (json.dumps(request_body, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+        try:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            self.write_errors += 1
+            debug_print(f"写入追踪失败: {e}")
+            return
+        self.exported += len(traces)
+        TRACES_TOTAL.inc("exported", amount=len(traces))
+
+    def close(self):
+        """写入队列中剩余的追踪"""
+        if self._thread is None or self._pid != os.getpid():
+            return
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+        self._thread = None
+
+trace_exporter = TraceExporter()
+atexit.register(trace_exporter.close)
+
 class ChatHistoryManager:
     """管理聊天历史记录的本地存储"""
+
+    # 固定的 SQL 文本，配合连接复用命中 sqlite3 的预编译语句缓存
+    SQL_UPSERT = '''
+        INSERT OR REPLACE INTO chat_sessions 
+        (chat_id, title, created_at, updated_at, chat_type, current_response_id, 
+         last_assistant_content, normalized_content, content_digest)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    '''
+    SQL_SELECT_BY_DIGEST = '''
+        SELECT chat_id, current_response_id, normalized_content
+        FROM chat_sessions 
+        WHERE content_digest = ?
+          AND NOT EXISTS (SELECT 1 FROM chat_prefixes WHERE chat_prefixes.chat_id = chat_sessions.chat_id)
+        ORDER BY updated_at DESC
+    '''
+    SQL_DELETE = 'DELETE FROM chat_sessions WHERE chat_id = ?'
+    SQL_DELETE_ALL = 'DELETE FROM chat_sessions'
+    SQL_SELECT_UPDATED_AT = 'SELECT chat_id, updated_at FROM chat_sessions'
+    SQL_EXISTS = 'SELECT 1 FROM chat_sessions WHERE chat_id = ?'
+    SQL_UPSERT_PREFIX = '''
+        INSERT OR REPLACE INTO chat_prefixes (prefix_hash, chat_id, response_id, updated_at)
+        VALUES (?, ?, ?, ?)
+    '''
+    SQL_DELETE_PREFIXES = 'DELETE FROM chat_prefixes WHERE chat_id = ?'
+    SQL_DELETE_ALL_PREFIXES = 'DELETE FROM chat_prefixes'
+    SQL_SELECT_OLDER_THAN = 'SELECT chat_id FROM chat_sessions WHERE updated_at < ?'
+    SQL_SELECT_OLDEST = 'SELECT chat_id FROM chat_sessions ORDER BY updated_at ASC LIMIT ?'
+    # 记录大小按主要文本列的字节数估算
+    SQL_ROW_BYTES = '''(length(CAST(chat_id AS BLOB)) + COALESCE(length(CAST(title AS BLOB)), 0)
+        + COALESCE(length(CAST(last_assistant_content AS BLOB)), 0)
+        + COALESCE(length(CAST(normalized_content AS BLOB)), 0))'''
+    SQL_SELECT_OLDEST_WITH_BYTES = f'SELECT chat_id, {SQL_ROW_BYTES} FROM chat_sessions ORDER BY updated_at ASC'
+    SQL_STATS = f'''
+        SELECT COUNT(*), COALESCE(SUM({SQL_ROW_BYTES}), 0), MIN(updated_at), MAX(updated_at)
+        FROM chat_sessions
+    '''
+    PREFIX_QUERY_BATCH = 500  # 单条 IN 查询的参数上限，避免超出 SQLite 变量数限制
     
-    def __init__(self, db_path: str):
+    def __init__(self, db_path: str, pool_size: int = DATABASE_POOL_SIZE,
+                 write_behind: bool = SESSION_WRITE_BEHIND):
         self.db_path = db_path
+        self.pool_size = pool_size
+        # 空闲连接池，LIFO 让最近使用过的连接（语句缓存最热）优先被复用
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        # 后台批量写入：待写入记录在落盘前作为覆盖层参与查找，保证紧接着的下一轮仍能续接
+        self.write_behind = write_behind
+        self._pending = []  # 待写入的 update_session 参数字典，按提交顺序
+        self._pending_prefixes = {}  # prefix_hash -> 待写入记录
+        self._pending_cond = threading.Condition()
+        self._flush_lock = threading.Lock()  # 串行化批量写入与删除，避免已删除的记录被再次写入
+        self._writer = None
+        self._writer_stopping = False
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.flush_errors = 0
         self.init_database()
+
+    def _create_connection(self):
+        """创建一个开启 WAL 模式并调优过的数据库连接"""
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=DATABASE_BUSY_TIMEOUT,
+            check_same_thread=False,  # 连接由连接池保证同一时间只被一个线程使用
+            cached_statements=64,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        # WAL 模式下 NORMAL 仅在检查点时 fsync，提交不再每次落盘
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={int(DATABASE_BUSY_TIMEOUT * 1000)}")
+        return conn
+
+    @contextmanager
+    def _connection(self):
+        """从连接池借出连接，正常结束时提交、异常时回滚，用完归还"""
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self._create_connection()
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            try:
+                self._pool.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+    def close(self):
+        """写入剩余的待写入记录，并关闭连接池中的所有空闲连接"""
+        self._stop_writer()
+        self.flush()
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
     
     def init_database(self):
         """初始化数据库表结构"""
-        conn = sqlite3.connect(self.db_path)
-        try:
+        directory = os.path.dirname(self.db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
             cursor = conn.cursor()
+            # 新建的数据库直接开启增量 VACUUM；已有数据库由压缩任务首次运行时转换
+            if cursor.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0] == 0:
+                cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS chat_sessions (
                     chat_id TEXT PRIMARY KEY,
@@ -76,87 +911,416 @@ class ChatHistoryManager:
                     updated_at INTEGER,
                     chat_type TEXT,
                     current_response_id TEXT,
-                    last_assistant_content TEXT
+                    last_assistant_content TEXT,
+                    normalized_content TEXT,
+                    content_digest TEXT
                 )
             ''')
-            conn.commit()
-            debug_print("数据库初始化完成")
-        finally:
-            conn.close()
+            self._migrate_database(cursor)
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_chat_sessions_digest
+                ON chat_sessions (content_digest)
+            ''')
+            # 保留策略按更新时间从旧到新淘汰
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_chat_sessions_updated
+                ON chat_sessions (updated_at)
+            ''')
+            # 对话前缀链：每个 assistant 回合之前（含该回合）全部消息的哈希 -> 该回合的回复ID
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS chat_prefixes (
+                    prefix_hash TEXT PRIMARY KEY,
+                    chat_id TEXT,
+                    response_id TEXT,
+                    updated_at INTEGER
+                )
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_chat_prefixes_chat
+                ON chat_prefixes (chat_id)
+            ''')
+        debug_print("数据库初始化完成")
+
+    def _migrate_database(self, cursor):
+        """为旧版本数据库补充标准化内容列与摘要列，并回填已有记录"""
+        cursor.execute("PRAGMA table_info(chat_sessions)")
+        columns = {row[1] for row in cursor.fetchall()}
+        for column in ("normalized_content", "content_digest"):
+            if column not in columns:
+                cursor.execute(f"ALTER TABLE chat_sessions ADD COLUMN {column} TEXT")
+                debug_print(f"数据库迁移: 添加列 {column}")
+
+        cursor.execute('''
+            SELECT chat_id, last_assistant_content
+            FROM chat_sessions
+            WHERE content_digest IS NULL AND last_assistant_content IS NOT NULL
+        ''')
+        rows = cursor.fetchall()
+        for chat_id, stored_content in rows:
+            normalized = self.normalize_text(stored_content)
+            cursor.execute('''
+                UPDATE chat_sessions SET normalized_content = ?, content_digest = ?
+                WHERE chat_id = ?
+            ''', (normalized, self.content_digest(normalized), chat_id))
+        if rows:
+            debug_print(f"数据库迁移: 回填 {len(rows)} 条会话摘要")
     
     def update_session(self, chat_id: str, title: str, created_at: int, updated_at: int, 
-                      chat_type: str, current_response_id: str, last_assistant_content: str):
-        """更新或插入会话记录"""
-        conn = sqlite3.connect(self.db_path)
-        try:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT OR REPLACE INTO chat_sessions 
-                (chat_id, title, created_at, updated_at, chat_type, current_response_id, 
-                 last_assistant_content)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (chat_id, title, created_at, updated_at, chat_type, current_response_id,
-                  remove_tool(last_assistant_content)))
-            conn.commit()
-            debug_print(f"更新会话记录: {chat_id}")
-        finally:
-            conn.close()
+                      chat_type: str, current_response_id: str, last_assistant_content: str,
+                      prefix_hash: str = None):
+        """更新或插入会话记录，提供 prefix_hash 时同时记录该回合的前缀链节点"""
+        session_row, prefix_row = self._session_rows(
+            chat_id, title, created_at, updated_at, chat_type, current_response_id,
+            last_assistant_content, prefix_hash)
+        with self._connection() as conn:
+            conn.execute(self.SQL_UPSERT, session_row)
+            if prefix_row:
+                conn.execute(self.SQL_UPSERT_PREFIX, prefix_row)
+        debug_print(f"更新会话记录: {chat_id}")
+
+    def _session_rows(self, chat_id: str, title: str, created_at: int, updated_at: int,
+                      chat_type: str, current_response_id: str, last_assistant_content: str,
+                      prefix_hash: str = None):
+        """构造会话表与前缀链表的待写入行，没有 prefix_hash 时前缀行为 None"""
+        last_assistant_content = remove_tool(last_assistant_content)
+        # 写入时一次性完成标准化，查找时只需按摘要走索引
+        normalized_content = self.normalize_text(last_assistant_content)
+        digest = self.content_digest(normalized_content)
+        session_row = (chat_id, title, created_at, updated_at, chat_type, current_response_id,
+                       last_assistant_content, normalized_content, digest)
+        prefix_row = (prefix_hash, chat_id, current_response_id, updated_at) if prefix_hash else None
+        return session_row, prefix_row
+
+    def queue_session_update(self, **record):
+        """
+        提交一条会话更新（参数同 update_session）。开启后台写入时只放入队列立即返回，
+        由后台线程攒批后在一个事务中写入；否则直接同步写入。
+        """
+        if not self.write_behind:
+            self.update_session(**record)
+            return
+        with self._pending_cond:
+            self._pending.append(record)
+            if record.get("prefix_hash"):
+                self._pending_prefixes[record["prefix_hash"]] = record
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._run_writer, daemon=True,
+                                                name="session-writer")
+                self._writer.start()
+            # 唤醒空闲等待中的写入线程，或提前结束攒批
+            if len(self._pending) == 1 or len(self._pending) >= SESSION_WRITE_BATCH_SIZE:
+                self._pending_cond.notify()
+
+    def _run_writer(self):
+        """后台写入线程：有待写入记录后最多等待 SESSION_WRITE_FLUSH_INTERVAL 或攒满一批再写入"""
+        while True:
+            with self._pending_cond:
+                while not self._pending and not self._writer_stopping:
+                    self._pending_cond.wait()
+                if self._writer_stopping:
+                    return
+                deadline = time.monotonic() + SESSION_WRITE_FLUSH_INTERVAL
+                while len(self._pending) < SESSION_WRITE_BATCH_SIZE and not self._writer_stopping:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._pending_cond.wait(remaining)
+            try:
+                self.flush()
+            except Exception as e:
+                # 记录已放回队列，稍后重试
+                debug_print(f"批量写入会话记录失败: {e}")
+                time.sleep(DATABASE_BUSY_TIMEOUT / 10)
+
+    def _stop_writer(self):
+        """停止后台写入线程（剩余记录由调用方 flush）"""
+        with self._pending_cond:
+            writer = self._writer
+            if writer is None:
+                return
+            self._writer_stopping = True
+            self._pending_cond.notify_all()
+        writer.join(timeout=DATABASE_BUSY_TIMEOUT * 2)
+        with self._pending_cond:
+            self._writer = None
+            self._writer_stopping = False
+
+    def flush(self) -> int:
+        """把队列中的会话更新在一个事务中写入数据库，返回写入的记录数"""
+        with self._flush_lock:
+            with self._pending_cond:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return 0
+            started = time.perf_counter()
+            try:
+                rows = [self._session_rows(**record) for record in batch]
+                with self._connection() as conn:
+                    conn.executemany(self.SQL_UPSERT, [session_row for session_row, _ in rows])
+                    conn.executemany(self.SQL_UPSERT_PREFIX, [prefix_row for _, prefix_row in rows if prefix_row])
+            except Exception:
+                self.flush_errors += 1
+                with self._pending_cond:
+                    self._pending[:0] = batch
+                raise
+            # 提交后再移除覆盖层，查找时总能在覆盖层或数据库之一中看到记录
+            with self._pending_cond:
+                for record in batch:
+                    prefix_hash = record.get("prefix_hash")
+                    if prefix_hash and self._pending_prefixes.get(prefix_hash) is record:
+                        del self._pending_prefixes[prefix_hash]
+            self.flushes += 1
+            self.flushed_rows += len(batch)
+        SESSION_WRITE_BATCH_ROWS.observe(len(batch))
+        SESSION_WRITE_FLUSH_SECONDS.observe(time.perf_counter() - started)
+        debug_print(f"批量写入 {len(batch)} 条会话记录")
+        return len(batch)
+
+    def _discard_pending(self, chat_ids=None):
+        """丢弃指定会话（None 表示全部）尚未写入的更新，调用方需持有 _flush_lock"""
+        with self._pending_cond:
+            if chat_ids is None:
+                self._pending = []
+                self._pending_prefixes.clear()
+            else:
+                chat_ids = set(chat_ids)
+                self._pending = [record for record in self._pending if record["chat_id"] not in chat_ids]
+                self._pending_prefixes = {prefix_hash: record
+                                          for prefix_hash, record in self._pending_prefixes.items()
+                                          if record["chat_id"] not in chat_ids}
+
+    def _pending_snapshot(self) -> list:
+        """返回尚未写入的会话更新（最新的在后）"""
+        with self._pending_cond:
+            return list(self._pending)
+
+    def message_prefix_hashes(self, messages: list) -> list:
+        """
+        计算消息列表的前缀哈希链，第 i 项为前 i+1 条消息的哈希。
+        assistant 内容先去除工具调用并标准化，以容忍客户端回传时的格式差异。
+        """
+        hashes = []
+        previous = b""
+        for msg in messages:
+            role = msg.get('role') or ''
+            content = msg.get('content') or ''
+            if not isinstance(content, str):
+                content = json.dumps(content, sort_keys=True, ensure_ascii=False)
+            if role == 'assistant':
+                content = self.normalize_text(remove_tool(content))
+            h = hashlib.sha256(previous)
+            h.update(role.encode('utf-8'))
+            h.update(b"\x00")
+            h.update(content.encode('utf-8'))
+            previous = h.digest()
+            hashes.append(h.hexdigest())
+        return hashes
+
+    def find_longest_prefix(self, prefix_hashes: list):
+        """
+        在给定的候选前缀哈希中查找已知的最长前缀（列表越靠后越长）。
+        返回 (候选下标, 会话信息)，均未命中时返回 None。
+        """
+        # 先查待写入的覆盖层再查数据库：记录在提交后才离开覆盖层，两次查找之间不会漏掉
+        with self._pending_cond:
+            overlay = {prefix_hash: (self._pending_prefixes[prefix_hash]["chat_id"],
+                                     self._pending_prefixes[prefix_hash]["current_response_id"])
+                       for prefix_hash in prefix_hashes if prefix_hash in self._pending_prefixes}
+        found = {}
+        with self._connection() as conn:
+            for start in range(0, len(prefix_hashes), self.PREFIX_QUERY_BATCH):
+                batch = prefix_hashes[start:start + self.PREFIX_QUERY_BATCH]
+                placeholders = ",".join("?" * len(batch))
+                rows = conn.execute(
+                    f"SELECT prefix_hash, chat_id, response_id FROM chat_prefixes "
+                    f"WHERE prefix_hash IN ({placeholders})", batch).fetchall()
+                for prefix_hash, chat_id, response_id in rows:
+                    found[prefix_hash] = (chat_id, response_id)
+        found.update(overlay)
+        for index in range(len(prefix_hashes) - 1, -1, -1):
+            if prefix_hashes[index] in found:
+                chat_id, response_id = found[prefix_hashes[index]]
+                return index, {'chat_id': chat_id, 'current_response_id': response_id}
+        return None
     
     def get_session_by_last_content(self, content: str):
         """根据最新AI回复内容查找会话"""
-        normalized_content = self.normalize_text(content)
+        return self.get_session_by_normalized(self.normalize_text(content))
+
+    def get_session_by_normalized(self, normalized_content: str):
+        """
+        根据已标准化的最新AI回复内容查找会话。
+        只匹配没有前缀链的会话（如从云端同步的会话）；有前缀链的会话已由前缀匹配判定，
+        链上未命中说明之前的消息（如 system 提示词）已改变，不能只凭最新回复续接。
+        """
         debug_print(f"查找会话，标准化内容: {normalized_content[:100]}...")
         
-        conn = sqlite3.connect(self.db_path)
-        try:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT chat_id, current_response_id, last_assistant_content
-                FROM chat_sessions 
-                WHERE last_assistant_content IS NOT NULL
-            ''')
-            results = cursor.fetchall()
-            
-            debug_print(f"数据库中共有 {len(results)} 条会话记录")
-            
-            for row in results:
-                chat_id, current_response_id, stored_content = row
-                normalized_stored = self.normalize_text(stored_content)
-                debug_print(f"比较会话 {chat_id}...")
-                
-                if normalized_content == normalized_stored:
-                    debug_print(f"匹配成功！会话ID: {chat_id}")
-                    return {
-                        'chat_id': chat_id,
-                        'current_response_id': current_response_id
-                    }
-            
-            debug_print("未找到匹配的会话")
-            return None
-        finally:
-            conn.close()
+        # 尚未写入的更新较新，优先匹配
+        for record in reversed(self._pending_snapshot()):
+            if record.get("prefix_hash"):
+                continue
+            if self.normalize_text(remove_tool(record["last_assistant_content"])) == normalized_content:
+                debug_print(f"匹配到待写入的会话: {record['chat_id']}")
+                return {
+                    'chat_id': record["chat_id"],
+                    'current_response_id': record["current_response_id"]
+                }
+        
+        with self._connection() as conn:
+            results = conn.execute(
+                self.SQL_SELECT_BY_DIGEST, (self.content_digest(normalized_content),)
+            ).fetchall()
+        
+        debug_print(f"摘要命中 {len(results)} 条会话记录")
+        
+        for row in results:
+            chat_id, current_response_id, normalized_stored = row
+            # 摘要相同时再比较全文，排除哈希碰撞
+            if normalized_content == normalized_stored:
+                debug_print(f"匹配成功！会话ID: {chat_id}")
+                return {
+                    'chat_id': chat_id,
+                    'current_response_id': current_response_id
+                }
+        
+        debug_print("未找到匹配的会话")
+        return None
     
     def delete_session(self, chat_id: str):
         """删除会话记录"""
-        conn = sqlite3.connect(self.db_path)
-        try:
-            cursor = conn.cursor()
-            cursor.execute('DELETE FROM chat_sessions WHERE chat_id = ?', (chat_id,))
-            conn.commit()
-            debug_print(f"删除会话记录: {chat_id}")
-        finally:
-            conn.close()
+        with self._flush_lock:
+            self._discard_pending((chat_id,))
+            with self._connection() as conn:
+                conn.execute(self.SQL_DELETE, (chat_id,))
+                conn.execute(self.SQL_DELETE_PREFIXES, (chat_id,))
+        debug_print(f"删除会话记录: {chat_id}")
     
+    def has_session(self, chat_id: str) -> bool:
+        """本地是否有该会话的记录"""
+        if any(record["chat_id"] == chat_id for record in self._pending_snapshot()):
+            return True
+        with self._connection() as conn:
+            return conn.execute(self.SQL_EXISTS, (chat_id,)).fetchone() is not None
+
+    def get_updated_at_map(self) -> dict:
+        """返回本地所有会话的 {chat_id: updated_at}，用于增量同步"""
+        with self._connection() as conn:
+            return dict(conn.execute(self.SQL_SELECT_UPDATED_AT).fetchall())
+
+    def delete_sessions_except(self, keep_chat_ids: set, updated_before: int) -> int:
+        """删除不在 keep_chat_ids 中且更新时间早于 updated_before 的会话，返回删除数量"""
+        with self._flush_lock:
+            # 同步开始后才排队的更新说明会话仍在使用，与已落盘的新记录一样保留
+            recent = {record["chat_id"] for record in self._pending_snapshot()
+                      if (record["updated_at"] or 0) >= updated_before}
+            stale = [(chat_id,) for chat_id, updated_at in self.get_updated_at_map().items()
+                     if chat_id not in keep_chat_ids and chat_id not in recent
+                     and (updated_at or 0) < updated_before]
+            if stale:
+                # 先丢弃这些会话尚未写入的旧更新，否则之后落盘会把已删除的记录和前缀链写回
+                self._discard_pending([chat_id for chat_id, in stale])
+                with self._connection() as conn:
+                    conn.executemany(self.SQL_DELETE, stale)
+                    conn.executemany(self.SQL_DELETE_PREFIXES, stale)
+        debug_print(f"删除 {len(stale)} 条云端已不存在的会话记录")
+        return len(stale)
+
+    def delete_sessions(self, chat_ids: list):
+        """批量删除会话记录及其前缀链"""
+        rows = [(chat_id,) for chat_id in chat_ids]
+        with self._flush_lock:
+            self._discard_pending(chat_ids)
+            with self._connection() as conn:
+                conn.executemany(self.SQL_DELETE, rows)
+                conn.executemany(self.SQL_DELETE_PREFIXES, rows)
+
+    def select_eviction_candidates(self, max_rows=None, max_age=None, max_bytes=None) -> dict:
+        """按保留策略挑选需要淘汰的会话，返回 {chat_id: 原因}，按最久未更新优先"""
+        victims = {}
+        with self._connection() as conn:
+            if max_age is not None:
+                cutoff = int(time.time()) - max_age
+                for (chat_id,) in conn.execute(self.SQL_SELECT_OLDER_THAN, (cutoff,)):
+                    victims[chat_id] = "age"
+            count, total_bytes, _, _ = conn.execute(self.SQL_STATS).fetchone()
+            total_bytes = total_bytes or 0
+            if max_rows is not None and count - len(victims) > max_rows:
+                # 已按年龄淘汰的会话也是最旧的，一并计入
+                for (chat_id,) in conn.execute(self.SQL_SELECT_OLDEST, (count - max_rows,)):
+                    victims.setdefault(chat_id, "rows")
+            if max_bytes is not None and total_bytes > max_bytes:
+                excess = total_bytes - max_bytes
+                for chat_id, row_bytes in conn.execute(self.SQL_SELECT_OLDEST_WITH_BYTES):
+                    if excess <= 0:
+                        break
+                    # 已因其他原因淘汰的会话同样释放空间
+                    victims.setdefault(chat_id, "bytes")
+                    excess -= row_bytes
+        return victims
+
+    def ensure_incremental_vacuum(self) -> bool:
+        """确保数据库处于增量 VACUUM 模式，旧数据库需要一次完整 VACUUM 转换；返回是否做了转换"""
+        with self._connection() as conn:
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+                return False
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.commit()
+            conn.execute("VACUUM")
+        debug_print("数据库已转换为增量 VACUUM 模式")
+        return True
+
+    def incremental_vacuum(self, pages: int = HISTORY_VACUUM_PAGES) -> int:
+        """回收空闲页并截断 WAL，返回回收的页数"""
+        with self._connection() as conn:
+            before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            # execute() 只会单步执行一次（只回收一页），executescript() 才会执行到结束
+            conn.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+            after = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+        return before - after
+
+    def file_size(self) -> int:
+        """数据库文件（含 WAL）的总大小"""
+        return sum(os.path.getsize(path) for path in (self.db_path, self.db_path + "-wal")
+                   if os.path.exists(path))
+
+    def stats(self) -> dict:
+        """返回数据库大小与行数统计"""
+        with self._connection() as conn:
+            sessions, content_bytes, oldest, newest = conn.execute(self.SQL_STATS).fetchone()
+            prefixes = conn.execute("SELECT COUNT(*) FROM chat_prefixes").fetchone()[0]
+            page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+            page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+            freelist = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            auto_vacuum = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+        return {
+            "db_path": self.db_path,
+            "file_bytes": self.file_size(),
+            "page_bytes": page_size * page_count,
+            "free_bytes": page_size * freelist,
+            "incremental_vacuum": auto_vacuum == 2,
+            "sessions": sessions,
+            "prefixes": prefixes,
+            "content_bytes": content_bytes,
+            "oldest_updated_at": oldest,
+            "newest_updated_at": newest,
+            "write_behind": {
+                "enabled": self.write_behind,
+                "pending": len(self._pending),
+                "flushes": self.flushes,
+                "flushed_rows": self.flushed_rows,
+                "flush_errors": self.flush_errors,
+            },
+        }
+
     def clear_all_sessions(self):
         """清空所有会话记录"""
-        conn = sqlite3.connect(self.db_path)
-        try:
-            cursor = conn.cursor()
-            cursor.execute('DELETE FROM chat_sessions')
-            conn.commit()
-            debug_print("清空所有会话记录")
-        finally:
-            conn.close()
+        with self._flush_lock:
+            self._discard_pending()
+            with self._connection() as conn:
+                conn.execute(self.SQL_DELETE_ALL)
+                conn.execute(self.SQL_DELETE_ALL_PREFIXES)
+        debug_print("清空所有会话记录")
     
     def normalize_text(self, text: str) -> str:
         """标准化文本，处理转义字符、空白符等"""
@@ -174,580 +1338,2971 @@ class ChatHistoryManager:
         
         return text
 
-class QwenClient:
+    @staticmethod
+    def content_digest(normalized_text: str) -> str:
+        """计算标准化文本的摘要，用作索引键"""
+        return hashlib.sha256(normalized_text.encode('utf-8')).hexdigest()
+
+class SessionCache:
     """
-    用于与 chat.qwen.ai API 交互的客户端。
-    封装了创建对话、发送消息、接收流式响应及删除对话的逻辑。
+    续接会话的进程内 LRU/TTL 缓存，位于 SQLite 之前。
+    以截至最新AI回复的对话前缀哈希为键，值为 (chat_id, current_response_id)；每个会话只缓存最新一轮。
     """
-    def __init__(self, auth_token: str, base_url: str = "https://chat.qwen.ai"):
-        self.auth_token = auth_token
-        self.base_url = base_url
-        self.session = requests.Session()
-        self.history_manager = ChatHistoryManager(DATABASE_PATH)
-        # 初始化时设置基本请求头
-        self.session.headers.update({
-            "accept-language": "zh-CN,zh;q=0.9,en;q=0.8",
-            "content-type": "application/json",
-            "source": "web",
-        })
-        self.user_info = None
-        self.models_info = None
-        self.user_settings = None
-        self._initialize()
-        # 启动时同步历史记录
-        self.sync_history_from_cloud()
 
-    def _initialize(self):
-        """初始化客户端，获取用户信息、模型列表和用户设置"""
-        self._update_auth_header()
+    def __init__(self, max_size: int = SESSION_CACHE_SIZE, ttl: float = SESSION_CACHE_TTL,
+                 shared: bool = PREFORK):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # digest -> (chat_id, current_response_id, expires_at)
+        self._digest_by_chat = {}  # chat_id -> digest，用于按会话失效
+        # 多进程模式下，各工作进程通过 fork 前创建的共享失效计数感知其他进程的删除操作
+        self._shared_epoch = multiprocessing.Value('Q', 0) if shared else None
+        self._epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, digest: str):
+        """查找缓存，命中时返回会话信息并刷新 LRU 顺序"""
+        with self._lock:
+            self._sync_epoch()
+            entry = self._entries.get(digest)
+            if entry is None:
+                self.misses += 1
+                return None
+            chat_id, current_response_id, expires_at = entry
+            if expires_at < time.monotonic():
+                self._remove(digest)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(digest)
+            self.hits += 1
+            return {'chat_id': chat_id, 'current_response_id': current_response_id}
+
+    def contains(self, digest: str) -> bool:
+        """是否缓存了该前缀且未过期，不计入命中统计，也不刷新 LRU 顺序"""
+        with self._lock:
+            self._sync_epoch()
+            entry = self._entries.get(digest)
+            return entry is not None and entry[2] >= time.monotonic()
+
+    def put(self, digest: str, chat_id: str, current_response_id: str):
+        """写入缓存，同一会话旧的回复摘要随之失效"""
+        with self._lock:
+            self._sync_epoch()
+            old_digest = self._digest_by_chat.get(chat_id)
+            if old_digest is not None and old_digest != digest:
+                self._remove(old_digest)
+            self._entries[digest] = (chat_id, current_response_id, time.monotonic() + self.ttl)
+            self._entries.move_to_end(digest)
+            self._digest_by_chat[chat_id] = digest
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate_chat(self, chat_id: str):
+        """使某个会话的缓存失效"""
+        with self._lock:
+            digest = self._digest_by_chat.get(chat_id)
+            if digest is not None:
+                self._remove(digest)
+                self.invalidations += 1
+            self._bump_epoch()
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._clear_entries()
+            self._bump_epoch()
+
+    def _clear_entries(self):
+        self.invalidations += len(self._entries)
+        self._entries.clear()
+        self._digest_by_chat.clear()
+
+    def _sync_epoch(self):
+        """其他进程使缓存失效后清空本进程的缓存（调用方需持有锁）"""
+        if self._shared_epoch is not None and self._shared_epoch.value != self._epoch:
+            self._epoch = self._shared_epoch.value
+            self._clear_entries()
+
+    def _bump_epoch(self):
+        """通知其他进程清空缓存（调用方需持有锁）"""
+        if self._shared_epoch is None:
+            return
+        with self._shared_epoch.get_lock():
+            previous = self._shared_epoch.value
+            self._shared_epoch.value = previous + 1
+        # 期间没有其他进程失效过时，本进程的缓存已是最新，不必清空
+        if previous == self._epoch:
+            self._epoch = previous + 1
+
+    def _remove(self, digest: str):
+        entry = self._entries.pop(digest, None)
+        if entry is not None and self._digest_by_chat.get(entry[0]) == digest:
+            del self._digest_by_chat[entry[0]]
+
+    def stats(self) -> dict:
+        """返回缓存命中统计"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+class ChatPool:
+    """
+    预先创建的空对话池，把 create_chat 从新对话的首 token 路径上移除。
+    每个常用模型保留若干空对话，取用后由后台线程异步补充，闲置过期的对话会被删除。
+    """
+
+    def __init__(self, client: "QwenClient", model_ids: list, size: int = CHAT_POOL_SIZE,
+                 ttl: float = CHAT_POOL_TTL):
+        self.client = client
+        self.model_ids = list(model_ids)
+        self.size = size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._chats = {model_id: deque() for model_id in self.model_ids}  # (chat_id, created_at)
+        self._expired = []  # 等待后台线程删除的 (model_id, chat_id)
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self.hits = 0
+        self.misses = 0
+        self.reclaimed = 0
+        self.last_refill_seconds = None
+        self._thread = None
+
+    def start(self):
+        """启动后台补充线程"""
+        if self.size <= 0 or not self.model_ids:
+            return
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name=f"chat-pool-{self.client.name}")
+        self._thread.start()
+
+    def acquire(self, model_id: str):
+        """取出一个未过期的空对话，池中没有时返回 None；未启用预创建时不计入命中统计"""
+        chats = self._chats.get(model_id)
+        if chats is None or self.size <= 0:
+            return None
+        with self._lock:
+            while chats:
+                chat_id, created_at = chats.popleft()
+                CHAT_POOL_DEPTH.dec(model_id)
+                if time.time() - created_at < self.ttl:
+                    self.hits += 1
+                    CHAT_POOL_TOTAL.inc(model_id, "hit")
+                    self._wakeup.set()
+                    return chat_id
+                # 已过期的对话交给后台线程删除
+                self._expired.append((model_id, chat_id))
+            self.misses += 1
+        CHAT_POOL_TOTAL.inc(model_id, "miss")
+        self._wakeup.set()
+        return None
+
+    def release(self, model_id: str, chat_id: str) -> bool:
+        """把未使用的空对话放回池中，池已满或不预创建该模型时返回 False"""
+        chats = self._chats.get(model_id)
+        if chats is None or self._stop.is_set():
+            return False
+        with self._lock:
+            if len(chats) >= self.size:
+                return False
+            chats.append((chat_id, time.time()))
+        CHAT_POOL_DEPTH.inc(model_id)
+        return True
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._reclaim_expired()
+            self._refill()
+            self._wakeup.wait(timeout=CHAT_POOL_CHECK_INTERVAL)
+            self._wakeup.clear()
+
+    def _refill(self):
+        """把每个模型的对话池补满，创建失败时等待下一轮"""
+        for model_id in self.model_ids:
+            started = time.perf_counter()
+            created = 0
+            while len(self._chats[model_id]) < self.size and not self._stop.is_set():
+                try:
+                    chat_id = self.client.create_chat(model_id, title=CHAT_POOL_TITLE, hedge=False)
+                except Exception as e:
+                    debug_print(f"预创建对话失败 ({model_id}): {e}")
+                    break
+                with self._lock:
+                    self._chats[model_id].append((chat_id, time.time()))
+                CHAT_POOL_DEPTH.inc(model_id)
+                created += 1
+            if created:
+                self.last_refill_seconds = round(time.perf_counter() - started, 4)
+                CHAT_POOL_REFILL_SECONDS.observe(time.perf_counter() - started, model_id)
+                debug_print(f"对话池补充 {model_id} x{created}")
+
+    def _reclaim_expired(self):
+        """删除闲置过期的对话"""
+        now = time.time()
+        with self._lock:
+            for model_id, chats in self._chats.items():
+                while chats and now - chats[0][1] >= self.ttl:
+                    chat_id, _ = chats.popleft()
+                    CHAT_POOL_DEPTH.dec(model_id)
+                    self._expired.append((model_id, chat_id))
+            expired, self._expired = self._expired, []
+        for model_id, chat_id in expired:
+            self.client.delete_chat(chat_id)
+            self.reclaimed += 1
+            CHAT_POOL_RECLAIMED_TOTAL.inc(model_id)
+
+    def close(self):
+        """停止后台线程并删除池中剩余的空对话"""
+        self._stop.set()
+        self._wakeup.set()
+        with self._lock:
+            for model_id, chats in self._chats.items():
+                while chats:
+                    chat_id, _ = chats.popleft()
+                    CHAT_POOL_DEPTH.dec(model_id)
+                    self._expired.append((model_id, chat_id))
+            expired, self._expired = self._expired, []
+        for model_id, chat_id in expired:
+            self.client.delete_chat(chat_id)
+            CHAT_POOL_RECLAIMED_TOTAL.inc(model_id)
+
+    def stats(self) -> dict:
+        """返回对话池状态"""
+        with self._lock:
+            depth = {model_id: len(chats) for model_id, chats in self._chats.items()}
+        return {
+            "size": self.size,
+            "depth": depth,
+            "hits": self.hits,
+            "misses": self.misses,
+            "reclaimed": self.reclaimed,
+            "last_refill_seconds": self.last_refill_seconds,
+        }
+
+class HistoryCompactor:
+    """
+    本地历史库的后台压缩任务：按保留策略（最大行数、最长保留时间、最大字节数）淘汰最久未更新的会话，
+    可选分批删除对应的云端对话，最后执行增量 VACUUM 回收磁盘空间。
+    """
+
+    def __init__(self, client: "QwenClient", interval: float = HISTORY_COMPACT_INTERVAL):
+        self.client = client
+        self.interval = interval
+        self._lock = threading.Lock()  # 同一时间只运行一次压缩
+        self._stop = threading.Event()
+        self._thread = None
+        self.runs = 0
+        self.evicted = 0
+        self.cloud_deleted = 0
+        self.cloud_delete_failed = 0
+        self.vacuumed_pages = 0
+        self.last_run_at = None
+        self.last_run_seconds = None
+        self.last_error = None
+
+    @staticmethod
+    def enabled() -> bool:
+        return any(limit is not None for limit in (HISTORY_MAX_ROWS, HISTORY_MAX_AGE, HISTORY_MAX_BYTES))
+
+    def start(self):
+        """启动后台压缩线程，未配置任何保留策略时不启动"""
+        if not self.enabled() or self.interval <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name=f"history-compactor-{self.client.name}")
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                self.last_error = str(e)
+                debug_print(f"压缩历史库失败: {e}")
+            self._stop.wait(self.interval)
+
+    def run_once(self) -> int:
+        """执行一次保留策略与增量 VACUUM，返回淘汰的会话数"""
+        history = self.client.history_manager
+        with self._lock:
+            started = time.perf_counter()
+            history.ensure_incremental_vacuum()
+            victims = history.select_eviction_candidates(HISTORY_MAX_ROWS, HISTORY_MAX_AGE, HISTORY_MAX_BYTES)
+            if victims:
+                chat_ids = list(victims)
+                history.delete_sessions(chat_ids)
+                for chat_id in chat_ids:
+                    self.client.session_cache.invalidate_chat(chat_id)
+                for reason in victims.values():
+                    HISTORY_EVICTED_TOTAL.inc(reason)
+                self.evicted += len(chat_ids)
+                debug_print(f"按保留策略淘汰 {len(chat_ids)} 条会话记录")
+                if HISTORY_DELETE_CLOUD:
+                    self._delete_cloud_chats(chat_ids)
+            self.vacuumed_pages += history.incremental_vacuum()
+            HISTORY_DB_BYTES.set(history.file_size(), self.client.name)
+            self.runs += 1
+            self.last_run_at = int(time.time())
+            self.last_run_seconds = round(time.perf_counter() - started, 4)
+            self.last_error = None
+            return len(victims)
+
+    def _delete_cloud_chats(self, chat_ids: list):
+        """分批并发删除云端对话，批次之间检查是否需要停止"""
+        with ThreadPoolExecutor(max_workers=HISTORY_CLOUD_DELETE_BATCH,
+                                thread_name_prefix="history-delete") as executor:
+            for start in range(0, len(chat_ids), HISTORY_CLOUD_DELETE_BATCH):
+                if self._stop.is_set():
+                    break
+                batch = chat_ids[start:start + HISTORY_CLOUD_DELETE_BATCH]
+                results = list(executor.map(self.client.delete_chat, batch))
+                self.cloud_deleted += sum(results)
+                self.cloud_delete_failed += len(results) - sum(results)
+
+    def close(self):
+        """停止后台压缩线程"""
+        self._stop.set()
+
+    def stats(self) -> dict:
+        """返回保留策略与压缩任务的运行状态"""
+        return {
+            "policy": {
+                "max_rows": HISTORY_MAX_ROWS,
+                "max_age": HISTORY_MAX_AGE,
+                "max_bytes": HISTORY_MAX_BYTES,
+                "delete_cloud": HISTORY_DELETE_CLOUD,
+                "interval": self.interval,
+            },
+            "running": self._thread is not None,
+            "runs": self.runs,
+            "evicted": self.evicted,
+            "cloud_deleted": self.cloud_deleted,
+            "cloud_delete_failed": self.cloud_delete_failed,
+            "vacuumed_pages": self.vacuumed_pages,
+            "last_run_at": self.last_run_at,
+            "last_run_seconds": self.last_run_seconds,
+            "last_error": self.last_error,
+        }
+
+class ModelCatalogSnapshot:
+    """模型目录的一份不可变快照，构建完成后整体替换，请求线程不会读到更新了一半的目录"""
+
+    def __init__(self, models_info: dict, user_settings: dict):
+        self.models_info = models_info
+        self.user_settings = user_settings
+        # 别名表：上游模型 ID 映射到自身，MODEL_MAP 中目标模型存在的条目覆盖其上
+        self.aliases = {model_id: model_id for model_id in models_info}
+        self.aliases.update({alias: target for alias, target in MODEL_MAP.items() if target in models_info})
+        # 预先序列化 /v1/models 的响应体
+        self.models_response = {"object": "list", "data": [{
+            "id": model_info['info']['id'],
+            "object": "model",
+            "created": model_info['info']['created_at'],
+            "owned_by": model_info['owned_by']
+        } for model_info in models_info.values()]}
+        self.models_body = json.dumps(self.models_response, ensure_ascii=False,
+                                      separators=(",", ":")).encode("utf-8")
+        self.etag = hashlib.sha1(self.models_body).hexdigest()
+
+class ModelCatalog:
+    """
+    缓存上游的模型列表与用户设置，并在后台定期刷新。
+    刷新时携带 If-None-Match/If-Modified-Since 条件请求，上游未变化时不重新构建快照。
+    """
+    PATHS = {"models": "/api/models", "settings": "/api/v2/users/user/settings"}
+
+    def __init__(self, client: "QwenClient", refresh_interval: float = MODEL_CATALOG_REFRESH_INTERVAL):
+        self.client = client
+        self.refresh_interval = refresh_interval
+        self.snapshot = None
+        self._validators = {}  # name -> (etag, last_modified, data)
+        self._refresh_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.refreshes = 0
+        self.not_modified = 0
+        self.failures = 0
+        self.last_refresh_at = None
+        self.last_error = None
+
+    def _fetch(self, name: str):
+        """条件请求上游数据，返回 (data, 是否有变化)"""
+        url = f"{self.client.base_url}{self.PATHS[name]}"
+        cached = self._validators.get(name)
+        headers = {}
+        if cached is not None:
+            etag, last_modified, _ = cached
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        response = self.client._upstream_request("GET", url, headers=headers)
+        if response.status_code == 304 and cached is not None:
+            return cached[2], False
+        response.raise_for_status()
+        data = response.json()['data']
+        self._validators[name] = (response.headers.get("ETag"), response.headers.get("Last-Modified"), data)
+        # 上游不支持条件请求时，按内容判断是否有变化
+        return data, cached is None or data != cached[2]
+
+    def refresh(self) -> bool:
+        """并发拉取模型列表与用户设置，有变化时构建新快照并原子替换；返回是否有更新"""
+        with self._refresh_lock:
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                models_future = executor.submit(self._fetch, "models")
+                settings_future = executor.submit(self._fetch, "settings")
+                models, models_changed = models_future.result()
+                settings, settings_changed = settings_future.result()
+            self.last_refresh_at = int(time.time())
+            if self.snapshot is not None and not (models_changed or settings_changed):
+                self.not_modified += 1
+                MODEL_CATALOG_REFRESH_TOTAL.inc("not_modified")
+                return False
+            self.snapshot = ModelCatalogSnapshot({model['id']: model for model in models}, settings)
+            self.refreshes += 1
+            MODEL_CATALOG_REFRESH_TOTAL.inc("updated")
+            return True
+
+    def export(self) -> dict:
+        """导出条件请求的校验信息与数据，用于保存启动快照"""
+        return {name: list(validator) for name, validator in self._validators.items()}
+
+    def load(self, exported: dict):
+        """从启动快照恢复目录；之后的刷新仍携带快照中的 ETag 发送条件请求"""
+        with self._refresh_lock:
+            self._validators = {name: tuple(validator) for name, validator in exported.items()}
+            models = self._validators["models"][2]
+            settings = self._validators["settings"][2]
+            self.snapshot = ModelCatalogSnapshot({model['id']: model for model in models}, settings)
+
+    def resolve(self, openai_model: str):
+        """将 OpenAI 模型名称映射到 Qwen 模型 ID，未知模型返回 None"""
+        return self.snapshot.aliases.get(openai_model)
+
+    def start(self):
+        """启动后台刷新线程"""
+        if self.refresh_interval <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name=f"model-catalog-{self.client.name}")
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.refresh_interval):
+            try:
+                if self.refresh():
+                    debug_print(f"模型目录已更新，共 {len(self.snapshot.models_info)} 个模型")
+                    self.client.save_bootstrap_snapshot()
+            except Exception as e:
+                # 刷新失败时继续使用旧目录
+                self.failures += 1
+                self.last_error = str(e)
+                MODEL_CATALOG_REFRESH_TOTAL.inc("failed")
+                debug_print(f"刷新模型目录失败: {e}")
+
+    def close(self):
+        """停止后台刷新线程"""
+        self._stop.set()
+
+    def stats(self) -> dict:
+        """返回模型目录状态"""
+        snapshot = self.snapshot
+        return {
+            "models": len(snapshot.models_info) if snapshot else 0,
+            "etag": snapshot.etag if snapshot else None,
+            "refreshes": self.refreshes,
+            "not_modified": self.not_modified,
+            "failures": self.failures,
+            "last_refresh_at": self.last_refresh_at,
+            "last_error": self.last_error,
+        }
+
+class AccountHealth:
+    """记录单个账号的在途请求数与健康/限流状态，供账号池调度使用"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.total_requests = 0
+        self.total_failures = 0
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self.throttled = False  # 当前冷却是否由限流引起
+        self.last_error = None
+
+    def begin(self):
+        """请求开始"""
+        with self._lock:
+            self.in_flight += 1
+            self.total_requests += 1
+
+    def end(self):
+        """请求结束（包括流式响应发送完毕）"""
+        with self._lock:
+            self.in_flight -= 1
+
+    def record_success(self):
+        """上游请求成功，清零连续失败计数"""
+        with self._lock:
+            self.consecutive_failures = 0
+
+    def record_failure(self, error: Exception):
+        """上游请求失败，根据状态码决定是否暂停调度该账号"""
+        status_code = getattr(getattr(error, "response", None), "status_code", None)
+        with self._lock:
+            self.total_failures += 1
+            self.consecutive_failures += 1
+            self.last_error = str(error)
+            if status_code == 429:
+                self.cooldown_until = time.time() + ACCOUNT_THROTTLE_COOLDOWN
+                self.throttled = True
+            elif status_code in (401, 403) or self.consecutive_failures >= ACCOUNT_MAX_FAILURES:
+                self.cooldown_until = time.time() + ACCOUNT_FAILURE_COOLDOWN
+                self.throttled = False
+
+    def available(self) -> bool:
+        """账号当前是否可被调度"""
+        return time.time() >= self.cooldown_until
+
+    def failing(self) -> bool:
+        """账号是否因认证失败或连续故障而暂停（限流引起的冷却不算）"""
+        return not self.available() and not self.throttled
+
+    def snapshot(self) -> dict:
+        """返回健康状态快照"""
+        with self._lock:
+            return {
+                "available": self.available(),
+                "in_flight": self.in_flight,
+                "total_requests": self.total_requests,
+                "total_failures": self.total_failures,
+                "consecutive_failures": self.consecutive_failures,
+                "cooldown_remaining": max(0, round(self.cooldown_until - time.time(), 1)),
+                "last_error": self.last_error,
+            }
+
+class QwenClient:
+    """
+    用于与 chat.qwen.ai API 交互的客户端。
+    封装了创建对话、发送消息、接收流式响应及删除对话的逻辑。
+    """
+    def __init__(self, auth_token: str, base_url: str = QWEN_BASE_URL,
+                 db_path: str = DATABASE_PATH, name: str = "default"):
+        self.auth_token = auth_token
+        self.base_url = base_url
+        self.name = name
+        self.session = requests.Session()
+        self.history_manager = ChatHistoryManager(db_path)
+        self.session_cache = SessionCache()
+        self.health = AccountHealth()
+        # 初始化时设置基本请求头
+        self.session.headers.update({
+            "accept-language": "zh-CN,zh;q=0.9,en;q=0.8",
+            "content-type": "application/json",
+            "source": "web",
+        })
+        # 连接池需容纳并发同步线程与请求线程
+        adapter = TimeoutHTTPAdapter(
+            pool_connections=4, pool_maxsize=max(10, HISTORY_SYNC_CONCURRENCY * 2))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.user_info = None
+        self.breaker = CircuitBreaker(name)
+        self._create_chat_latencies = deque(maxlen=200)  # 最近成功创建对话的耗时，用于计算对冲阈值
+        self._output_deltas_ewma = {}  # 模型 -> 完整回复输出增量数的滑动平均
+        self._hedge_executor = None
+        self._hedge_lock = threading.Lock()
+        self.catalog = ModelCatalog(self)
+        self._sync_lock = threading.Lock()
+        self.sync_status = {"state": "idle"}
+        self.snapshot_path = f"{db_path}.bootstrap.json"
+        self.bootstrap = {}  # 启动数据来源与耗时
+        self._initialize()
+        # 为常用模型预创建空对话
+        pool_models = CHAT_POOL_MODELS if CHAT_POOL_MODELS is not None else MODEL_MAP.values()
+        self.chat_pool = ChatPool(self, [m for m in dict.fromkeys(pool_models) if m in self.models_info])
+        self.compactor = HistoryCompactor(self)
+        if PREFORK:
+            # 主进程不持有上游连接与数据库连接，也不启动线程，避免它们被 fork 到工作进程中共用
+            self.session.close()
+            self.history_manager.close()
+        else:
+            self.start_background_tasks()
+
+    def start_background_tasks(self, leader: bool = True):
+        """
+        启动后台任务：对话池补充与模型目录刷新；
+        历史同步（不阻塞服务启动）与历史库压缩只需在一个进程 (leader) 中运行。
+        """
+        if leader:
+            self.start_leader_tasks()
+        self.chat_pool.start()
+        self.catalog.start()
+        if self.bootstrap.get("source") == "snapshot" and not self.bootstrap.get("revalidated"):
+            threading.Thread(target=self.revalidate_bootstrap, daemon=True,
+                             name=f"bootstrap-revalidate-{self.name}").start()
+
+    def start_leader_tasks(self):
+        """启动只需在一个进程中运行的后台任务：历史同步与历史库压缩"""
+        self.start_history_sync()
+        self.compactor.start()
+
+    def _initialize(self):
+        """
+        初始化客户端：有可用的启动快照时直接从快照启动（之后在后台重新验证），
+        否则并发获取用户信息、模型列表和用户设置。
+        """
+        started = time.perf_counter()
+        self._update_auth_header()
+        source = "snapshot" if self.load_bootstrap_snapshot() else "upstream"
+        if source == "upstream":
+            try:
+                self._fetch_bootstrap()
+            except requests.exceptions.RequestException as e:
+                print(f"客户端初始化失败: {e}")
+                raise
+        elapsed = time.perf_counter() - started
+        self.bootstrap.update(source=source, seconds=round(elapsed, 4))
+        STARTUP_SECONDS.set(elapsed, self.name, source)
+        debug_print(f"账号 {self.name} 初始化完成（启动数据来自 {source}），用时 {elapsed * 1000:.0f} ms")
+
+    def _fetch_bootstrap(self):
+        """并发获取用户信息与模型目录（模型列表、用户设置），成功后保存启动快照"""
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            user_info_future = executor.submit(self._upstream_request, "GET", f"{self.base_url}/api/v1/auths/")
+            # 模型列表和用户设置之后由模型目录在后台定期刷新
+            catalog_future = executor.submit(self.catalog.refresh)
+            self.user_info = user_info_future.result().json()
+            catalog_future.result()
+        self.save_bootstrap_snapshot()
+
+    def _token_fingerprint(self) -> str:
+        return hashlib.sha256(self.auth_token.encode('utf-8')).hexdigest()[:16]
+
+    def load_bootstrap_snapshot(self) -> bool:
+        """读取本地启动快照，快照不存在、过期或属于其他账号时返回 False"""
+        if not BOOTSTRAP_SNAPSHOT:
+            return False
+        try:
+            with open(self.snapshot_path, "rb") as f:
+                snapshot = json_loads(f.read())
+            if snapshot["token"] != self._token_fingerprint():
+                return False
+            age = time.time() - snapshot["saved_at"]
+            if age > BOOTSTRAP_SNAPSHOT_MAX_AGE:
+                debug_print(f"启动快照已过期 ({age:.0f}s)，重新向上游获取")
+                return False
+            self.catalog.load(snapshot["catalog"])
+        except (OSError, ValueError, KeyError, TypeError, IndexError) as e:
+            if not isinstance(e, FileNotFoundError):
+                debug_print(f"启动快照不可用: {e}")
+            return False
+        self.user_info = snapshot["user_info"]
+        self.bootstrap["snapshot_age"] = round(age)
+        return True
+
+    def save_bootstrap_snapshot(self):
+        """把当前的启动数据写入本地快照（先写临时文件再替换，多进程同时写入也不会损坏）"""
+        if not BOOTSTRAP_SNAPSHOT or self.catalog.snapshot is None:
+            return
+        snapshot = {
+            "saved_at": time.time(),
+            "token": self._token_fingerprint(),
+            "user_info": self.user_info,
+            "catalog": self.catalog.export(),
+        }
+        tmp_path = f"{self.snapshot_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f, ensure_ascii=False)
+            os.replace(tmp_path, self.snapshot_path)
+        except OSError as e:
+            debug_print(f"保存启动快照失败: {e}")
+
+    def revalidate_bootstrap(self):
+        """从快照启动后在后台向上游重新获取启动数据（模型目录使用条件请求）；失败时继续使用快照"""
+        try:
+            self._fetch_bootstrap()
+            self.bootstrap["revalidated"] = int(time.time())
+            debug_print(f"账号 {self.name} 的启动数据已重新验证")
+        except requests.exceptions.RequestException as e:
+            self.bootstrap["revalidate_error"] = str(e)
+            debug_print(f"重新验证启动数据失败，继续使用快照: {e}")
+
+    @property
+    def models_info(self) -> dict:
+        return self.catalog.snapshot.models_info
+
+    @property
+    def user_settings(self) -> dict:
+        return self.catalog.snapshot.user_settings
+
+    def _update_auth_header(self):
+        """更新会话中的认证头"""
+        self.session.headers.update({"authorization": f"Bearer {self.auth_token}"})
+
+    def _upstream_request(self, method: str, url: str, model_id: str = None, **kwargs) -> requests.Response:
+        """
+        经熔断器发送上游请求：在拿到响应之前失败或返回可重试的 5xx 时按抖动退避重试，
+        其余非成功状态抛出 HTTPError。流式请求拿到响应头即返回，之后的失败不再重试。
+        """
+        # POST 不是幂等的，只重试可确定上游未处理的连接失败；读取超时可能已在上游生效
+        retry_errors = (requests.exceptions.ConnectionError,) if method == "POST" else \
+            (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                raise UpstreamUnavailable(f"上游连续故障，已熔断 (账号 {self.name})")
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.exceptions.RequestException as e:
+                self.breaker.record_failure()
+                if not isinstance(e, retry_errors) or attempt >= UPSTREAM_MAX_RETRIES:
+                    raise
+                debug_print(f"上游请求失败，准备重试: {e}")
+                if model_id is not None:
+                    record_upstream_error(model_id, e)
+            else:
+                if model_id is not None:
+                    UPSTREAM_RESPONSES_TOTAL.inc(model_id, response.status_code)
+                if response.status_code < 500:
+                    self.breaker.record_success()
+                else:
+                    self.breaker.record_failure()
+                if response.status_code not in UPSTREAM_RETRY_STATUSES or attempt >= UPSTREAM_MAX_RETRIES:
+                    try:
+                        response.raise_for_status()
+                    except requests.exceptions.HTTPError:
+                        response.close()
+                        raise
+                    return response
+                debug_print(f"上游返回 {response.status_code}，准备重试: {url}")
+                response.close()
+            attempt += 1
+            UPSTREAM_RETRIES_TOTAL.inc(method)
+            time.sleep(retry_delay(attempt))
+
+    def start_history_sync(self) -> bool:
+        """在后台线程中从云端同步历史记录，已有同步在进行时返回 False"""
+        with self._sync_lock:
+            if self.sync_status["state"] == "running":
+                return False
+            self.sync_status = {
+                "state": "running",
+                "started_at": int(time.time()),
+                "finished_at": None,
+                "pages": 0,
+                "listed": 0,
+                "fetched": 0,
+                "skipped": 0,
+                "failed": 0,
+                "removed": 0,
+                "reclaimed": 0,
+                "error": None,
+            }
+        threading.Thread(target=self.sync_history_from_cloud, daemon=True,
+                         name="history-sync").start()
+        return True
+
+    def get_sync_status(self) -> dict:
+        """返回当前历史同步进度的快照"""
+        with self._sync_lock:
+            return dict(self.sync_status)
+
+    def _bump_sync_status(self, **deltas):
+        """累加同步进度计数"""
+        with self._sync_lock:
+            for key, value in deltas.items():
+                self.sync_status[key] += value
+
+    def _sync_one_session(self, session: dict):
+        """拉取单个会话详情并写入本地数据库"""
+        chat_id = session['id']
+        try:
+            detail_url = f"{self.base_url}/api/v2/chats/{chat_id}"
+            detail_response = self._upstream_request("GET", detail_url)
+            detail_data = detail_response.json()
+            
+            if not detail_data.get('success'):
+                self._bump_sync_status(failed=1)
+                return
+            
+            chat_detail = detail_data['data']
+            messages = chat_detail.get('chat', {}).get('messages', [])
+            if not messages:
+                # 从未使用的空对话（多为预创建对话）不写入本地；上次运行遗留的预创建对话直接删除
+                if session.get('title') == CHAT_POOL_TITLE and session.get('created_at', 0) < SERVICE_STARTED_AT:
+                    if self.delete_chat(chat_id):
+                        self._bump_sync_status(reclaimed=1)
+                        return
+                self._bump_sync_status(skipped=1)
+                return
+            
+            # 提取最新的AI回复内容
+            last_assistant_content = ""
+            for msg in reversed(messages):
+                if msg.get('role') == 'assistant':
+                    # 从content_list中提取内容
+                    content_list = msg.get('content_list', [])
+                    if content_list:
+                        last_assistant_content = content_list[-1].get('content', '')
+                    else:
+                        last_assistant_content = msg.get('content', '')
+                    break
+            
+            # 保存到本地数据库
+            current_response_id = chat_detail.get('currentId', '')
+            
+            self.session_cache.invalidate_chat(chat_id)
+            self.history_manager.update_session(
+                chat_id=chat_id,
+                title=session.get('title', ''),
+                created_at=session.get('created_at', 0),
+                updated_at=session.get('updated_at', 0),
+                chat_type=session.get('chat_type', ''),
+                current_response_id=current_response_id,
+                last_assistant_content=last_assistant_content
+            )
+            self._bump_sync_status(fetched=1)
+            
+        except Exception as e:
+            debug_print(f"获取会话 {chat_id} 详细信息失败: {e}")
+            self._bump_sync_status(failed=1)
+
+    def sync_history_from_cloud(self):
+        """从云端增量同步历史记录到本地数据库"""
+        debug_print("开始从云端同步历史记录")
+        self._update_auth_header()
+        started_at = int(time.time())
+        # 超过保留时长的会话不再拉取详情，写入后也会被压缩任务淘汰
+        cutoff = started_at - HISTORY_MAX_AGE if HISTORY_MAX_AGE is not None else None
+        seen_chat_ids = set()
+        completed = False
+        
+        try:
+            # 本地已有且云端未更新的会话直接跳过，不再清空重建
+            local_updated_at = self.history_manager.get_updated_at_map()
+            
+            with ThreadPoolExecutor(max_workers=HISTORY_SYNC_CONCURRENCY,
+                                    thread_name_prefix="history-sync") as executor:
+                page = 1
+                while True:
+                    # 获取历史会话列表
+                    list_url = f"{self.base_url}/api/v2/chats/?page={page}"
+                    response = self._upstream_request("GET", list_url)
+                    data = response.json()
+                    
+                    if not data.get('success') or not data.get('data'):
+                        break
+                    
+                    sessions = data['data']
+                    debug_print(f"第 {page} 页获取到 {len(sessions)} 个会话")
+                    
+                    if not sessions:
+                        break
+                    
+                    pending = []
+                    expired = 0
+                    for session in sessions:
+                        seen_chat_ids.add(session['id'])
+                        if cutoff is not None and session.get('updated_at', 0) < cutoff:
+                            expired += 1
+                            continue
+                        local = local_updated_at.get(session['id'])
+                        if local is not None and local >= session.get('updated_at', 0):
+                            continue
+                        pending.append(session)
+                    self._bump_sync_status(pages=1, listed=len(sessions),
+                                           skipped=len(sessions) - len(pending))
+                    
+                    # 并发获取需要更新的会话详情，当前页完成后再翻页
+                    list(executor.map(self._sync_one_session, pending))
+                    
+                    # 列表按更新时间倒序，整页都已过期时后续页面也不必再拉取
+                    if expired == len(sessions):
+                        break
+                    page += 1
+            
+            # 只有完整遍历后才清理云端已删除的会话；同步期间新写入的记录不受影响
+            removed = self.history_manager.delete_sessions_except(seen_chat_ids, started_at)
+            if removed:
+                self.session_cache.clear()
+            self._bump_sync_status(removed=removed)
+            completed = True
+            debug_print("历史记录同步完成")
+            if self.compactor.enabled():
+                self.compactor.run_once()
+            
+        except Exception as e:
+            debug_print(f"同步历史记录失败: {e}")
+            with self._sync_lock:
+                self.sync_status["error"] = str(e)
+        finally:
+            with self._sync_lock:
+                self.sync_status["state"] = "finished" if completed else "failed"
+                self.sync_status["finished_at"] = int(time.time())
+
+    def _get_qwen_model_id(self, openai_model: str) -> str:
+        """将 OpenAI 模型名称映射到 Qwen 模型 ID"""
+        # 别名表已合并 MODEL_MAP 与当前模型列表；都不匹配时回退到默认模型
+        qwen_model_id = self.catalog.resolve(openai_model)
+        if qwen_model_id is not None:
+            return qwen_model_id
+        else:
+            print(f"模型 '{openai_model}' 未找到或未映射，使用默认模型 'qwen3-235b-a22b'")
+            return "qwen3-235b-a22b" # 最可靠的回退选项
+
+    def list_openai_models(self) -> dict:
+        """返回 OpenAI 格式的模型列表"""
+        return self.catalog.snapshot.models_response
+
+    def create_chat(self, model_id: str, title: str = "新对话", hedge: bool = True) -> str:
+        """
+        创建一个新的对话。
+        开启 CREATE_CHAT_HEDGE 时，若请求耗时超过近期 P95 仍未完成，再并发发出一个请求，取先成功者；
+        落选请求创建的对话放入对话池或删除。
+        """
+        delay = self.hedge_delay() if hedge else None
+        if delay is None:
+            return self._create_chat_once(model_id, title)
+        executor = self._get_hedge_executor()
+        primary = executor.submit(self._create_chat_once, model_id, title)
+        futures = [primary]
+        if not wait(futures, timeout=delay).done:
+            debug_print(f"创建对话超过 {delay:.3f}s 未完成，发出对冲请求")
+            CREATE_CHAT_HEDGES_TOTAL.inc("sent")
+            futures.append(executor.submit(self._create_chat_once, model_id, title))
+        error = None
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    chat_id = future.result()
+                except requests.exceptions.RequestException as e:
+                    error = e
+                    continue
+                if future is not primary:
+                    CREATE_CHAT_HEDGES_TOTAL.inc("won")
+                # 另一个请求完成后再处理它创建的对话
+                for other in futures:
+                    if other is not future:
+                        other.add_done_callback(lambda f: self._discard_hedged_chat(model_id, f))
+                return chat_id
+        raise error
+
+    def hedge_delay(self):
+        """返回创建对话的对冲阈值（近期耗时的 P95），未开启或样本不足时返回 None"""
+        if not CREATE_CHAT_HEDGE:
+            return None
+        samples = sorted(self._create_chat_latencies)
+        if len(samples) < CREATE_CHAT_HEDGE_MIN_SAMPLES:
+            return None
+        return samples[int(len(samples) * 0.95) - 1]
+
+    def _get_hedge_executor(self) -> ThreadPoolExecutor:
+        with self._hedge_lock:
+            if self._hedge_executor is None:
+                self._hedge_executor = ThreadPoolExecutor(max_workers=16,
+                                                          thread_name_prefix=f"hedge-{self.name}")
+            return self._hedge_executor
+
+    def _discard_hedged_chat(self, model_id: str, future):
+        """落选的对冲请求成功创建了对话时，放入对话池，池满则删除"""
+        if future.exception() is not None:
+            return
+        chat_id = future.result()
+        if not self.chat_pool.release(model_id, chat_id):
+            self.delete_chat(chat_id)
+
+    def _create_chat_once(self, model_id: str, title: str) -> str:
+        """发送一次创建对话请求"""
+        self._update_auth_header() # 确保 token 是最新的
+        url = f"{self.base_url}/api/v2/chats/new"
+        payload = {
+            "title": title,
+            "models": [model_id],
+            "chat_mode": "normal",
+            "chat_type": "t2t", # Text to Text
+            "timestamp": int(time.time() * 1000)
+        }
+        started = time.perf_counter()
+        try:
+            response = self._upstream_request("POST", url, model_id, json=payload)
+            chat_id = response.json()['data']['id']
+            elapsed = time.perf_counter() - started
+            STAGE_SECONDS.observe(elapsed, "create_chat", model_id)
+            self._create_chat_latencies.append(elapsed)
+            debug_print(f"成功创建对话: {chat_id}")
+            return chat_id
+        except requests.exceptions.RequestException as e:
+            debug_print(f"创建对话失败: {e}")
+            record_upstream_error(model_id, e)
+            self.health.record_failure(e)
+            raise
+
+    def acquire_chat(self, model_id: str) -> str:
+        """为新对话取得 chat_id：优先使用预创建的空对话，池中没有时即时创建"""
+        chat_id = self.chat_pool.acquire(model_id)
+        if chat_id:
+            debug_print(f"使用预创建的对话: {chat_id}")
+            return chat_id
+        return self.create_chat(model_id, title=f"OpenAI_API_对话_{int(time.time())}")
+
+    def delete_chat(self, chat_id: str):
+        """删除一个对话"""
+        self._update_auth_header() # 确保 token 是最新的
+        url = f"{self.base_url}/api/v2/chats/{chat_id}"
+        
+        try:
+            response = self._upstream_request("DELETE", url)
+            res_data = response.json()
+            if res_data.get('success', False):
+                debug_print(f"成功删除对话: {chat_id}")
+                # 同时删除本地记录
+                self.forget_session(chat_id)
+                return True
+            else:
+                debug_print(f"删除对话 {chat_id} 返回 success=False: {res_data}")
+                return False
+        except requests.exceptions.RequestException as e:
+            debug_print(f"删除对话失败 {chat_id}: {e}")
+            return False
+        except json.JSONDecodeError:
+            debug_print(f"删除对话时无法解析 JSON 响应 {chat_id}")
+            return False
+
+    def find_matching_session(self, messages: list, prefix_hashes: list = None, use_cache: bool = True):
+        """
+        根据消息历史查找匹配的会话。
+        优先按前缀哈希链匹配已知的最长前缀（支持编辑、重新生成早期回合后从对应回复处分支），
+        未命中时回退到只比较最新AI回复内容。
+        返回的会话信息中 matched_messages 表示已被该会话覆盖的消息条数。
+        prefix_hashes 为调用方已计算的前缀哈希链；use_cache=False 时跳过内存缓存（账号池已确认各账号缓存均未命中）。
+        """
+        debug_print("开始查找匹配的会话")
+        
+        # 检查是否有AI回复历史
+        assistant_positions = [i for i, msg in enumerate(messages) if msg.get('role') == 'assistant']
+        if not assistant_positions:
+            debug_print("请求中没有AI回复历史，将创建新会话")
+            return None
+        last_position = assistant_positions[-1]
+        
+        debug_print("查找匹配...")
+        if prefix_hashes is None:
+            prefix_hashes = self.history_manager.message_prefix_hashes(messages)
+        
+        # 1. 最常见的情况是接着最新一轮继续，先查内存缓存
+        matched_session = self.session_cache.get(prefix_hashes[last_position]) if use_cache else None
+        if matched_session:
+            matched_session['matched_messages'] = last_position + 1
+            debug_print(f"缓存命中会话: {matched_session['chat_id']}")
+            return matched_session
+        
+        # 2. 在 SQLite 中按索引查找最长的已知前缀
+        candidates = [prefix_hashes[i] for i in assistant_positions]
+        # 多进程模式下其他工作进程尚未落盘的更新不可见；未命中时不等待，直接按新对话处理
+        found = self.history_manager.find_longest_prefix(candidates)
+        if found:
+            index, matched_session = found
+            position = assistant_positions[index]
+            if position == last_position:
+                self.session_cache.put(prefix_hashes[position], matched_session['chat_id'],
+                                       matched_session['current_response_id'])
+            matched_session['matched_messages'] = position + 1
+            debug_print(f"前缀匹配到会话: {matched_session['chat_id']}，覆盖 {position + 1}/{len(messages)} 条消息")
+            return matched_session
+        
+        # 3. 回退：只比较最新AI回复内容，仅限从云端同步、尚无前缀链的会话
+        #    （前缀链上的会话未命中时说明之前的消息已改变，如更换了 system 提示词，按新对话处理）
+        last_content = messages[last_position].get('content', '')
+        if not last_content:
+            debug_print("最新AI回复内容为空，将创建新会话")
+            return None
+        
+        matched_session = self.history_manager.get_session_by_last_content(last_content)
+        
+        if matched_session:
+            matched_session['matched_messages'] = last_position + 1
+            debug_print(f"找到匹配的会话: {matched_session['chat_id']}")
+            return matched_session
+        else:
+            debug_print("未找到匹配的会话，将创建新会话")
+            return None
+
+    def update_session_after_chat(self, chat_id: str, title: str, messages: list, 
+                                  current_response_id: str, assistant_content: str):
+        """聊天结束后更新会话记录"""
+        debug_print(f"更新会话记录: {chat_id}")
+        
+        current_time = int(time.time())
+        # messages 已包含本轮回复，其前缀哈希即本回合在前缀链上的节点
+        prefix_hash = self.history_manager.message_prefix_hashes(messages)[-1]
+        
+        # 去除工具调用、标准化与提交由后台写入线程完成，不占用请求线程
+        self.history_manager.queue_session_update(
+            chat_id=chat_id,
+            title=title,
+            created_at=current_time,
+            updated_at=current_time,
+            chat_type="t2t",
+            current_response_id=current_response_id,
+            last_assistant_content=assistant_content,
+            prefix_hash=prefix_hash
+        )
+        self.session_cache.put(prefix_hash, chat_id, current_response_id)
+
+    def forget_session(self, chat_id: str):
+        """删除会话的本地记录及其缓存"""
+        self.session_cache.invalidate_chat(chat_id)
+        self.history_manager.delete_session(chat_id)
+
+    def prepare_chat(self, openai_request: dict, trace: RequestTrace = None,
+                     matched_session=LOOKUP_SESSION) -> dict:
+        """
+        解析 OpenAI 请求并查找可续接的会话。
+        返回构建上游请求所需的上下文；未匹配到会话时 chat_id 为 None，需由调用方创建对话。
+        trace 为本次请求的追踪，保存在 ctx["trace"] 中供后续阶段记录 span。
+        matched_session 为账号池调度时已查到的会话（None 表示按新对话处理），此时不再重复查找。
+        """
+        # 解析 OpenAI 请求
+        model = openai_request.get("model", "qwen3")
+        messages = openai_request.get("messages", [])
+        # 映射模型
+        qwen_model_id = self._get_qwen_model_id(model)
+
+        debug_print(f"收到聊天请求，消息数量: {len(messages)}, 模型: {qwen_model_id}")
+        # debug_print(f"收到的完整请求: \n{openai_request}\n")
+
+        ctx = {
+            "received_at": time.perf_counter(),  # 用于统计首字节时间
+            "model": model,
+            "messages": messages,
+            "stream": openai_request.get("stream", False),
+            "reasoning_mode": reasoning_stream_mode(openai_request),
+            # 解析新增参数
+            "enable_thinking": openai_request.get("enable_thinking", True), # 默认启用思考
+            "thinking_budget": openai_request.get("thinking_budget", None), # 默认不指定
+            "qwen_model_id": qwen_model_id,
+            "chat_id": None,
+            "parent_id": None,
+            "user_input": "",
+            "trace": trace or NO_TRACE,
+        }
+        ctx["trace"].root.set("gen_ai.request.model", model).set("qwen.model_id", qwen_model_id) \
+            .set("qwen.stream", ctx["stream"]).set("qwen.messages", len(messages)) \
+            .set("qwen.reasoning_stream", ctx["reasoning_mode"])
+
+        # 查找匹配的现有会话
+        if matched_session is LOOKUP_SESSION:
+            started = time.perf_counter()
+            with ctx["trace"].span("find_matching_session") as span:
+                matched_session = self.find_matching_session(messages)
+                span.set("qwen.continuation", "hit" if matched_session else "miss")
+                if matched_session:
+                    span.set("qwen.matched_messages", matched_session['matched_messages'])
+            STAGE_SECONDS.observe(time.perf_counter() - started, "session_lookup", qwen_model_id)
+        elif matched_session:
+            ctx["trace"].root.set("qwen.matched_messages", matched_session['matched_messages'])
+        CONTINUATION_TOTAL.inc(qwen_model_id, "hit" if matched_session else "miss")
+        ctx["trace"].root.set("qwen.continuation", "hit" if matched_session else "miss")
+        
+        if matched_session:
+            # 使用现有会话进行增量聊天，从匹配到的回复处继续（可能是分支）
+            ctx["chat_id"] = matched_session['chat_id']
+            ctx["parent_id"] = matched_session['current_response_id']
+            
+            # 只发送会话尚未包含的新消息
+            suffix = messages[matched_session['matched_messages']:]
+            if len(suffix) == 1 and suffix[0].get('role') == 'user':
+                ctx["user_input"] = suffix[0].get('content', '')
+            elif suffix:
+                ctx["user_input"] = "\n\n".join([f"{msg['role']}: {msg['content']}" for msg in suffix])
+            else:
+                # 没有新消息时保持原有行为：取最新的用户消息
+                for msg in reversed(messages):
+                    if msg.get('role') == 'user':
+                        ctx["user_input"] = msg.get('content', '')
+                        break
+            
+            debug_print(f"使用现有会话 {ctx['chat_id']}，parent_id: {ctx['parent_id']}")
+            
+        else:
+            # 创建新会话，拼接所有消息
+            ctx["user_input"] = format_transcript(messages)
+            if PROMPT_COMPACTION:
+                self.compact_prompt(ctx)
+
+        ctx["trace"].root.set("qwen.chat_id", ctx["chat_id"]) \
+            .set("qwen.prompt.bytes", len(ctx["user_input"].encode('utf-8')))
+        return ctx
+
+    def prompt_budget(self, qwen_model_id: str) -> int:
+        """新对话提示词的 token 预算：优先使用配置，其次按上游模型信息中的上下文长度推算"""
+        if qwen_model_id in PROMPT_TOKEN_BUDGETS:
+            return PROMPT_TOKEN_BUDGETS[qwen_model_id]
+        meta = (self.models_info.get(qwen_model_id, {}).get('info') or {}).get('meta') or {}
+        context_length = meta.get('max_context_length')
+        if isinstance(context_length, int) and context_length > 0:
+            return int(context_length * PROMPT_CONTEXT_RATIO)
+        return PROMPT_TOKEN_BUDGET_DEFAULT
+
+    def compact_prompt(self, ctx: dict):
+        """按模型的 token 预算压缩新对话的完整历史，并在 ctx["prompt_compaction"] 中记录节省量"""
+        qwen_model_id = ctx["qwen_model_id"]
+        budget = self.prompt_budget(qwen_model_id)
+        original = ctx["user_input"]
+        original_tokens = estimate_tokens(original)
+        # 未超预算且没有重复 system 消息时不做任何改动
+        messages, report = compact_messages(ctx["messages"], budget if original_tokens > budget else float("inf"))
+        if not any(report.values()):
+            return
+        compacted = format_transcript(messages)
+        compacted_tokens = estimate_tokens(compacted)
+        saved_bytes = len(original.encode('utf-8')) - len(compacted.encode('utf-8'))
+        ctx["user_input"] = compacted
+        ctx["prompt_compaction"] = dict(report, budget=budget, tokens=compacted_tokens,
+                                        saved_tokens=original_tokens - compacted_tokens, saved_bytes=saved_bytes)
+        PROMPT_COMPACTED_TOTAL.inc(qwen_model_id)
+        PROMPT_SAVED_BYTES_TOTAL.inc(qwen_model_id, amount=saved_bytes)
+        PROMPT_SAVED_TOKENS_TOTAL.inc(qwen_model_id, amount=original_tokens - compacted_tokens)
+        debug_print(f"压缩新对话提示词: {ctx['prompt_compaction']}")
+
+    def build_completion_request(self, ctx: dict):
+        """根据聊天上下文构建上游补全请求，返回 (url, payload, headers)"""
+        chat_id = ctx["chat_id"]
+        parent_id = ctx["parent_id"]
+        qwen_model_id = ctx["qwen_model_id"]
+        thinking_budget = ctx["thinking_budget"]
+
+        # 准备请求负载
+        timestamp_ms = int(time.time() * 1000)
+        
+        # 构建 feature_config
+        feature_config = {
+            "output_schema": "phase"
+        }
+        if ctx["enable_thinking"]:
+            feature_config["thinking_enabled"] = True
+            # 如果提供了 thinking_budget 则使用，否则尝试从用户设置获取
+            if thinking_budget is not None:
+                feature_config["thinking_budget"] = thinking_budget
+            else:
+                # 尝试从用户设置中获取默认的 thinking_budget
+                default_budget = self.user_settings.get('model_config', {}).get(qwen_model_id, {}).get('thinking_budget')
+                if default_budget:
+                    feature_config["thinking_budget"] = default_budget
+        else:
+            feature_config["thinking_enabled"] = False
+
+        payload = {
+            "stream": True, # 始终使用流式以获取实时数据
+            "incremental_output": True,
+            "chat_id": chat_id,
+            "chat_mode": "normal",
+            "model": qwen_model_id,
+            "parent_id": parent_id,
+            "messages": [{
+                "fid": str(uuid.uuid4()),
+                "parentId": parent_id,
+                "childrenIds": [str(uuid.uuid4())],
+                "role": "user",
+                "content": ctx["user_input"],
+                "user_action": "chat",
+                "files": [],
+                "timestamp": timestamp_ms,
+                "models": [qwen_model_id],
+                "chat_type": "t2t",
+                "feature_config": feature_config,
+                "extra": {"meta": {"subChatType": "t2t"}},
+                "sub_chat_type": "t2t",
+                "parent_id": parent_id
+            }],
+            "timestamp": timestamp_ms
+        }
+
+        # 添加必要的头
+        headers = {
+            "x-accel-buffering": "no" # 对于流式响应很重要
+        }
+
+        url = f"{self.base_url}/api/v2/chat/completions?chat_id={chat_id}"
+        return url, payload, headers
+
+    def finish_chat(self, ctx: dict, translator: "ChatStreamTranslator"):
+        """聊天结束后记录阶段指标，并根据翻译结果更新会话记录"""
+        translator.close()
+        trace = ctx.get("trace", NO_TRACE)
+        translator.record_trace(trace)
+        with trace.span("finish_chat") as finish:
+            # 思考内容被截断的回复不写入缓存，以免之后按流式重放时给出不完整的思考过程
+            if ctx.get("cache_key") and translator.complete and translator.finish_reason != "error" \
+                    and not translator.reasoning_text.dropped_chars:
+                response_cache.put(ctx["cache_key"], translator.cache_entry())
+                RESPONSE_CACHE_TOTAL.inc("store")
+            if translator.complete:
+                # 完整回复的平均输出量，用于估算取消时节省的生成量
+                previous = self._output_deltas_ewma.get(ctx["qwen_model_id"])
+                observed = translator.output_deltas
+                self._output_deltas_ewma[ctx["qwen_model_id"]] = \
+                    observed if previous is None else previous * 0.9 + observed * 0.1
+            if translator.assistant_content and translator.current_response_id:
+                started = time.perf_counter()
+                assistant_content = translator.assistant_content.getvalue()
+                # 构建完整的消息历史
+                updated_messages = ctx["messages"].copy()
+                updated_messages.append({
+                    "role": "assistant",
+                    "content": assistant_content
+                })
+            
+                with trace.span("update_session_after_chat", parent=finish) as span:
+                    span.set("qwen.chat_id", ctx["chat_id"]).set("qwen.messages", len(updated_messages)) \
+                        .set("qwen.write_behind", SESSION_WRITE_BEHIND)
+                    self.update_session_after_chat(
+                        chat_id=ctx["chat_id"],
+                        title=f"OpenAI_API_对话_{int(time.time())}",
+                        messages=updated_messages,
+                        current_response_id=translator.current_response_id,
+                        assistant_content=assistant_content
+                    )
+                STAGE_SECONDS.observe(time.perf_counter() - started, "session_write", ctx["qwen_model_id"])
+
+    def cancel_chat(self, ctx: dict, translator: "ChatStreamTranslator"):
+        """
+        客户端中途断开后调用（上游连接已由调用方关闭）：记录取消指标，并在后台通知上游停止生成。
+        本轮回复不完整，客户端也没有收到完整内容，因此不写入会话记录，下一轮仍从上一条回复处续接。
+        """
+        translator.close()
+        translator.record_trace(ctx.get("trace", NO_TRACE), cancelled=True)
+        qwen_model_id = ctx["qwen_model_id"]
+        STREAMS_CANCELLED_TOTAL.inc(qwen_model_id, translator.phase)
+        expected = self._output_deltas_ewma.get(qwen_model_id)
+        if expected is not None and expected > translator.output_deltas:
+            CANCELLED_TOKENS_SAVED_TOTAL.inc(qwen_model_id, amount=round(expected - translator.output_deltas))
+        debug_print(f"客户端已断开，取消会话 {ctx['chat_id']} 的生成（{translator.phase} 阶段）")
+        if UPSTREAM_STOP_PATH and translator.current_response_id:
+            threading.Thread(target=self.stop_generation, daemon=True, name="upstream-stop",
+                             args=(ctx["chat_id"], translator.current_response_id)).start()
+
+    def stop_generation(self, chat_id: str, response_id: str) -> bool:
+        """调用上游的停止生成接口（尽力而为，失败只记录日志）"""
+        url = f"{self.base_url}{UPSTREAM_STOP_PATH}?chat_id={chat_id}"
+        try:
+            response = self._upstream_request("POST", url, json={"chat_id": chat_id, "response_id": response_id})
+            response.close()
+            debug_print(f"已通知上游停止生成: {response_id}")
+            return True
+        except requests.exceptions.RequestException as e:
+            debug_print(f"通知上游停止生成失败 {response_id}: {e}")
+            return False
+
+    def chat_completions(self, openai_request: dict, cache_key: str = None, trace: RequestTrace = None,
+                         matched_session=LOOKUP_SESSION):
+        """
+        执行聊天补全，模拟 OpenAI API。
+        返回流式生成器或非流式 JSON 响应；提供 cache_key 时完整结束的回复会写入响应缓存。
+        """
+        self._update_auth_header() # 确保 token 是最新的
+        
+        ctx = self.prepare_chat(openai_request, trace, matched_session)
+        ctx["cache_key"] = cache_key
+        if "prompt_compaction" in ctx and has_request_context():
+            g.prompt_compaction = ctx["prompt_compaction"]
+        if ctx["chat_id"] is None:
+            with ctx["trace"].span("create_chat") as span:
+                ctx["chat_id"] = self.acquire_chat(ctx["qwen_model_id"])
+                span.set("qwen.chat_id", ctx["chat_id"])
+            ctx["trace"].root.set("qwen.chat_id", ctx["chat_id"])
+            debug_print(f"创建新会话 {ctx['chat_id']}")
+
+        try:
+            url, payload, headers = self.build_completion_request(ctx)
+            qwen_model_id = ctx["qwen_model_id"]
+            translator = ChatStreamTranslator(ctx["chat_id"], ctx["model"], ctx["stream"], qwen_model_id,
+                                              keep_reasoning=cache_key is not None,
+                                              reasoning_mode=ctx["reasoning_mode"], started=ctx["received_at"])
+            
+            if ctx["stream"]:
+                # 流式请求
+                def generate():
+                    ACTIVE_STREAMS.inc(qwen_model_id)
+                    cancelled = False
+                    try:
+                        # 使用流式请求，并确保会话能正确处理连接
+                        with self._upstream_request("POST", url, qwen_model_id, json=payload,
+                                                    headers=headers, stream=True) as r:
+                            # 首 token 前上游沉默时 line 为 None，只用于发送保活注释
+                            interval = STREAM_KEEPALIVE_INTERVAL if UPSTREAM_WAIT_KEEPALIVE else 0
+                            with closing(iter_with_keepalive(r, interval)) as lines:
+                                for line in lines:
+                                    for chunk in translator.relay_line(line):
+                                        yield chunk
+                                    if translator.done:
+                                        break
+                            for chunk in translator.flush_pending():
+                                yield chunk
+                        self.health.record_success()
+                    except GeneratorExit:
+                        # 客户端断开时服务器关闭生成器，退出 with 时上游连接随之关闭，不再读完剩余输出
+                        cancelled = not translator.complete
+                        raise
+                    except requests.exceptions.RequestException as e:
+                        debug_print(f"流式请求失败: {e}")
+                        record_upstream_error(qwen_model_id, e)
+                        self.health.record_failure(e)
+                        # 发送一个错误块
+                        yield translator.error_chunk(e)
+                    finally:
+                        ACTIVE_STREAMS.dec(qwen_model_id)
+                        if cancelled:
+                            self.cancel_chat(ctx, translator)
+                        else:
+                            # 聊天结束后更新会话记录
+                            self.finish_chat(ctx, translator)
+
+                return generate()
+
+            else:
+                # 非流式请求: 聚合流式响应
+                with self._upstream_request("POST", url, qwen_model_id, json=payload,
+                                            headers=headers, stream=True) as r:
+                    for line in r.iter_lines():
+                        translator.feed_line(line)
+                        if translator.done:
+                            break
+                self.health.record_success()
+                
+                # 聊天结束后更新会话记录
+                self.finish_chat(ctx, translator)
+                return jsonify(translator.completion_response())
+
+        except requests.exceptions.RequestException as e:
+            debug_print(f"聊天补全失败: {e}")
+            record_upstream_error(ctx["qwen_model_id"], e)
+            self.health.record_failure(e)
+            # 返回 OpenAI 格式的错误
+            if isinstance(e, UpstreamUnavailable):
+                return jsonify(error_response(str(e), "upstream_unavailable")), 503
+            return jsonify(error_response(f"内部服务器错误: {str(e)}")), 500
+
+    def run_flight(self, openai_request: dict, flight: "InFlightRequest", cache_key: str = None,
+                   trace: RequestTrace = None, matched_session=LOOKUP_SESSION):
+        """
+        作为 single-flight 的驱动方执行一次聊天补全：准备会话后逐行发布上游输出，从不等待订阅者。
+        会话记录与响应缓存按这一次生成写入；所有订阅者在结束前离开时停止上游生成。
+        各阶段记录在发起请求 (leader) 的追踪中。
+        """
+        ctx = translator = error = None
+        try:
+            self._update_auth_header()
+            ctx = self.prepare_chat(openai_request, trace, matched_session)
+            ctx["cache_key"] = cache_key
+            if ctx["chat_id"] is None:
+                with ctx["trace"].span("create_chat") as span:
+                    ctx["chat_id"] = self.acquire_chat(ctx["qwen_model_id"])
+                    span.set("qwen.chat_id", ctx["chat_id"])
+                ctx["trace"].root.set("qwen.chat_id", ctx["chat_id"])
+                debug_print(f"创建新会话 {ctx['chat_id']}")
+            flight.start(ctx)
+            url, payload, headers = self.build_completion_request(ctx)
+            qwen_model_id = ctx["qwen_model_id"]
+            # 驱动方按非流式累积完整回复，供会话记录与响应缓存使用
+            translator = ChatStreamTranslator(ctx["chat_id"], ctx["model"], False, qwen_model_id,
+                                              keep_reasoning=cache_key is not None,
+                                              reasoning_mode="buffered", started=ctx["received_at"])
+            if not flight.cancelled:
+                with self._upstream_request("POST", url, qwen_model_id, json=payload,
+                                            headers=headers, stream=True) as r:
+                    for line in r.iter_lines():
+                        translator.feed_line(line)
+                        flight.publish(line)
+                        if translator.done or flight.cancelled:
+                            break
+                self.health.record_success()
+        except requests.exceptions.RequestException as e:
+            debug_print(f"single-flight 聊天补全失败: {e}")
+            if ctx is not None:
+                record_upstream_error(ctx["qwen_model_id"], e)
+            self.health.record_failure(e)
+            error = e
+        except Exception as e:
+            debug_print(f"single-flight 聊天补全出错: {e}")
+            error = e
+        finally:
+            try:
+                if translator is not None:
+                    if flight.cancelled and not translator.complete:
+                        self.cancel_chat(ctx, translator)
+                    else:
+                        self.finish_chat(ctx, translator)
+            finally:
+                single_flight.done(flight)
+                flight.finish(error)
+
+
+class TextBuffer:
+    """
+    按片段累积文本，取值时才拼接，避免对长回复反复字符串拼接。
+    可设置最多保留的字符数，超出部分丢弃并计数。
+    """
+
+    def __init__(self, max_chars: int = None):
+        self.max_chars = max_chars
+        self.dropped_chars = 0
+        self._parts = []
+        self._length = 0
+
+    def append(self, text: str):
+        if not text:
+            return
+        if self.max_chars is not None:
+            room = self.max_chars - self._length
+            if room <= 0:
+                self.dropped_chars += len(text)
+                return
+            if len(text) > room:
+                self.dropped_chars += len(text) - room
+                text = text[:room]
+        self._parts.append(text)
+        self._length += len(text)
+
+    def getvalue(self) -> str:
+        if len(self._parts) > 1:
+            # 拼接结果替换原片段，重复取值不再重新拼接
+            self._parts = ["".join(self._parts)]
+        return self._parts[0] if self._parts else ""
+
+    def clear(self):
+        self._parts = []
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def __bool__(self):
+        return self._length > 0
+
+
+def is_delta_line(line: bytes) -> bool:
+    """上游行是否为输出增量（而非 response.created 等开头的元数据）"""
+    return b'"choices"' in line
+
+
+def iter_with_keepalive(response: requests.Response, interval: float, until=is_delta_line):
+    """
+    逐行迭代上游流式响应，在上游开始输出增量（until 为真的第一行）之前，每隔 interval 秒没有新行时产出 None，
+    供调用方在首 token 前的沉默期间发送保活注释。
+    只有这段开头由一个短暂的读取线程读取；之后在调用方线程中直接迭代，不再经过队列。interval 为 0 时直接迭代。
+    调用方在此之前结束时，先关闭底层 socket 让读取线程退出，再由调用方关闭响应，避免两个线程同时读写同一个上游响应。
+    """
+    lines = response.iter_lines()
+    if not interval:
+        yield from lines
+        return
+    head = queue.Queue()
+
+    def read_head():
+        try:
+            for line in lines:
+                head.put(("item", line))
+                if until(line):
+                    head.put(("handoff", None))
+                    return
+            head.put(("end", None))
+        except Exception as e:
+            head.put(("error", e))
+
+    reader = threading.Thread(target=read_head, daemon=True, name="stream-head-reader")
+    reader.start()
+    try:
+        while True:
+            try:
+                kind, value = head.get(timeout=interval)
+            except queue.Empty:
+                yield None
+                continue
+            if kind == "item":
+                yield value
+            elif kind == "error":
+                raise value
+            else:
+                break
+    finally:
+        if reader.is_alive():
+            sock = getattr(response.raw.connection, "sock", None)
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            reader.join(timeout=UPSTREAM_CONNECT_TIMEOUT)
+    if kind == "handoff":
+        yield from lines
+
+
+class ChatStreamTranslator:
+    """
+    将上游 phase 格式的 SSE 流翻译为 OpenAI 格式。
+    同步（Flask）与异步（async_server.py）两条服务路径共用此逻辑。
+
+    上游行以 bytes 形式传入，不做整行解码；answer 阶段的流式块使用预先拼好的模板，
+    只把转义后的 content 填入其中，避免逐 token 构造字典再 json.dumps。
+    """
+
+    def __init__(self, chat_id: str, model: str, stream: bool, qwen_model_id: str = "",
+                 keep_reasoning: bool = False, reasoning_mode: str = REASONING_STREAM_MODE,
+                 started: float = None):
+        self.chat_id = chat_id
+        self.model = model
+        self.stream = stream
+        self.qwen_model_id = qwen_model_id  # 指标标签使用映射后的 Qwen 模型 ID
+        # 思考内容的输出方式：live 实时发送，buffered 附在第一个回答块中，dropped 不发送也不累积
+        self.reasoning_mode = reasoning_mode
+        self.finish_reason = "stop"
+        # 用于累积 thinking 阶段的内容；长度上限只作用于非流式聚合，流式的 buffered 模式随首个回答块完整发送
+        self.reasoning_text = TextBuffer(None if stream else REASONING_MAX_CHARS)
+        # 流式发送后 reasoning_text 会被清空；需要完整思考内容（如写入响应缓存）时另行保留已发送的部分
+        self.sent_reasoning = TextBuffer() if keep_reasoning else None
+        self.assistant_content = TextBuffer()  # 用于累积assistant回复内容
+        self.current_response_id = None  # 当前回复ID
+        self.usage_data = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+        self.done = False  # 是否已收到上游的 [DONE]
+        self.answer_finished = False  # 是否已收到 answer 阶段的结束块
+        # 同一个流内 id/created/model 不变，预先生成流式块模板
+        self.chunk_id = f"chatcmpl-{chat_id[:10]}"
+        self.created = int(time.time())
+        self._content_prefix = (
+            f'data: {{"id": {json.dumps(self.chunk_id)}, "object": "chat.completion.chunk", '
+            f'"created": {self.created}, "model": {json.dumps(self.model)}, '
+            f'"choices": [{{"index": 0, "delta": {{"content": '
+        )
+        self._content_suffix = '}, "finish_reason": null}]}\n\n'
+        self._reasoning_prefix = self._content_prefix[:-len('"content": ')] + '"reasoning_content": '
+        # 待合并发送的 answer 增量
+        self._pending = []
+        self._pending_chars = 0
+        self._last_flush = 0.0
+        # 阶段时间点与计数，流结束时一次性写入指标，避免逐 token 加锁
+        self._started = time.perf_counter()
+        self._received_at = started if started is not None else self._started  # 请求开始处理的时间
+        self._first_byte_at = None
+        self._first_data_at = None  # 向客户端发出第一个内容块的时间
+        self._think_started_at = None
+        self._answer_started_at = None
+        self._finished_at = None
+        self._think_deltas = 0
+        self._answer_deltas = 0
+        self._closed = False
+        self._last_emit = time.monotonic()  # 上次向客户端发送数据的时间，用于发送保活注释
+
+    def _chunk(self, delta: dict, finish_reason=None) -> str:
+        """构造一个 OpenAI 流式块的 SSE 文本"""
+        openai_chunk = {
+            "id": self.chunk_id,
+            "object": "chat.completion.chunk",
+            "created": self.created,
+            "model": self.model,
+            "choices": [{
+                "index": 0,
+                "delta": delta,
+                "finish_reason": finish_reason
+            }]
+        }
+        return f"data: {json.dumps(openai_chunk)}\n\n"
+
+    def _content_chunk(self, content: str) -> str:
+        """用模板构造包含 content 的流式块，如果累积了 reasoning_text，则一并附带"""
+        body = encode_basestring_ascii(content)
+        if self.reasoning_text:
+            body += ', "reasoning_content": ' + encode_basestring_ascii(self.reasoning_text.getvalue())
+            if self.sent_reasoning is not None:
+                self.sent_reasoning.append(self.reasoning_text.getvalue())
+            self.reasoning_text.clear() # 发送后清空
+        return self._content_prefix + body + self._content_suffix
+
+    def _reasoning_chunk(self, reasoning: str) -> str:
+        """用模板构造只包含 reasoning_content 的流式块（live 模式）"""
+        if self.sent_reasoning is not None:
+            self.sent_reasoning.append(reasoning)
+        return self._reasoning_prefix + encode_basestring_ascii(reasoning) + self._content_suffix
+
+    def flush_pending(self) -> list:
+        """发送尚未发出的合并增量"""
+        if not self._pending:
+            return []
+        content = "".join(self._pending)
+        self._pending = []
+        self._pending_chars = 0
+        self._last_flush = time.monotonic()
+        return [self._content_chunk(content)]
+
+    def relay_line(self, line) -> list:
+        """
+        流式转发一行上游数据；line 为 None 表示上游暂时没有输出。
+        长时间没有可发送的内容时，每隔 STREAM_KEEPALIVE_INTERVAL 秒插入一条 SSE 注释（客户端会忽略），
+        避免中间代理因空闲超时断开，同时使已断开的客户端在写入时尽早暴露。
+        """
+        chunks = self.feed_line(line) if line is not None else []
+        now = time.monotonic()
+        if chunks:
+            self._last_emit = now
+            if self._first_data_at is None:
+                self._first_data_at = time.perf_counter()
+        elif STREAM_KEEPALIVE_INTERVAL and now - self._last_emit >= STREAM_KEEPALIVE_INTERVAL:
+            self._last_emit = now
+            chunks = [": keep-alive\n\n"]
+        return chunks
+
+    @property
+    def phase(self) -> str:
+        """当前所处阶段：waiting（尚无输出）、think 或 answer"""
+        if self._answer_started_at is not None:
+            return "answer"
+        return "think" if self._think_started_at is not None else "waiting"
+
+    @property
+    def complete(self) -> bool:
+        """上游是否已输出完整回复（收到 [DONE] 或 answer 阶段的结束块）"""
+        return self.done or self.answer_finished
+
+    @property
+    def output_deltas(self) -> int:
+        """已从上游收到的思考与回答增量数"""
+        return self._think_deltas + self._answer_deltas
+
+    def feed_line(self, line: bytes) -> list:
+        """处理一行上游 SSE 数据，返回需要发送给客户端的 SSE 文本列表（非流式时始终为空）"""
+        if self._first_byte_at is None:
+            self._first_byte_at = time.perf_counter()
+            STAGE_SECONDS.observe(self._first_byte_at - self._started, "upstream_first_byte",
+                                  self.qwen_model_id)
+        # 检查标准的 SSE 前缀
+        if not line or not line.startswith(b"data: "):
+            return []
+        data_bytes = line[6:]  # 移除 'data: '
+        if data_bytes.strip() == b"[DONE]":
+            self.done = True
+            self._finished_at = time.perf_counter()
+            if not self.stream:
+                return []
+            # 发送最终的 done 消息块，包含 finish_reason
+            return self.flush_pending() + [self._chunk({}, self.finish_reason), "data: [DONE]\n\n"]
+        try:
+            data = json_loads(data_bytes)
+        except ValueError:
+            # 忽略无法解析的行
+            SSE_DECODE_ERRORS_TOTAL.inc(self.qwen_model_id)
+            return []
+
+        # 提取response_id
+        if "response.created" in data:
+            self.current_response_id = data["response.created"].get("response_id")
+            debug_print(f"获取到response_id: {self.current_response_id}")
+
+        if not data.get("choices"):
+            return []
+
+        # --- 清晰区分 think 和 answer 阶段 ---
+        delta = data["choices"][0].get("delta", {})
+        phase = delta.get("phase")
+        status = delta.get("status")
+        content = delta.get("content", "")
+        chunks = []
+
+        if phase == "think":
+            if self._think_started_at is None:
+                self._think_started_at = time.perf_counter()
+            if content:
+                self._think_deltas += 1
+        elif phase == "answer" or (phase is None and content):
+            if self._answer_started_at is None:
+                self._answer_started_at = time.perf_counter()
+            if content:
+                self._answer_deltas += 1
+
+        # 1. 处理 "think" 阶段
+        if phase == "think":
+            if status == "finished" or not content:
+                pass
+            elif self.reasoning_mode == "dropped":
+                if self.sent_reasoning is not None:
+                    self.sent_reasoning.append(content)  # 不发送，但写入缓存的回复保持完整
+            elif self.stream and self.reasoning_mode == "live":
+                chunks.append(self._reasoning_chunk(content))
+            else:
+                # buffered 模式与非流式请求只累积，随第一个回答块或最终响应一并发送
+                self.reasoning_text.append(content)
+
+        elif self.stream:
+            # 2. 处理 "answer" 阶段 或 无明确 phase 的内容 (兼容性)
+            if phase == "answer" or (phase is None and content):
+                self.assistant_content.append(content)  # 累积assistant回复
+                if not RELAY_BATCH_INTERVAL:
+                    # answer 阶段进行中不设 finish_reason
+                    chunks.append(self._content_chunk(content))
+                else:
+                    # 距上次发送不足一个时间窗口的小增量先合并，窗口到期或累积过多时再发送
+                    self._pending.append(content)
+                    self._pending_chars += len(content)
+                    if (self._pending_chars >= RELAY_BATCH_MAX_CHARS
+                            or time.monotonic() - self._last_flush >= RELAY_BATCH_INTERVAL):
+                        chunks.extend(self.flush_pending())
+
+        elif phase == "answer" and status != "finished":
+            # 非流式只聚合 "answer" 阶段的内容
+            self.assistant_content.append(content)
+
+        # 收集最后一次的 usage 信息
+        if "usage" in data:
+            qwen_usage = data["usage"]
+            self.usage_data = {
+                "prompt_tokens": qwen_usage.get("input_tokens", 0),
+                "completion_tokens": qwen_usage.get("output_tokens", 0),
+                "total_tokens": qwen_usage.get("total_tokens", 0),
+            }
+
+        # 3. 处理结束信号 (通常在 answer 阶段的最后一个块)
+        if status == "finished":
+            self.finish_reason = delta.get("finish_reason", "stop")
+            if phase == "answer":
+                self.answer_finished = True
+
+        return chunks
+
+    def close(self, stages: bool = True):
+        """
+        流结束时记录 think/answer 阶段耗时与转发量，可重复调用。
+        共享同一次上游生成的订阅者传入 stages=False，阶段指标只由驱动上游的一方记录。
+        """
+        if self._closed:
+            return
+        self._closed = True
+        end = self._finished_at or time.perf_counter()
+        if stages and self._think_started_at is not None:
+            STAGE_SECONDS.observe((self._answer_started_at or end) - self._think_started_at,
+                                  "think_phase", self.qwen_model_id)
+        if stages and self._answer_started_at is not None:
+            STAGE_SECONDS.observe(end - self._answer_started_at, "answer_phase", self.qwen_model_id)
+        if stages and self._think_deltas:
+            TOKENS_RELAYED_TOTAL.inc(self.qwen_model_id, "think", amount=self._think_deltas)
+        if stages and self._answer_deltas:
+            TOKENS_RELAYED_TOTAL.inc(self.qwen_model_id, "answer", amount=self._answer_deltas)
+        if self._first_data_at is not None:
+            STREAM_TTFB_SECONDS.observe(self._first_data_at - self._received_at, self.qwen_model_id,
+                                        self.reasoning_mode)
+
+    def record_trace(self, trace: RequestTrace, cancelled: bool = False):
+        """
+        按流中记录的时间点补记上游补全请求的 span：从发出请求到流结束，
+        其中 think_phase/answer_phase 分别从第一个思考增量、第一个回答增量开始，首字节等时间点记为事件。
+        """
+        if not trace.sampled:
+            return
+        end = self._finished_at or time.perf_counter()
+        outcome = "cancelled" if cancelled else ("error" if self.finish_reason == "error" else
+                                                 "complete" if self.complete else "incomplete")
+        upstream = trace.add_span("POST /api/v2/chat/completions", self._started, end, kind=SPAN_KIND_CLIENT,
+                                  attributes={"qwen.chat_id": self.chat_id,
+                                              "qwen.response_id": self.current_response_id,
+                                              "qwen.outcome": outcome,
+                                              "qwen.think_deltas": self._think_deltas,
+                                              "qwen.answer_deltas": self._answer_deltas})
+        upstream.add_event("first_byte", self._first_byte_at)
+        upstream.add_event("first_think_delta", self._think_started_at)
+        upstream.add_event("first_answer_delta", self._answer_started_at)
+        if self._think_started_at is not None:
+            trace.add_span("think_phase", self._think_started_at, self._answer_started_at or end, parent=upstream,
+                           attributes={"qwen.deltas": self._think_deltas})
+        if self._answer_started_at is not None:
+            trace.add_span("answer_phase", self._answer_started_at, end, parent=upstream,
+                           attributes={"qwen.deltas": self._answer_deltas})
+        trace.root.set("qwen.chat_id", self.chat_id).set("qwen.outcome", outcome) \
+            .set("gen_ai.response.finish_reasons", self.finish_reason) \
+            .set("gen_ai.usage.input_tokens", self.usage_data["prompt_tokens"]) \
+            .set("gen_ai.usage.output_tokens", self.usage_data["completion_tokens"])
+        trace.root.add_event("first_data", self._first_data_at)
+
+    def cache_entry(self) -> dict:
+        """完整回复的可缓存内容，用于之后按相同格式重放"""
+        reasoning = self.reasoning_text.getvalue()
+        if self.sent_reasoning:
+            reasoning = self.sent_reasoning.getvalue() + reasoning
+        return {
+            "chat_id": self.chat_id,
+            "content": self.assistant_content.getvalue(),
+            "reasoning_content": reasoning,
+            "finish_reason": self.finish_reason,
+            "usage": self.usage_data,
+        }
+
+    def replay_chunks(self, content: str) -> list:
+        """
+        把一段完整回复按流式响应的格式输出：若干 content 块、结束块与 [DONE]。
+        思考内容按 reasoning_mode 处理：live 时先单独发送，buffered 时附在首个 content 块中。
+        """
+        chunks = []
+        if self.reasoning_mode == "live" and self.reasoning_text:
+            chunks.append(self._reasoning_chunk(self.reasoning_text.getvalue()))
+            self.reasoning_text.clear()
+        pieces = [content[i:i + RELAY_BATCH_MAX_CHARS] for i in range(0, len(content), RELAY_BATCH_MAX_CHARS)]
+        chunks.extend(self._content_chunk(piece) for piece in pieces or [""])
+        return chunks + [self._chunk({}, self.finish_reason), "data: [DONE]\n\n"]
+
+    def error_chunk(self, e: Exception) -> str:
+        """构造流式传输出错时发送的错误块"""
+        error_chunk = {
+            "id": f"chatcmpl-error",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": self.model,
+            "choices": [{
+                "index": 0,
+                "delta": {"content": f"Error during streaming: {str(e)}"},
+                "finish_reason": "error"
+            }]
+        }
+        return f"data: {json.dumps(error_chunk)}\n\n"
+
+    def completion_response(self) -> dict:
+        """构造非流式的 OpenAI 响应"""
+        openai_response = {
+            "id": f"chatcmpl-{self.chat_id[:10]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": self.model,
+            "choices": [{
+                "index": 0,
+                "message": {
+                    "role": "assistant",
+                    "content": self.assistant_content.getvalue()
+                },
+                "finish_reason": self.finish_reason
+            }],
+            "usage": self.usage_data
+        }
+        
+        # 在非流式响应中添加 reasoning_content
+        if self.reasoning_text:
+            openai_response["choices"][0]["message"]["reasoning_content"] = self.reasoning_text.getvalue()
+        
+        return openai_response
+
+
+class ResponseCache:
+    """
+    完全相同请求的回复缓存，分为内存与磁盘两层，均按总字节数淘汰最久未使用的回复。
+    键为模型、消息、enable_thinking 与 thinking_budget 的规范化哈希；只缓存完整结束的回复。
+    磁盘层每个回复一个文件，多进程共用同一目录。
+    """
+
+    def __init__(self, enabled: bool = RESPONSE_CACHE, memory_bytes: int = RESPONSE_CACHE_MEMORY_BYTES,
+                 directory: str = RESPONSE_CACHE_DIR, disk_bytes: int = RESPONSE_CACHE_DISK_BYTES,
+                 ttl: float = RESPONSE_CACHE_TTL):
+        self.enabled = enabled
+        self.memory_limit = memory_bytes
+        self.directory = directory
+        self.disk_limit = disk_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()  # key -> (entry, size)
+        self._memory_bytes = 0
+        self._disk_bytes = None  # 首次写入时扫描目录得到
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    @staticmethod
+    def request_key(openai_request: dict, qwen_model_id: str) -> str:
+        """请求的规范化哈希，参数缺省值与 prepare_chat 一致"""
+        canonical = json.dumps({
+            "model": qwen_model_id,
+            "messages": openai_request.get("messages", []),
+            "enable_thinking": openai_request.get("enable_thinking", True),
+            "thinking_budget": openai_request.get("thinking_budget", None),
+        }, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def parse_cache_control(value: str):
+        """
+        按请求头 Cache-Control 返回 (可读缓存, 可写缓存)：
+        no-store 既不读也不写；no-cache 不读取缓存，但用新回复刷新缓存。
+        """
+        directives = {directive.strip().lower() for directive in (value or "").split(",")}
+        if "no-store" in directives:
+            return False, False
+        if "no-cache" in directives:
+            return False, True
+        return True, True
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key: str):
+        """查找缓存，返回 (回复, 命中层 memory/disk)，未命中时返回 (None, None)"""
+        now = time.time()
+        with self._lock:
+            item = self._memory.get(key)
+            if item is not None:
+                if now - item[0]["created_at"] < self.ttl:
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return item[0], "memory"
+                self._memory_bytes -= item[1]
+                del self._memory[key]
+        entry = self._read_disk(key, now)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None, None
+            self.disk_hits += 1
+        self._remember(key, entry)
+        return entry, "disk"
+
+    def _read_disk(self, key: str, now: float):
+        if not self.directory:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                entry = json_loads(f.read())
+        except (OSError, ValueError):
+            return None
+        if now - entry.get("created_at", 0) >= self.ttl:
+            self._remove_file(path)
+            return None
+        try:
+            os.utime(path)  # 用修改时间记录最近使用，磁盘淘汰时据此排序
+        except OSError:
+            pass
+        return entry
+
+    def put(self, key: str, entry: dict):
+        """写入两层缓存"""
+        entry = dict(entry, created_at=time.time())
+        body = json.dumps(entry, ensure_ascii=False).encode('utf-8')
+        self._remember(key, entry, len(body))
+        with self._lock:
+            self.stores += 1
+        if self.directory:
+            self._write_disk(key, body)
+
+    def _remember(self, key: str, entry: dict, size: int = None):
+        """放入内存层并按容量淘汰"""
+        if size is None:
+            size = len(entry.get("content", "")) + len(entry.get("reasoning_content", "")) + 256
+        with self._lock:
+            previous = self._memory.pop(key, None)
+            if previous is not None:
+                self._memory_bytes -= previous[1]
+            self._memory[key] = (entry, size)
+            self._memory_bytes += size
+            while self._memory_bytes > self.memory_limit and self._memory:
+                _, (_, evicted_size) = self._memory.popitem(last=False)
+                self._memory_bytes -= evicted_size
+                self.evictions += 1
+
+    def _write_disk(self, key: str, body: bytes):
+        """先写临时文件再改名，其他进程不会读到写了一半的文件"""
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(body)
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            debug_print(f"写入响应缓存失败: {e}")
+            return
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = self._scan_disk()[1]
+            else:
+                self._disk_bytes += len(body)
+            over = self._disk_bytes > self.disk_limit
+        if over:
+            self._evict_disk()
+
+    def _scan_disk(self):
+        """返回 ([(最近使用时间, 大小, 路径)], 总字节数)"""
+        files = []
+        try:
+            with os.scandir(self.directory) as it:
+                for item in it:
+                    if item.name.endswith(".json"):
+                        try:
+                            stat = item.stat()
+                        except OSError:
+                            continue
+                        files.append((stat.st_mtime, stat.st_size, item.path))
+        except OSError:
+            pass
+        return files, sum(size for _, size, _ in files)
+
+    def _evict_disk(self):
+        """重新扫描目录（包含其他进程写入的文件），从最久未使用的开始删除到容量的 90%"""
+        files, total = self._scan_disk()
+        target = self.disk_limit * 0.9
+        for _, size, path in sorted(files):
+            if total <= target:
+                break
+            if self._remove_file(path):
+                total -= size
+                with self._lock:
+                    self.evictions += 1
+        with self._lock:
+            self._disk_bytes = total
+
+    @staticmethod
+    def _remove_file(path: str) -> bool:
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+    def record_bypass(self):
+        with self._lock:
+            self.bypasses += 1
+
+    @staticmethod
+    def replay(entry: dict, model: str, stream: bool, reasoning_mode: str = REASONING_STREAM_MODE):
+        """按请求的格式重放缓存的回复：流式返回 SSE 文本列表，非流式返回响应字典"""
+        translator = ChatStreamTranslator(entry["chat_id"], model, stream, reasoning_mode=reasoning_mode)
+        translator.finish_reason = entry["finish_reason"]
+        translator.usage_data = entry["usage"]
+        if reasoning_mode != "dropped":
+            translator.reasoning_text.append(entry["reasoning_content"])
+        if stream:
+            return translator.replay_chunks(entry["content"])
+        translator.assistant_content.append(entry["content"])
+        return translator.completion_response()
+
+    def stats(self) -> dict:
+        """返回两层缓存的容量与命中统计"""
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "memory": {"entries": len(self._memory), "bytes": self._memory_bytes,
+                           "limit_bytes": self.memory_limit},
+                "disk": {"directory": self.directory, "bytes": self._disk_bytes,
+                         "limit_bytes": self.disk_limit},
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "bypasses": self.bypasses,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "hit_ratio": round((self.memory_hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+                "memory_hit_ratio": round(self.memory_hits / lookups, 4) if lookups else 0.0,
+            }
+
+response_cache = ResponseCache()
+
+
+def _resolve_future(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class InFlightRequest:
+    """
+    一次正在进行、可被相同请求共享的上游生成（single-flight）。
+    驱动方把上游原始行追加到只增不减的列表中；每个订阅者按自己的读取位置从头重放，
+    用自己的翻译器按各自的 stream / reasoning_stream 参数输出。追加从不等待订阅者，慢订阅者不会拖慢其他人。
+    同步订阅者在条件变量上等待，异步订阅者通过 poll 取得在新内容到达时完成的 future。
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self.ctx = None  # 驱动方准备好的会话上下文，就绪前为 None
+        self.lines = []
+        self.finished = False
+        self.error = None
+        self.cancelled = False  # 所有订阅者都已离开，驱动方应停止上游生成
+        self.subscribers = 0
+        self._cond = threading.Condition()
+        self._async_waiters = []
+
+    def _notify(self):
+        self._cond.notify_all()
+        waiters, self._async_waiters = self._async_waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_resolve_future, future)
+
+    def start(self, ctx: dict):
+        """会话已准备好，订阅者可以开始构造各自的翻译器"""
+        with self._cond:
+            self.ctx = ctx
+            self._notify()
+
+    def publish(self, line: bytes):
+        with self._cond:
+            self.lines.append(line)
+            self._notify()
+
+    def finish(self, error: Exception = None):
+        """上游生成结束；error 非空时订阅者在重放完已有内容后收到该异常。重复调用只保留第一次的结果"""
+        with self._cond:
+            if self.finished:
+                return
+            self.finished = True
+            self.error = error
+            self._notify()
+
+    def wait_ready(self) -> dict:
+        """等待驱动方准备好会话并返回上下文；准备失败时抛出对应的异常"""
+        with self._cond:
+            self._cond.wait_for(lambda: self.ctx is not None or self.finished)
+            if self.ctx is None:
+                raise self.error or RuntimeError("single-flight 驱动方未能准备会话")
+            return self.ctx
+
+    def poll(self, index: int, loop):
+        """
+        非阻塞读取：返回 (index 之后的行, 是否结束, 异常, future)。
+        没有新内容时 future 在下一次就绪、追加或结束时完成，供异步订阅者等待。
+        """
+        with self._cond:
+            lines = self.lines[index:]
+            if lines or self.finished:
+                return lines, self.finished, self.error, None
+            future = loop.create_future()
+            self._async_waiters.append((loop, future))
+            return lines, False, None, future
+
+    def iter_lines(self, keepalive: float = 0):
+        """
+        从头重放上游行（同步订阅者使用），等待新行超过 keepalive 秒时产出 None 以便发送保活注释；
+        上游出错时在重放完已有内容后抛出异常。
+        """
+        index = 0
+        while True:
+            with self._cond:
+                if index >= len(self.lines) and not self.finished:
+                    self._cond.wait(keepalive or None)
+                lines = self.lines[index:]
+                finished, error = self.finished, self.error
+            index += len(lines)
+            if not lines and not finished:
+                yield None
+                continue
+            yield from lines
+            if finished:
+                if error is not None:
+                    raise error
+                return
+
+
+class SingleFlightGroup:
+    """
+    按规范化请求哈希合并同时进行的相同请求：第一个请求成为驱动方并访问上游，
+    之后的相同请求作为订阅者加入；生成结束后即移出，之后的相同请求重新访问上游（或命中响应缓存）。
+    """
+
+    def __init__(self, enabled: bool = SINGLE_FLIGHT):
+        self.enabled = enabled
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.joined = 0
+        self.cancelled = 0
+
+    def join(self, key: str):
+        """返回 (InFlightRequest, 是否为驱动方)；调用方结束后须调用 leave"""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None and not flight.cancelled:
+                flight.subscribers += 1
+                self.joined += 1
+                SINGLE_FLIGHT_TOTAL.inc("joined")
+                return flight, False
+            flight = InFlightRequest(key)
+            flight.subscribers = 1
+            self._flights[key] = flight
+            self.leaders += 1
+            SINGLE_FLIGHT_TOTAL.inc("leader")
+            return flight, True
+
+    def leave(self, flight: InFlightRequest):
+        """订阅者离开；最后一个订阅者在生成结束前离开时标记取消，由驱动方停止上游生成"""
+        with self._lock:
+            flight.subscribers -= 1
+            if flight.subscribers <= 0 and not flight.finished and not flight.cancelled:
+                flight.cancelled = True
+                self.cancelled += 1
+                self._discard(flight)
+
+    def done(self, flight: InFlightRequest):
+        """驱动方结束后调用，之后的相同请求不再加入这次生成"""
+        with self._lock:
+            self._discard(flight)
+
+    def _discard(self, flight: InFlightRequest):
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"enabled": self.enabled, "in_flight": len(self._flights), "leaders": self.leaders,
+                    "joined": self.joined, "cancelled": self.cancelled}
+
+single_flight = SingleFlightGroup()
+
+
+class BatchRunner:
+    """
+    OpenAI 风格的离线批处理：每个任务是 BATCH_DIR 下的一个目录，包含 input.jsonl、逐条追加结果的 output.jsonl
+    与 state.json。磁盘是唯一的状态来源，任一工作进程都可以创建、查询与取消任务（取消通过标记文件传递），
+    只有一个进程中的后台线程负责执行。请求以非流式方式经 AccountPool.chat_completions 执行，
+    重启后跳过 output.jsonl 中已有结果的请求，从中断处继续。
+    """
+
+    ENDPOINT = "/v1/chat/completions"
+
+    def __init__(self, pool, app, directory: str = BATCH_DIR, concurrency: int = BATCH_CONCURRENCY):
+        self.pool = pool
+        self.app = app
+        self.directory = directory
+        self.concurrency = concurrency
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory)
+
+    def _path(self, job_id: str, name: str = "") -> str:
+        return os.path.join(self.directory, job_id, name)
+
+    def _read_state(self, job_id: str):
         try:
-            # 获取用户信息
-            user_info_res = self.session.get(f"{self.base_url}/api/v1/auths/")
-            user_info_res.raise_for_status()
-            self.user_info = user_info_res.json()
+            with open(self._path(job_id, "state.json"), "rb") as f:
+                return json_loads(f.read())
+        except (OSError, ValueError):
+            return None
 
-            # 获取模型列表
-            models_res = self.session.get(f"{self.base_url}/api/models")
-            models_res.raise_for_status()
-            self.models_info = {model['id']: model for model in models_res.json()['data']}
+    def _write_state(self, state: dict):
+        # 先写临时文件再替换，其他进程不会读到写了一半的状态
+        path = self._path(state["id"], "state.json")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
 
-            # 获取用户设置
-            settings_res = self.session.get(f"{self.base_url}/api/v2/users/user/settings")
-            settings_res.raise_for_status()
-            self.user_settings = settings_res.json()['data']
+    def _cancel_requested(self, job_id: str) -> bool:
+        return os.path.exists(self._path(job_id, "cancel"))
 
-        except requests.exceptions.RequestException as e:
-            print(f"客户端初始化失败: {e}")
+    @classmethod
+    def parse_request(cls, line: bytes, number: int):
+        """
+        解析输入文件中的一行，返回 (custom_id, 请求体)。
+        支持 OpenAI Batch API 的输入格式（custom_id/method/url/body），也可以直接是请求体；
+        未提供 custom_id 时使用 request-<行号>。格式错误时抛出 ValueError。
+        """
+        try:
+            item = json_loads(line)
+        except ValueError:
+            raise ValueError(f"第 {number} 行不是有效的 JSON")
+        if not isinstance(item, dict):
+            raise ValueError(f"第 {number} 行不是 JSON 对象")
+        custom_id = None
+        if "body" in item:
+            url = item.get("url", cls.ENDPOINT)
+            if url != cls.ENDPOINT:
+                raise ValueError(f"第 {number} 行: 不支持的 url {url}，只支持 {cls.ENDPOINT}")
+            custom_id, item = item.get("custom_id"), item["body"]
+        if not isinstance(item, dict) or not isinstance(item.get("messages"), list):
+            raise ValueError(f"第 {number} 行缺少 messages")
+        return (str(custom_id) if custom_id is not None else f"request-{number}"), item
+
+    def _iter_input(self, job_id: str):
+        with open(self._path(job_id, "input.jsonl"), "rb") as f:
+            for number, line in enumerate(f, 1):
+                if line.strip():
+                    yield self.parse_request(line, number)
+
+    def create(self, chunks) -> dict:
+        """保存上传的 JSONL（bytes 片段的可迭代对象）并校验，返回任务描述；格式错误时抛出 ValueError"""
+        job_id = f"batch_{uuid.uuid4().hex}"
+        os.makedirs(self._path(job_id), exist_ok=True)
+        try:
+            with open(self._path(job_id, "input.jsonl"), "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            seen = set()
+            for custom_id, _body in self._iter_input(job_id):
+                if custom_id in seen:
+                    raise ValueError(f"custom_id 重复: {custom_id}")
+                seen.add(custom_id)
+                if len(seen) > BATCH_MAX_REQUESTS:
+                    raise ValueError(f"请求数超过上限 {BATCH_MAX_REQUESTS}")
+            if not seen:
+                raise ValueError("输入文件中没有请求")
+        except ValueError:
+            shutil.rmtree(self._path(job_id), ignore_errors=True)
             raise
+        state = {
+            "id": job_id,
+            "object": "batch",
+            "endpoint": self.ENDPOINT,
+            "status": "in_progress",
+            "created_at": int(time.time()),
+            "in_progress_at": None,
+            "completed_at": None,
+            "cancelled_at": None,
+            "failed_at": None,
+            "errors": None,
+            "request_counts": {"total": len(seen), "completed": 0, "failed": 0},
+        }
+        self._write_state(state)
+        self._wakeup.set()
+        debug_print(f"创建批处理任务 {job_id}，共 {len(seen)} 个请求")
+        return self.describe(state)
 
-    def _update_auth_header(self):
-        """更新会话中的认证头"""
-        self.session.headers.update({"authorization": f"Bearer {self.auth_token}"})
+    def describe(self, state: dict) -> dict:
+        """返回给客户端的任务描述：已请求取消的任务显示为 cancelling，并附带结果文件的下载地址"""
+        state = dict(state)
+        if state["status"] == "in_progress" and self._cancel_requested(state["id"]):
+            state["status"] = "cancelling"
+        state["output_url"] = f"/v1/batches/{state['id']}/output"
+        return state
 
-    def sync_history_from_cloud(self):
-        """从云端同步历史记录到本地数据库"""
-        debug_print("开始从云端同步历史记录")
-        self._update_auth_header()
-        
+    def get(self, job_id: str):
+        state = self._read_state(os.path.basename(job_id))
+        return self.describe(state) if state else None
+
+    def list(self) -> list:
+        """按创建时间倒序列出全部任务"""
         try:
-            # 清空本地记录
-            self.history_manager.clear_all_sessions()
-            
-            page = 1
-            while True:
-                # 获取历史会话列表
-                list_url = f"{self.base_url}/api/v2/chats/?page={page}"
-                response = self.session.get(list_url)
-                response.raise_for_status()
-                data = response.json()
-                
-                if not data.get('success') or not data.get('data'):
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        states = [state for state in map(self._read_state, names) if state]
+        return [self.describe(state) for state in sorted(states, key=lambda s: s["created_at"], reverse=True)]
+
+    def cancel(self, job_id: str):
+        """请求取消任务，正在执行的请求完成后停止；已结束的任务保持原状态"""
+        state = self._read_state(os.path.basename(job_id))
+        if state is None:
+            return None
+        if state["status"] == "in_progress":
+            open(self._path(state["id"], "cancel"), "w").close()
+            self._wakeup.set()
+        return self.describe(state)
+
+    def output_path(self, job_id: str):
+        path = self._path(os.path.basename(job_id), "output.jsonl")
+        return path if os.path.exists(path) else None
+
+    def start(self):
+        """启动后台执行线程（多进程模式下只在一个工作进程中启动），并继续执行上次未完成的任务"""
+        if not self.enabled or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, daemon=True, name="batch-runner")
+        self._thread.start()
+
+    def close(self):
+        """停止后台线程；进行中的任务保持 in_progress，下次启动时继续"""
+        self._stop.set()
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            pending = [state for state in self.list() if state["status"] in ("in_progress", "cancelling")]
+            if not pending:
+                self._wakeup.wait(BATCH_POLL_INTERVAL)
+                self._wakeup.clear()
+                continue
+            state = self._read_state(min(pending, key=lambda s: s["created_at"])["id"])
+            if state is None:
+                continue
+            try:
+                self._run_job(state)
+            except Exception as e:
+                debug_print(f"批处理任务 {state['id']} 失败: {e}")
+                state.update(status="failed", failed_at=int(time.time()), errors={"message": str(e)})
+                self._write_state(state)
+
+    def _load_checkpoint(self, job_id: str):
+        """
+        读取已写入的结果，返回 (已有结果的 custom_id 集合, 成功数, 失败数)。
+        进程中断时最后一行可能只写了一半，将其截掉，该请求会重新执行。
+        """
+        path = self._path(job_id, "output.jsonl")
+        done, completed, failed, valid_bytes = set(), 0, 0, 0
+        if not os.path.exists(path):
+            return done, completed, failed
+        with open(path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
                     break
-                
-                sessions = data['data']
-                debug_print(f"第 {page} 页获取到 {len(sessions)} 个会话")
-                
-                if not sessions:
+                try:
+                    record = json_loads(line)
+                except ValueError:
                     break
-                
-                # 获取每个会话的详细信息
-                for session in sessions:
-                    chat_id = session['id']
-                    try:
-                        detail_url = f"{self.base_url}/api/v2/chats/{chat_id}"
-                        detail_response = self.session.get(detail_url)
-                        detail_response.raise_for_status()
-                        detail_data = detail_response.json()
-                        
-                        if not detail_data.get('success'):
-                            continue
-                        
-                        chat_detail = detail_data['data']
-                        messages = chat_detail.get('chat', {}).get('messages', [])
-                        
-                        # 提取最新的AI回复内容
-                        last_assistant_content = ""
-                        for msg in reversed(messages):
-                            if msg.get('role') == 'assistant':
-                                # 从content_list中提取内容
-                                content_list = msg.get('content_list', [])
-                                if content_list:
-                                    last_assistant_content = content_list[-1].get('content', '')
-                                else:
-                                    last_assistant_content = msg.get('content', '')
-                                break
-                        
-                        # 保存到本地数据库
-                        current_response_id = chat_detail.get('currentId', '')
-                        
-                        self.history_manager.update_session(
-                            chat_id=chat_id,
-                            title=session.get('title', ''),
-                            created_at=session.get('created_at', 0),
-                            updated_at=session.get('updated_at', 0),
-                            chat_type=session.get('chat_type', ''),
-                            current_response_id=current_response_id,
-                            last_assistant_content=last_assistant_content
-                        )
-                        
-                    except Exception as e:
-                        debug_print(f"获取会话 {chat_id} 详细信息失败: {e}")
-                        continue
-                
-                page += 1
-                
-            debug_print("历史记录同步完成")
-            
-        except Exception as e:
-            debug_print(f"同步历史记录失败: {e}")
+                valid_bytes += len(line)
+                done.add(record["custom_id"])
+                if record["response"]["status_code"] < 400:
+                    completed += 1
+                else:
+                    failed += 1
+        if valid_bytes != os.path.getsize(path):
+            os.truncate(path, valid_bytes)
+        return done, completed, failed
 
-    def _get_qwen_model_id(self, openai_model: str) -> str:
-        """将 OpenAI 模型名称映射到 Qwen 模型 ID"""
-        # 如果直接匹配到 key，则使用映射值；否则尝试看模型 ID 是否直接存在于 Qwen 模型列表中；最后回退到默认模型
-        mapped_id = MODEL_MAP.get(openai_model)
-        if mapped_id and mapped_id in self.models_info:
-            return mapped_id
-        elif openai_model in self.models_info:
-            return openai_model # OpenAI 模型名恰好与 Qwen ID 相同
+    def _run_job(self, state: dict):
+        job_id = state["id"]
+        done, completed, failed = self._load_checkpoint(job_id)
+        state["request_counts"].update(completed=completed, failed=failed)
+        if not state["in_progress_at"]:
+            state["in_progress_at"] = int(time.time())
+        self._write_state(state)
+        if done:
+            debug_print(f"继续执行批处理任务 {job_id}，跳过已完成的 {len(done)} 个请求")
+
+        slots = threading.BoundedSemaphore(self.concurrency)
+        executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="batch")
+        last_write = [time.monotonic()]
+        with open(self._path(job_id, "output.jsonl"), "a", encoding="utf-8") as output:
+            try:
+                for custom_id, body in self._iter_input(job_id):
+                    if custom_id in done:
+                        continue
+                    if not self._acquire_slot(slots, job_id):
+                        break
+                    future = executor.submit(self._run_request, state, output, last_write, custom_id, body)
+                    future.add_done_callback(lambda _future: slots.release())
+            finally:
+                # 停止服务时不等待进行中的请求，下次启动时重新执行
+                stopping = self._stop.is_set()
+                executor.shutdown(wait=not stopping, cancel_futures=stopping)
+        if self._stop.is_set():
+            self._write_state(state)
+            return
+        now = int(time.time())
+        if self._cancel_requested(job_id):
+            state.update(status="cancelled", cancelled_at=now)
         else:
-            print(f"模型 '{openai_model}' 未找到或未映射，使用默认模型 'qwen3-235b-a22b'")
-            return "qwen3-235b-a22b" # 最可靠的回退选项
+            state.update(status="completed", completed_at=now)
+        self._write_state(state)
+        counts = state["request_counts"]
+        debug_print(f"批处理任务 {job_id} {state['status']}: 成功 {counts['completed']}，失败 {counts['failed']}")
 
-    def create_chat(self, model_id: str, title: str = "新对话") -> str:
-        """创建一个新的对话"""
-        self._update_auth_header() # 确保 token 是最新的
-        url = f"{self.base_url}/api/v2/chats/new"
-        payload = {
-            "title": title,
-            "models": [model_id],
-            "chat_mode": "normal",
-            "chat_type": "t2t", # Text to Text
-            "timestamp": int(time.time() * 1000)
+    def _acquire_slot(self, slots: threading.BoundedSemaphore, job_id: str) -> bool:
+        """等待空闲的执行槽，期间照常响应停止与取消；停止或取消时返回 False"""
+        while not (self._stop.is_set() or self._cancel_requested(job_id)):
+            if slots.acquire(timeout=BATCH_POLL_INTERVAL):
+                return True
+        return False
+
+    def _run_request(self, state: dict, output, last_write: list, custom_id: str, body: dict):
+        status_code, response_body = self._execute(body)
+        record = {
+            "id": f"batch_req_{uuid.uuid4().hex}",
+            "custom_id": custom_id,
+            "response": {"status_code": status_code, "body": response_body},
+            "error": None,
         }
-        try:
-            response = self.session.post(url, json=payload)
-            response.raise_for_status()
-            chat_id = response.json()['data']['id']
-            debug_print(f"成功创建对话: {chat_id}")
-            return chat_id
-        except requests.exceptions.RequestException as e:
-            debug_print(f"创建对话失败: {e}")
-            raise
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        result = "completed" if status_code < 400 else "failed"
+        BATCH_REQUESTS_TOTAL.inc(result)
+        with self._lock:
+            output.write(line)
+            output.flush()
+            state["request_counts"][result] += 1
+            # 进度每秒最多写入一次，任务结束时再写入最终结果
+            if time.monotonic() - last_write[0] >= 1.0:
+                last_write[0] = time.monotonic()
+                self._write_state(state)
 
-    def delete_chat(self, chat_id: str):
-        """删除一个对话"""
-        self._update_auth_header() # 确保 token 是最新的
-        url = f"{self.base_url}/api/v2/chats/{chat_id}"
-        
+    def _execute(self, body: dict):
+        """执行一个非流式请求，返回 (状态码, 响应体)；连接失败、429 与 5xx 按 BATCH_MAX_RETRIES 退避重试"""
+        request_body = dict(body, stream=False)
+        for attempt in range(BATCH_MAX_RETRIES + 1):
+            if attempt:
+                BATCH_REQUESTS_TOTAL.inc("retried")
+                time.sleep(retry_delay(attempt, BATCH_RETRY_BACKOFF))
+            try:
+                with self.app.app_context():
+                    result = self.pool.chat_completions(request_body)
+                    response, status_code = result if isinstance(result, tuple) else (result, result.status_code)
+                    response_body = response.get_json()
+            except UpstreamUnavailable as e:
+                status_code, response_body = 503, error_response(str(e), "upstream_unavailable")
+            except Exception as e:
+                status_code, response_body = 500, error_response(f"内部服务器错误: {str(e)}")
+            if status_code < 500 and status_code != 429:
+                break
+        return status_code, response_body
+
+
+class LeaderLock:
+    """
+    多进程模式下选出一个工作进程 (leader) 运行只需一份的后台任务：历史同步、历史库压缩与批处理。
+    以非阻塞 flock 锁住数据库旁的锁文件，持有者退出（包括被杀死）时锁由内核释放；
+    没有抢到锁的进程每隔 LEADER_RETRY_INTERVAL 秒重试，leader 被重启或替换后由其他进程接替。
+    """
+
+    def __init__(self, path: str, retry_interval: float = LEADER_RETRY_INTERVAL):
+        self.path = path
+        self.retry_interval = retry_interval
+        self._file = None
+        self._stop = threading.Event()
+        self.is_leader = False
+
+    def acquire(self) -> bool:
+        """尝试成为 leader，不等待"""
+        import fcntl  # 只有多进程模式（gunicorn，仅支持 Unix）使用
+        if self._file is None:
+            self._file = open(self.path, "a")
         try:
-            response = self.session.delete(url)
-            response.raise_for_status()
-            res_data = response.json()
-            if res_data.get('success', False):
-                debug_print(f"成功删除对话: {chat_id}")
-                # 同时删除本地记录
-                self.history_manager.delete_session(chat_id)
-                return True
-            else:
-                debug_print(f"删除对话 {chat_id} 返回 success=False: {res_data}")
-                return False
-        except requests.exceptions.RequestException as e:
-            debug_print(f"删除对话失败 {chat_id}: {e}")
-            return False
-        except json.JSONDecodeError:
-            debug_print(f"删除对话时无法解析 JSON 响应 {chat_id}")
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
             return False
+        self.is_leader = True
+        return True
 
-    def find_matching_session(self, messages: list):
-        """根据消息历史查找匹配的会话"""
-        debug_print("开始查找匹配的会话")
-        
-        # 检查是否有AI回复历史
-        last_assistant_message = None
-        for msg in reversed(messages):
-            if msg.get('role') == 'assistant':
-                last_assistant_message = msg
-                break
-        
-        if not last_assistant_message:
-            debug_print("请求中没有AI回复历史，将创建新会话")
-            return None
-        
-        last_content = last_assistant_message.get('content', '')
-        if not last_content:
-            debug_print("最新AI回复内容为空，将创建新会话")
-            return None
-        
-        debug_print("查找匹配...")
-        
-        # 查找匹配的会话
-        matched_session = self.history_manager.get_session_by_last_content(last_content)
-        
+    def campaign(self, on_elected):
+        """在工作进程中调用：抢到锁时立即执行 on_elected，否则在后台线程中定期重试直到抢到或进程退出"""
+        if self.acquire():
+            on_elected()
+            return
+
+        def retry():
+            while not self._stop.wait(self.retry_interval):
+                if self.acquire():
+                    debug_print(f"工作进程 {os.getpid()} 接替成为 leader")
+                    on_elected()
+                    return
+
+        threading.Thread(target=retry, daemon=True, name="leader-campaign").start()
+
+    def close(self):
+        """进程退出前释放锁，让其他工作进程尽快接替"""
+        self._stop.set()
+        if self._file is not None:
+            self._file.close()  # 关闭文件即释放 flock
+            self._file = None
+            self.is_leader = False
+
+
+def account_db_path(auth_token: str) -> str:
+    """多账号时每个账号使用独立的历史库，按 token 指纹命名以免调整顺序后错位"""
+    stem, ext = os.path.splitext(DATABASE_PATH)
+    fingerprint = hashlib.sha256(auth_token.encode('utf-8')).hexdigest()[:12]
+    return f"{stem}_{fingerprint}{ext}"
+
+
+class AccountPool:
+    """
+    管理多个 Qwen 账号。
+    新对话调度到在途请求最少的可用账号；续接对话固定路由到拥有该 chat_id 的账号。
+    """
+
+    def __init__(self, auth_tokens: list, base_url: str = QWEN_BASE_URL):
+        self.clients = []
+        for index, auth_token in enumerate(auth_tokens):
+            db_path = DATABASE_PATH if len(auth_tokens) == 1 else account_db_path(auth_token)
+            try:
+                self.clients.append(QwenClient(auth_token, base_url, db_path=db_path,
+                                               name=f"account-{index}"))
+            except requests.exceptions.RequestException:
+                # 单账号时保持原有行为：初始化失败直接退出
+                if len(auth_tokens) == 1:
+                    raise
+                print(f"账号 account-{index} 初始化失败，已跳过")
+        if not self.clients:
+            raise RuntimeError("没有可用的 Qwen 账号")
+
+    @property
+    def primary(self) -> QwenClient:
+        """第一个可用账号，用于模型列表等与账号无关的查询"""
+        return self.clients[0]
+
+    def select(self, messages: list):
+        """
+        为一次请求选择账号，返回 (账号, 匹配到的会话)。
+        会话为 None 表示按新对话处理；只有一个账号时不在此查找，返回 LOOKUP_SESSION 由 prepare_chat 查找。
+        """
+        if len(self.clients) == 1:
+            return self.clients[0], LOOKUP_SESSION
+
+        # 粘性路由：续接对话必须发往拥有该会话的账号，先于冷却过滤查找，限流冷却中的拥有者仍然使用；
+        # 只有拥有者熔断或认证/连续故障时才改由其他账号按新对话处理
+        owner, matched_session = self._find_session_owner(messages)
         if matched_session:
-            debug_print(f"找到匹配的会话: {matched_session['chat_id']}")
-            return matched_session
-        else:
-            debug_print("未找到匹配的会话，将创建新会话")
-            return None
+            if not owner.breaker.is_open() and not owner.health.failing():
+                debug_print(f"续接对话路由到 {owner.name}")
+                return owner, matched_session
+            debug_print(f"会话所属账号 {owner.name} 不可用，改为新对话")
 
-    def update_session_after_chat(self, chat_id: str, title: str, messages: list, 
-                                  current_response_id: str, assistant_content: str):
-        """聊天结束后更新会话记录"""
-        debug_print(f"更新会话记录: {chat_id}")
-        
-        current_time = int(time.time())
-        
-        self.history_manager.update_session(
-            chat_id=chat_id,
-            title=title,
-            created_at=current_time,
-            updated_at=current_time,
-            chat_type="t2t",
-            current_response_id=current_response_id,
-            last_assistant_content=assistant_content
-        )
+        candidates = [c for c in self.clients if c.health.available() and not c.breaker.is_open()]
+        if not candidates:
+            # 全部账号都在冷却时仍需尝试，选择最早恢复的账号
+            return min(self.clients, key=lambda c: c.health.cooldown_until), None
+
+        # 新对话选择在途请求最少的账号，相同时选择累计请求较少的
+        client = min(candidates, key=lambda c: (c.health.in_flight, c.health.total_requests))
+        debug_print(f"新对话调度到 {client.name}")
+        return client, None
 
-    def chat_completions(self, openai_request: dict):
+    def _find_session_owner(self, messages: list):
         """
-        执行聊天补全，模拟 OpenAI API。
-        返回流式生成器或非流式 JSON 响应。
+        查找拥有可续接会话的账号，返回 (账号, 会话)，未命中时均为 None。
+        前缀哈希链只计算一次；先用各账号的内存缓存确定拥有者，只在该账号上查找。
+        缓存均未命中时（如重启后）才逐个账号查 SQLite，此时跳过缓存，不给非拥有者记入未命中。
         """
-        self._update_auth_header() # 确保 token 是最新的
-        
-        # 解析 OpenAI 请求
-        model = openai_request.get("model", "qwen3")
-        messages = openai_request.get("messages", [])
-        stream = openai_request.get("stream", False)
-        # 解析新增参数
-        enable_thinking = openai_request.get("enable_thinking", True) # 默认启用思考
-        thinking_budget = openai_request.get("thinking_budget", None) # 默认不指定
+        positions = [i for i, msg in enumerate(messages) if msg.get('role') == 'assistant']
+        if not positions:
+            return None, None
+        prefix_hashes = self.primary.history_manager.message_prefix_hashes(messages)
+        latest = prefix_hashes[positions[-1]]
+        for client in self.clients:
+            if client.session_cache.contains(latest):
+                return client, client.find_matching_session(messages, prefix_hashes)
+        for client in self.clients:
+            matched_session = client.find_matching_session(messages, prefix_hashes, use_cache=False)
+            if matched_session:
+                return client, matched_session
+        return None, None
 
-        # 映射模型
-        qwen_model_id = self._get_qwen_model_id(model)
+    def find_owner(self, chat_id: str):
+        """查找本地记录中拥有 chat_id 的账号"""
+        for client in self.clients:
+            if client.history_manager.has_session(chat_id):
+                return client
+        return None
 
-        debug_print(f"收到聊天请求，消息数量: {len(messages)}, 模型: {qwen_model_id}")
-        # debug_print(f"收到的完整请求: \n{openai_request}\n")
+    def cached_response(self, openai_request: dict, cache_control: str = None):
+        """
+        按请求的 Cache-Control 查找响应缓存。
+        返回 (重放的响应, 写入用的键, 结果 memory_hit/disk_hit/miss/bypass)：命中时响应非空；
+        未启用缓存时均为 None。
+        """
+        if not response_cache.enabled:
+            return None, None, None
+        readable, writable = ResponseCache.parse_cache_control(cache_control)
+        model = openai_request.get("model", "qwen3")
+        key = ResponseCache.request_key(openai_request, self.primary.catalog.resolve(model) or model)
+        if not readable:
+            response_cache.record_bypass()
+            RESPONSE_CACHE_TOTAL.inc("bypass")
+            return None, key if writable else None, "bypass"
+        entry, tier = response_cache.get(key)
+        if entry is None:
+            RESPONSE_CACHE_TOTAL.inc("miss")
+            return None, key, "miss"
+        RESPONSE_CACHE_TOTAL.inc(f"{tier}_hit")
+        debug_print(f"响应缓存命中 ({tier}): {key[:12]}")
+        replayed = ResponseCache.replay(entry, model, openai_request.get("stream", False),
+                                        reasoning_stream_mode(openai_request))
+        return replayed, None, f"{tier}_hit"
 
-        # 查找匹配的现有会话
-        matched_session = self.find_matching_session(messages)
-        
-        chat_id = None
-        parent_id = None
-        user_input = ""
-        
-        if matched_session:
-            # 使用现有会话进行增量聊天
-            chat_id = matched_session['chat_id']
-            parent_id = matched_session['current_response_id']
-            
-            # 只取最新的用户消息
-            for msg in reversed(messages):
-                if msg.get('role') == 'user':
-                    user_input = msg.get('content', '')
-                    break
-            
-            debug_print(f"使用现有会话 {chat_id}，parent_id: {parent_id}")
-            # debug_print(f"用户输入: {user_input[:100]}...")
-            
-        else:
-            # 创建新会话，拼接所有消息
-            formatted_history = "\n\n".join([f"{msg['role']}: {msg['content']}" for msg in messages])
-            if messages and messages[0]['role'] != "system":
-                formatted_history = "system:\n\n" + formatted_history
-            user_input = formatted_history
-            
-            chat_id = self.create_chat(qwen_model_id, title=f"OpenAI_API_对话_{int(time.time())}")
-            parent_id = None
-            
-            debug_print(f"创建新会话 {chat_id}")
+    def chat_completions(self, openai_request: dict, cache_control: str = None, trace: RequestTrace = None):
+        """选择账号并执行聊天补全，流式响应在发送完毕后才释放在途计数；缓存命中时直接重放"""
+        cached, cache_key, cache_result = self.cached_response(openai_request, cache_control)
+        if cache_result and has_request_context():
+            g.response_cache = cache_result
+        if cached is not None:
+            return cached if openai_request.get("stream", False) else jsonify(cached)
+        if single_flight.enabled:
+            return self.shared_completions(openai_request, cache_key, trace)
+        client, matched_session = self.select(openai_request.get("messages", []))
+        client.health.begin()
+        if trace is not None:
+            trace.root.set("qwen.account", client.name)
+        try:
+            result = client.chat_completions(openai_request, cache_key, trace, matched_session)
+        except Exception:
+            client.health.end()
+            raise
+        if openai_request.get("stream", False):
+            return self._release_after_stream(client, result)
+        client.health.end()
+        return result
 
+    @staticmethod
+    def _release_after_stream(client: QwenClient, generator):
         try:
-            # 准备请求负载
-            timestamp_ms = int(time.time() * 1000)
-            
-            # 构建 feature_config
-            feature_config = {
-                "output_schema": "phase"
-            }
-            if enable_thinking:
-                feature_config["thinking_enabled"] = True
-                # 如果提供了 thinking_budget 则使用，否则尝试从用户设置获取
-                if thinking_budget is not None:
-                    feature_config["thinking_budget"] = thinking_budget
-                else:
-                    # 尝试从用户设置中获取默认的 thinking_budget
-                    default_budget = self.user_settings.get('model_config', {}).get(qwen_model_id, {}).get('thinking_budget')
-                    if default_budget:
-                        feature_config["thinking_budget"] = default_budget
-            else:
-                feature_config["thinking_enabled"] = False
-
-            payload = {
-                "stream": True, # 始终使用流式以获取实时数据
-                "incremental_output": True,
-                "chat_id": chat_id,
-                "chat_mode": "normal",
-                "model": qwen_model_id,
-                "parent_id": parent_id,
-                "messages": [{
-                    "fid": str(uuid.uuid4()),
-                    "parentId": parent_id,
-                    "childrenIds": [str(uuid.uuid4())],
-                    "role": "user",
-                    "content": user_input,
-                    "user_action": "chat",
-                    "files": [],
-                    "timestamp": timestamp_ms,
-                    "models": [qwen_model_id],
-                    "chat_type": "t2t",
-                    "feature_config": feature_config,
-                    "extra": {"meta": {"subChatType": "t2t"}},
-                    "sub_chat_type": "t2t",
-                    "parent_id": parent_id
-                }],
-                "timestamp": timestamp_ms
-            }
+            yield from generator
+        finally:
+            client.health.end()
 
-            # 添加必要的头
-            headers = {
-                "x-accel-buffering": "no" # 对于流式响应很重要
-            }
+    def flight_key(self, openai_request: dict) -> str:
+        """single-flight 的键，与响应缓存使用同一规范化哈希"""
+        model = openai_request.get("model", "qwen3")
+        return ResponseCache.request_key(openai_request, self.primary.catalog.resolve(model) or model)
 
-            url = f"{self.base_url}/api/v2/chat/completions?chat_id={chat_id}"
-            
-            if stream:
-                # 流式请求
-                def generate():
-                    try:
-                        # 使用流式请求，并确保会话能正确处理连接
-                        with self.session.post(url, json=payload, headers=headers, stream=True) as r:
-                            r.raise_for_status()
-                            finish_reason = "stop"
-                            reasoning_text = ""  # 用于累积 thinking 阶段的内容
-                            assistant_content = ""  # 用于累积assistant回复内容
-                            has_sent_content = False # 标记是否已经开始发送 answer 内容
-                            current_response_id = None  # 当前回复ID
-
-                            for line in r.iter_lines(decode_unicode=True):
-                                # 检查标准的 SSE 前缀
-                                if line.startswith("data: "):
-                                    data_str = line[6:]  # 移除 'data: '
-                                    if data_str.strip() == "[DONE]":
-                                        # 发送最终的 done 消息块，包含 finish_reason
-                                        final_chunk = {
-                                            "id": f"chatcmpl-{chat_id[:10]}",
-                                            "object": "chat.completion.chunk",
-                                            "created": int(time.time()),
-                                            "model": model,
-                                            "choices": [{
-                                                "index": 0,
-                                                "delta": {}, 
-                                                "finish_reason": finish_reason
-                                            }]
-                                        }
-                                        yield f"data: {json.dumps(final_chunk)}\n\n"
-                                        yield "data: [DONE]\n\n"
-                                        break
-                                    try:
-                                        data = json.loads(data_str)
-                                        
-                                        # 提取response_id
-                                        if "response.created" in data:
-                                            current_response_id = data["response.created"].get("response_id")
-                                            debug_print(f"获取到response_id: {current_response_id}")
-                                        
-                                        # 处理 choices 数据
-                                        if "choices" in data and len(data["choices"]) > 0:
-                                            choice = data["choices"][0]
-                                            delta = choice.get("delta", {})
-                                            
-                                            # --- 重构逻辑：清晰区分 think 和 answer 阶段 ---
-                                            phase = delta.get("phase")
-                                            status = delta.get("status")
-                                            content = delta.get("content", "")
-
-                                            # 1. 处理 "think" 阶段
-                                            if phase == "think":
-                                                if status != "finished":
-                                                    reasoning_text += content
-                                                # 注意：think 阶段的内容不直接发送，只累积
-
-                                            # 2. 处理 "answer" 阶段 或 无明确 phase 的内容 (兼容性)
-                                            elif phase == "answer" or (phase is None and content):
-                                                # 一旦进入 answer 阶段或有内容，标记为已开始
-                                                has_sent_content = True 
-                                                assistant_content += content  # 累积assistant回复
-                                                
-                                                # 构造包含 content 的流式块
-                                                openai_chunk = {
-                                                    "id": f"chatcmpl-{chat_id[:10]}",
-                                                    "object": "chat.completion.chunk",
-                                                    "created": int(time.time()),
-                                                    "model": model,
-                                                    "choices": [{
-                                                        "index": 0,
-                                                        "delta": {"content": content},
-                                                        "finish_reason": None # answer 阶段进行中不设 finish_reason
-                                                    }]
-                                                }
-                                                # 如果累积了 reasoning_text，则在第一个 answer 块中附带
-                                                if reasoning_text:
-                                                     openai_chunk["choices"][0]["delta"]["reasoning_content"] = reasoning_text
-                                                     reasoning_text = "" # 发送后清空
-
-                                                yield f"data: {json.dumps(openai_chunk)}\n\n"
-
-                                            # 3. 处理结束信号 (通常在 answer 阶段的最后一个块)
-                                            if status == "finished":
-                                                finish_reason = delta.get("finish_reason", "stop")
-
-                                    except json.JSONDecodeError:
-                                        continue
-                    except requests.exceptions.RequestException as e:
-                        debug_print(f"流式请求失败: {e}")
-                        # 发送一个错误块
-                        error_chunk = {
-                            "id": f"chatcmpl-error",
-                            "object": "chat.completion.chunk",
-                            "created": int(time.time()),
-                            "model": model,
-                            "choices": [{
-                                "index": 0,
-                                "delta": {"content": f"Error during streaming: {str(e)}"},
-                                "finish_reason": "error"
-                            }]
-                        }
-                        yield f"data: {json.dumps(error_chunk)}\n\n"
-                    finally:
-                        # 聊天结束后更新会话记录
-                        if assistant_content and current_response_id:
-                            # 构建完整的消息历史
-                            updated_messages = messages.copy()
-                            updated_messages.append({
-                                "role": "assistant",
-                                "content": assistant_content
-                            })
-                            
-                            self.update_session_after_chat(
-                                chat_id=chat_id,
-                                title=f"OpenAI_API_对话_{int(time.time())}",
-                                messages=updated_messages,
-                                current_response_id=current_response_id,
-                                assistant_content=assistant_content
-                            )
+    def start_flight(self, openai_request: dict, flight: InFlightRequest, cache_key: str = None,
+                     trace: RequestTrace = None):
+        """在后台线程中驱动上游生成，与任何一个订阅者的连接都无关；驱动结束前 leader 的追踪不会导出"""
+        client, matched_session = self.select(openai_request.get("messages", []))
+        client.health.begin()
+        if trace is not None:
+            trace.root.set("qwen.account", client.name)
+            trace.hold()
 
-                return generate()
+        def run():
+            try:
+                client.run_flight(openai_request, flight, cache_key, trace, matched_session)
+            finally:
+                client.health.end()
+                if trace is not None:
+                    trace.release()
 
-            else:
-                # 非流式请求: 聚合流式响应
-                response_text = ""  # 用于聚合最终回复
-                reasoning_text = "" # 用于聚合 thinking 阶段的内容
-                finish_reason = "stop"
-                usage_data = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
-                current_response_id = None
-                
+        threading.Thread(target=run, daemon=True, name="single-flight").start()
+
+    def shared_completions(self, openai_request: dict, cache_key: str = None, trace: RequestTrace = None):
+        """
+        合并同时进行的相同请求：第一个请求启动上游生成，之后的相同请求加入为订阅者。
+        每个请求都作为订阅者按自己的参数重放共享的输出。
+        """
+        received_at = time.perf_counter()
+        flight, leader = single_flight.join(self.flight_key(openai_request))
+        if has_request_context():
+            g.single_flight = "leader" if leader else "joined"
+        if leader:
+            try:
+                self.start_flight(openai_request, flight, cache_key, trace)
+            except Exception as e:
+                single_flight.done(flight)
+                flight.finish(e)
+        return self.flight_response(flight, openai_request, received_at)
+
+    @staticmethod
+    def flight_response(flight: InFlightRequest, openai_request: dict, received_at: float):
+        """single-flight 订阅者：返回流式生成器或非流式 JSON 响应，格式与直接请求上游时相同"""
+        try:
+            ctx = flight.wait_ready()
+        except BaseException:
+            # 准备会话失败时按直接请求的方式抛出，由路由返回错误响应
+            single_flight.leave(flight)
+            raise
+        if "prompt_compaction" in ctx and has_request_context():
+            g.prompt_compaction = ctx["prompt_compaction"]
+        qwen_model_id = ctx["qwen_model_id"]
+        stream = openai_request.get("stream", False)
+        translator = ChatStreamTranslator(ctx["chat_id"], openai_request.get("model", "qwen3"), stream,
+                                          qwen_model_id, reasoning_mode=reasoning_stream_mode(openai_request),
+                                          started=received_at)
+
+        if stream:
+            def generate():
+                ACTIVE_STREAMS.inc(qwen_model_id)
                 try:
-                    with self.session.post(url, json=payload, headers=headers, stream=True) as r:
-                        r.raise_for_status()
-                        for line in r.iter_lines(decode_unicode=True):
-                            # 检查完整的 SSE 前缀
-                            if line.startswith("data: "): 
-                                data_str = line[6:] # 移除 'data: '
-                                if data_str.strip() == "[DONE]":
-                                    break
-                                try:
-                                    data = json.loads(data_str)
-                                    
-                                    # 提取response_id
-                                    if "response.created" in data:
-                                        current_response_id = data["response.created"].get("response_id")
-                                    
-                                    # 处理 choices 数据来构建最终回复
-                                    if "choices" in data and len(data["choices"]) > 0:
-                                        delta = data["choices"][0].get("delta", {})
-                                        
-                                        # 累积 "think" 阶段的内容
-                                        if delta.get("phase") == "think":
-                                            if delta.get("status") != "finished":
-                                                reasoning_text += delta.get("content", "")
-                                        
-                                        # 只聚合 "answer" 阶段的内容
-                                        if delta.get("phase") == "answer":
-                                            if delta.get("status") != "finished":
-                                                response_text += delta.get("content", "")
-                                        
-                                        # 收集最后一次的 usage 信息
-                                        if "usage" in data:
-                                            qwen_usage = data["usage"]
-                                            usage_data = {
-                                                "prompt_tokens": qwen_usage.get("input_tokens", 0),
-                                                "completion_tokens": qwen_usage.get("output_tokens", 0),
-                                                "total_tokens": qwen_usage.get("total_tokens", 0),
-                                            }
-                                    
-                                    # 检查是否是结束信号
-                                    if "choices" in data and len(data["choices"]) > 0:
-                                        delta = data["choices"][0].get("delta", {})
-                                        if delta.get("status") == "finished":
-                                            finish_reason = delta.get("finish_reason", "stop")
-                                        
-                                except json.JSONDecodeError:
-                                    # 忽略无法解析的行
-                                    continue
-                    
-                    # 聊天结束后更新会话记录
-                    if response_text and current_response_id:
-                        # 构建完整的消息历史
-                        updated_messages = messages.copy()
-                        updated_messages.append({
-                            "role": "assistant",
-                            "content": response_text
-                        })
-                        
-                        self.update_session_after_chat(
-                            chat_id=chat_id,
-                            title=f"OpenAI_API_对话_{int(time.time())}",
-                            messages=updated_messages,
-                            current_response_id=current_response_id,
-                            assistant_content=response_text
-                        )
-                    
-                    # 构造非流式的 OpenAI 响应
-                    openai_response = {
-                        "id": f"chatcmpl-{chat_id[:10]}",
-                        "object": "chat.completion",
-                        "created": int(time.time()),
-                        "model": model,
-                        "choices": [{
-                            "index": 0,
-                            "message": {
-                                "role": "assistant",
-                                "content": response_text
-                            },
-                            "finish_reason": finish_reason
-                        }],
-                        "usage": usage_data
-                    }
-                    
-                    # 在非流式响应中添加 reasoning_content
-                    if reasoning_text:
-                        openai_response["choices"][0]["message"]["reasoning_content"] = reasoning_text
-                    
-                    return jsonify(openai_response)
+                    for line in flight.iter_lines(STREAM_KEEPALIVE_INTERVAL):
+                        for chunk in translator.relay_line(line):
+                            yield chunk
+                        if translator.done:
+                            break
+                    for chunk in translator.flush_pending():
+                        yield chunk
+                except requests.exceptions.RequestException as e:
+                    yield translator.error_chunk(e)
                 finally:
-                    pass  # 不再自动删除会话
+                    ACTIVE_STREAMS.dec(qwen_model_id)
+                    translator.close(stages=False)
+                    single_flight.leave(flight)
 
+            return generate()
+
+        try:
+            for line in flight.iter_lines():
+                translator.feed_line(line)
         except requests.exceptions.RequestException as e:
-            debug_print(f"聊天补全失败: {e}")
-            # 返回 OpenAI 格式的错误
-            return jsonify({
-                "error": {
-                    "message": f"内部服务器错误: {str(e)}",
-                    "type": "server_error",
-                    "param": None,
-                    "code": None
-                }
-            }), 500
+            if isinstance(e, UpstreamUnavailable):
+                return jsonify(error_response(str(e), "upstream_unavailable")), 503
+            return jsonify(error_response(f"内部服务器错误: {str(e)}")), 500
+        finally:
+            translator.close(stages=False)
+            single_flight.leave(flight)
+        return jsonify(translator.completion_response())
+
+    def delete_chat(self, chat_id: str) -> bool:
+        """删除对话，本地无记录时依次尝试各账号"""
+        owner = self.find_owner(chat_id)
+        if owner is not None:
+            return owner.delete_chat(chat_id)
+        return any(client.delete_chat(chat_id) for client in self.clients)
+
+    def start_history_sync(self) -> bool:
+        """触发所有账号的历史同步，任一账号成功启动即返回 True"""
+        return any([client.start_history_sync() for client in self.clients])
+
+    def get_sync_status(self) -> dict:
+        """汇总各账号的历史同步进度"""
+        accounts = [{"account": c.name, **c.get_sync_status()} for c in self.clients]
+        states = {a["state"] for a in accounts}
+        if "running" in states:
+            state = "running"
+        elif "failed" in states:
+            state = "failed"
+        else:
+            state = accounts[0]["state"]
+        return {"state": state, "accounts": accounts}
+
+    def upstream_health(self) -> dict:
+        """汇总各账号的上游熔断状态，任一账号熔断时整体为 degraded"""
+        circuits = [{"account": c.name, **c.breaker.snapshot()} for c in self.clients]
+        degraded = any(circuit["state"] != "closed" for circuit in circuits)
+        return {"status": "degraded" if degraded else "healthy", "upstream": circuits}
+
+    def history_stats(self) -> list:
+        """返回各账号历史库的大小、行数与压缩任务状态"""
+        return [{"account": c.name, **c.history_manager.stats(), "compactor": c.compactor.stats()}
+                for c in self.clients]
+
+    def snapshot(self) -> list:
+        """返回各账号的调度状态"""
+        return [{"account": c.name, **c.health.snapshot(), "session_cache": c.session_cache.stats(),
+                 "chat_pool": c.chat_pool.stats(), "model_catalog": c.catalog.stats(),
+                 "circuit": c.breaker.snapshot(), "bootstrap": c.bootstrap}
+                for c in self.clients]
+
+    def after_fork(self, leader: bool):
+        """多进程模式下在每个工作进程中调用；历史同步与压缩只需由其中一个工作进程执行"""
+        for client in self.clients:
+            client.start_background_tasks(leader=leader)
+
+    def start_leader_tasks(self):
+        """工作进程成为 leader 后调用（可能晚于 after_fork，如接替退出的 leader）"""
+        for client in self.clients:
+            client.start_leader_tasks()
+
+    def close(self):
+        """进程退出时清理各账号预创建的空对话，并写入尚未落盘的会话记录"""
+        for client in self.clients:
+            client.catalog.close()
+            client.compactor.close()
+            client.chat_pool.close()
+            if client._hedge_executor is not None:
+                client._hedge_executor.shutdown(wait=False)
+            # 写入后台队列中剩余的会话记录
+            client.history_manager.close()
 
 
 # --- Flask 应用 ---
@@ -755,88 +4310,87 @@ app = Flask(__name__)
 # 配置 CORS，允许所有来源 (生产环境请根据需要进行限制)
 CORS(app) 
 
-# 初始化客户端
-qwen_client = QwenClient(auth_token=QWEN_AUTH_TOKEN)
+# 初始化账号池
+account_pool = AccountPool(QWEN_AUTH_TOKENS)
+qwen_client = account_pool.primary  # 兼容单账号用法
+atexit.register(account_pool.close)
+batch_runner = BatchRunner(account_pool, app)
+leader_lock = LeaderLock(f"{DATABASE_PATH}.leader.lock")
+if not PREFORK:
+    batch_runner.start()
+atexit.register(batch_runner.close)
+
+@app.after_request
+def add_response_headers(response):
+    """
+    提示词被压缩时在响应头中返回本次请求的节省量；启用响应缓存与请求合并时返回对应结果。
+    启用追踪时返回 trace id，并在响应发送完毕（流式响应为客户端收完或断开）后结束追踪。
+    """
+    compaction = g.get("prompt_compaction")
+    if compaction:
+        response.headers["X-Prompt-Compaction"] = compaction_header(compaction)
+    if g.get("response_cache"):
+        response.headers["X-Response-Cache"] = g.response_cache
+    if g.get("single_flight"):
+        response.headers["X-Single-Flight"] = g.single_flight
+    trace = g.get("trace")
+    if trace is not None:
+        trace_response(trace, response.headers, g)
+        status_code = response.status_code
+        response.call_on_close(lambda: trace.finish(status_code))
+    return response
 
 @app.route('/v1/models', methods=['GET'])
 def list_models():
     """列出可用模型 (模拟 OpenAI API)"""
     try:
-        # 从已获取的模型信息构造 OpenAI 格式列表
-        openai_models = []
-        for model_id, model_info in qwen_client.models_info.items():
-            openai_models.append({
-                "id": model_info['info']['id'],
-                "object": "model",
-                "created": model_info['info']['created_at'],
-                "owned_by": model_info['owned_by']
-            })
-        return jsonify({"object": "list", "data": openai_models})
+        # 直接返回预先序列化的响应体，客户端带 If-None-Match 且目录未变化时返回 304
+        snapshot = qwen_client.catalog.snapshot
+        response = Response(snapshot.models_body, content_type='application/json')
+        response.set_etag(snapshot.etag)
+        return response.make_conditional(request)
     except Exception as e:
         print(f"列出模型时出错: {e}")
-        return jsonify({
-            "error": {
-                "message": f"获取模型列表失败: {e}",
-                "type": "server_error",
-                "param": None,
-                "code": None
-            }
-        }), 500
+        return jsonify(error_response(f"获取模型列表失败: {e}")), 500
 
 @app.route('/v1/chat/completions', methods=['POST'])
 def chat_completions():
     """处理 OpenAI 兼容的聊天补全请求"""
     openai_request = request.get_json()
     if not openai_request:
-        return jsonify({
-            "error": {
-                "message": "请求体中 JSON 无效",
-                "type": "invalid_request_error",
-                "param": None,
-                "code": None
-            }
-        }), 400
+        return jsonify(error_response("请求体中 JSON 无效", "invalid_request_error")), 400
 
     stream = openai_request.get("stream", False)
+    g.trace = start_request_trace("POST /v1/chat/completions", request.headers.get("traceparent"))
+    if g.trace is not None:
+        g.trace.root.set("http.request.body.size", request.content_length)
     
     try:
-        result = qwen_client.chat_completions(openai_request)
+        result = account_pool.chat_completions(openai_request, request.headers.get("Cache-Control"), g.trace)
         if stream:
             # 如果是流式响应，`result` 是一个生成器函数
             return Response(stream_with_context(result), content_type='text/event-stream')
         else:
             # 如果是非流式响应，`result` 是一个 Flask Response 对象 (jsonify)
             return result
+    except UpstreamUnavailable as e:
+        return jsonify(error_response(str(e), "upstream_unavailable")), 503
     except Exception as e:
         debug_print(f"处理聊天补全请求时发生未预期错误: {e}")
-        return jsonify({
-            "error": {
-                "message": f"内部服务器错误: {str(e)}",
-                "type": "server_error",
-                "param": None,
-                "code": None
-            }
-        }), 500
+        return jsonify(error_response(f"内部服务器错误: {str(e)}")), 500
 
 @app.route('/v1/chats/<chat_id>', methods=['DELETE'])
 def delete_chat(chat_id):
     """删除指定的对话"""
     try:
-        success = qwen_client.delete_chat(chat_id)
+        success = account_pool.delete_chat(chat_id)
         if success:
             return jsonify({"message": f"会话 {chat_id} 已删除", "success": True})
         else:
             return jsonify({"message": f"删除会话 {chat_id} 失败", "success": False}), 400
     except Exception as e:
         debug_print(f"删除会话时发生错误: {e}")
-        return jsonify({
-            "error": {
-                "message": f"删除会话失败: {str(e)}",
-                "type": "server_error",
-                "param": None,
-                "code": None
-            }
-        }), 500
+        return jsonify(error_response(f"删除会话失败: {str(e)}")), 500
 
 @app.route('/', methods=['GET'])
 def index():
@@ -846,11 +4400,88 @@ def index():
         "docs": "https://platform.openai.com/docs/api-reference/chat"
     })
 
+@app.route('/v1/history/sync', methods=['GET'])
+def history_sync_status():
+    """查询云端历史记录同步进度"""
+    return jsonify(account_pool.get_sync_status())
+
+@app.route('/v1/history/sync', methods=['POST'])
+def history_sync_start():
+    """手动触发一次云端历史记录同步"""
+    started = account_pool.start_history_sync()
+    status_code = 202 if started else 409
+    return jsonify({"started": started, **account_pool.get_sync_status()}), status_code
+
+@app.route('/v1/history/stats', methods=['GET'])
+def history_stats():
+    """查看本地历史库的大小、行数与保留策略执行情况"""
+    return jsonify({"accounts": account_pool.history_stats()})
+
+@app.route('/v1/cache/stats', methods=['GET'])
+def cache_stats():
+    """查看响应缓存的容量与命中率"""
+    return jsonify(response_cache.stats())
+
+@app.route('/v1/single-flight/stats', methods=['GET'])
+def single_flight_stats():
+    """查看相同请求合并的统计"""
+    return jsonify(single_flight.stats())
+
+@app.route('/v1/batches', methods=['POST'])
+def create_batch():
+    """上传 JSONL 批处理任务（请求体即文件内容），后台按有限并发执行"""
+    if not batch_runner.enabled:
+        return jsonify(error_response("批处理接口未启用", "invalid_request_error")), 404
+    try:
+        batch = batch_runner.create(iter(lambda: request.stream.read(64 * 1024), b""))
+    except ValueError as e:
+        return jsonify(error_response(str(e), "invalid_request_error")), 400
+    return jsonify(batch)
+
+@app.route('/v1/batches', methods=['GET'])
+def list_batches():
+    """列出全部批处理任务及其进度"""
+    return jsonify({"object": "list", "data": batch_runner.list() if batch_runner.enabled else []})
+
+@app.route('/v1/batches/<batch_id>', methods=['GET'])
+def get_batch(batch_id):
+    """查询批处理任务的状态与进度"""
+    batch = batch_runner.get(batch_id) if batch_runner.enabled else None
+    if batch is None:
+        return jsonify(error_response(f"批处理任务不存在: {batch_id}", "invalid_request_error")), 404
+    return jsonify(batch)
+
+@app.route('/v1/batches/<batch_id>/cancel', methods=['POST'])
+def cancel_batch(batch_id):
+    """取消批处理任务，已写入的结果保留"""
+    batch = batch_runner.cancel(batch_id) if batch_runner.enabled else None
+    if batch is None:
+        return jsonify(error_response(f"批处理任务不存在: {batch_id}", "invalid_request_error")), 404
+    return jsonify(batch)
+
+@app.route('/v1/batches/<batch_id>/output', methods=['GET'])
+def batch_output(batch_id):
+    """下载批处理结果 (JSONL)，任务进行中时返回目前已完成的部分"""
+    path = batch_runner.output_path(batch_id) if batch_runner.enabled else None
+    if path is None:
+        return jsonify(error_response(f"批处理任务没有结果: {batch_id}", "invalid_request_error")), 404
+    return send_file(os.path.abspath(path), mimetype="application/jsonl")
+
+@app.route('/v1/accounts', methods=['GET'])
+def list_accounts():
+    """查看各账号的调度与健康状态"""
+    return jsonify({"accounts": account_pool.snapshot()})
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus 格式的监控指标"""
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 # 健康检查端点
 @app.route('/health', methods=['GET'])
 def health_check():
-    """健康检查端点"""
-    return jsonify({"status": "healthy"}), 200
+    """健康检查端点；上游熔断时 status 为 degraded，服务本身仍可用故返回 200"""
+    return jsonify(account_pool.upstream_health()), 200
 
 if __name__ == '__main__':
     print(f"正在启动服务器于端口 {PORT}...")